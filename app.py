@@ -1,13 +1,31 @@
 import streamlit as st
 import ezdxf
+from ezdxf.tools.text import plain_mtext
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 import numpy as np
 from openai import OpenAI
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import os
 import io
+import hashlib
+import importlib
+import sys
 import tempfile
+import threading
+import urllib.request
+import time
+import pickle
+import multiprocessing
+import concurrent.futures
+import zipfile
+import json
+import random
+import uuid
+import re
+import shutil
 import xml.etree.ElementTree as ET
 from PIL import Image
 from gradio_client import Client, handle_file
@@ -601,93 +619,2946 @@ else:
 </style>
 """, unsafe_allow_html=True)
 
-# Get Groq API key from environment variable
-groq_api_key = os.getenv("GROQ_API_KEY") # <--- MODIFIED LINE
+# --- Service Clients ---
 
-# Initialize LLM Client (from CAD_GUI.py)
-try:
-    if groq_api_key: # <--- ADDED CHECK
-        llm_client = OpenAI(
-            api_key=groq_api_key, # <--- MODIFIED LINE
-            base_url="https://api.groq.com/openai/v1"
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+VECTORIZER_SPACE = "openfree/image-to-vector"
+# Seconds after which a cached service health status is refreshed in the background.
+SERVICE_HEALTH_TTL = 300
+
+@st.cache_resource
+def get_llm_client():
+    """Returns the process-wide Groq client, created on first use; None when GROQ_API_KEY is not set."""
+    groq_api_key = os.getenv("GROQ_API_KEY")
+    if not groq_api_key:
+        return None
+    return OpenAI(api_key=groq_api_key, base_url=GROQ_BASE_URL)
+
+@st.cache_resource
+def get_gradio_client():
+    """Returns the process-wide client of the vectorization Space, connecting on first use.
+
+    A failed connection raises and is not cached, so the next call tries again.
+    """
+    return Client(VECTORIZER_SPACE)
+
+class ServiceHealth:
+    """Last known health of an external service; stale results are refreshed in a background thread."""
+
+    def __init__(self, check, ttl):
+        self._check = check
+        self.ttl = ttl
+        self.ok = None  # unknown until the first check has finished
+        self.message = ""
+        self.checked_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def status(self):
+        """Returns (ok, message) without blocking; ok is None while the first check is running."""
+        with self._lock:
+            stale = self.checked_at is None or time.monotonic() - self.checked_at > self.ttl
+            if stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh, daemon=True).start()
+            return self.ok, self.message
+
+    def _refresh(self):
+        try:
+            self._check()
+            ok, message = True, ""
+        except Exception as ex:
+            ok, message = False, str(ex)
+        with self._lock:
+            self.ok, self.message = ok, message
+            self.checked_at = time.monotonic()
+            self._refreshing = False
+
+def _check_llm_service():
+    client = get_llm_client()
+    if client is None:
+        raise RuntimeError("GROQ_API_KEY environment variable not found. Please set it to enable AI services.")
+    client.models.list()
+
+def _check_vectorizer_service():
+    with urllib.request.urlopen(get_gradio_client().src, timeout=10):
+        pass
+
+@st.cache_resource
+def get_service_health():
+    """Returns the process-wide health trackers of the AI and vectorization services."""
+    return {
+        'llm': ServiceHealth(_check_llm_service, SERVICE_HEALTH_TTL),
+        'vectorizer': ServiceHealth(_check_vectorizer_service, SERVICE_HEALTH_TTL),
+    }
+
+def llm_client_ready():
+    """True unless the AI service is known to be unavailable."""
+    if not os.getenv("GROQ_API_KEY"):
+        return False
+    ok, _ = get_service_health()['llm'].status()
+    return ok is not False
+
+def gradio_client_ready():
+    """True unless the vectorization service is known to be unavailable."""
+    ok, _ = get_service_health()['vectorizer'].status()
+    return ok is not False
+
+def service_unavailable_reason(name):
+    """Returns the message of the last failed health check of a service, if any."""
+    if name == 'llm' and not os.getenv("GROQ_API_KEY"):
+        return "GROQ_API_KEY environment variable not found. Please set it to enable AI services."
+    return get_service_health()[name].status()[1]
+
+# --- Parsed Drawing Cache ---
+
+# Upper bound for the memory held by parsed drawings, shared by all sessions.
+DXF_CACHE_MAX_BYTES = int(os.getenv("DXF_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+class SizedLRUCache:
+    """Thread-safe LRU cache whose entries are evicted once their total size exceeds max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+
+    def pop(self, key):
+        """Removes an entry if present."""
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is not None:
+                self.current_bytes -= item[1]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+@st.cache_resource
+def get_drawing_cache():
+    """Returns the process-wide cache of parsed DXF drawings keyed by file hash."""
+    return SizedLRUCache(DXF_CACHE_MAX_BYTES)
+
+def hash_file_bytes(file_bytes):
+    """Returns the SHA-256 hex digest used to key cached drawings."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+# --- Geometry Sidecar Files ---
+
+# Directory for persistent caches; extracted drawings live in its "drawings" subdirectory.
+CACHE_DIR = os.getenv("TAILAI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tailai"))
+# Bump whenever the sidecar layout or the DrawingGeometry fields change; older sidecars are rebuilt.
+SIDECAR_FORMAT_VERSION = 3
+
+def _sidecar_dir(file_hash):
+    return os.path.join(CACHE_DIR, "drawings", file_hash)
+
+def _write_json_atomic(path, data):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def save_drawing_sidecar(file_hash, result, visualization_description=""):
+    """Persists a parse result as one .npy file per geometry array plus a meta.json, keyed by file hash."""
+    final_dir = _sidecar_dir(file_hash)
+    temp_dir = f"{final_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        fields = result['geometry']
+        for name in DrawingGeometry.ARRAY_FIELDS:
+            np.save(os.path.join(temp_dir, f"{name}.npy"), fields[name])
+        _write_json_atomic(os.path.join(temp_dir, "meta.json"), {
+            'format_version': SIDECAR_FORMAT_VERSION,
+            'lists': {name: fields[name] for name in DrawingGeometry.LIST_FIELDS},
+            'entity_summary': dict(result['entity_summary']),
+            'layers': sorted(result['layers']),
+            'visualization_description': visualization_description,
+        })
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(temp_dir, final_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def load_drawing_sidecar(file_hash):
+    """Returns the parse result stored for file_hash with its arrays memory-mapped, or None if missing or stale."""
+    directory = _sidecar_dir(file_hash)
+    try:
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get('format_version') != SIDECAR_FORMAT_VERSION:
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        fields = {name: meta['lists'][name] for name in DrawingGeometry.LIST_FIELDS}
+        for name in DrawingGeometry.ARRAY_FIELDS:
+            fields[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return {
+        'geometry': fields,
+        'entity_summary': meta['entity_summary'],
+        'layers': set(meta['layers']),
+        'visualization_description': meta.get('visualization_description', ""),
+    }
+
+def update_sidecar_description(file_hash, visualization_description):
+    """Stores a newly generated visualization description in an existing sidecar."""
+    meta_path = os.path.join(_sidecar_dir(file_hash), "meta.json")
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        meta['visualization_description'] = visualization_description
+        _write_json_atomic(meta_path, meta)
+    except (OSError, ValueError):
+        pass
+
+# --- LLM Response Cache ---
+
+LLM_MODEL = "llama-3.3-70b-versatile"
+# Cached completions expire after this long; the disk tier is trimmed oldest-first beyond its size limit.
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL_HOURS", "168")) * 3600
+LLM_CACHE_MEMORY_MAX_BYTES = 16 * 1024 * 1024
+LLM_CACHE_DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_MB", "64")) * 1024 * 1024
+# Disk writes between full scans of the cache directory, which also drop expired files.
+LLM_CACHE_DISK_SCAN_WRITES = 100
+# Share of disk_max_bytes an over-full cache is trimmed to, so that the next writes need no scan.
+LLM_CACHE_DISK_TRIM_SHARE = 0.75
+
+class LLMResponseCache:
+    """Two-tier (memory LRU, JSON files on disk) cache of chat completions with TTL and size-bounded eviction."""
+
+    def __init__(self, directory, ttl, memory_max_bytes, disk_max_bytes):
+        self.directory = directory
+        self.ttl = ttl
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = SizedLRUCache(memory_max_bytes)
+        self._disk_lock = threading.Lock()
+        # Bytes of the cache files, tracked between directory scans; None until the first scan.
+        self._disk_bytes = None
+        self._disk_writes = 0
+
+    @staticmethod
+    def make_key(messages, model, temperature, max_tokens):
+        request = json.dumps(
+            {'messages': messages, 'model': model, 'temperature': temperature, 'max_tokens': max_tokens},
+            sort_keys=True,
         )
-        st.session_state.llm_client_ready = True
-    else: # <--- ADDED ELSE BLOCK
-        st.error("GROQ_API_KEY environment variable not found. Please set it to enable AI services.")
-        st.session_state.llm_client_ready = False
-except Exception as e:
-    st.error("Failed to initialize AI services. Please check your internet connection or try again later.")
-    st.session_state.llm_client_ready = False
-
-# Initialize Gradio Client (from SVG_Converter.py)
-try:
-    gradio_client = Client("openfree/image-to-vector")
-    st.session_state.gradio_client_ready = True
-except Exception as e:
-    st.error("Failed to initialize vectorization services. Please check your internet connection or try again later.")
-    st.session_state.gradio_client_ready = False
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """Returns the cached completion text, or None if missing or expired; expired entries are evicted."""
+        item = self._memory.get(key)
+        if item is None:
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    item = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if time.time() - item['created'] > self.ttl:
+            self._memory.pop(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+        self._memory.put(key, item, len(item['response']))
+        return item['response']
 
-# --- Helper Functions ---
+    def put(self, key, response):
+        item = {'created': time.time(), 'response': response}
+        self._memory.put(key, item, len(response))
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            _write_json_atomic(path, item)
+            written = os.path.getsize(path)
+        except OSError:
+            return
+        with self._disk_lock:
+            self._disk_writes += 1
+            if self._disk_bytes is not None:
+                self._disk_bytes += written - replaced
+            if (self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes
+                    or self._disk_writes >= LLM_CACHE_DISK_SCAN_WRITES):
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """Scans the cache directory, deleting expired files and, when over disk_max_bytes, the oldest ones.
+
+        Called with _disk_lock held.
+        """
+        try:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        limit = self.disk_max_bytes * LLM_CACHE_DISK_TRIM_SHARE if total > self.disk_max_bytes else self.disk_max_bytes
+        now = time.time()
+        for mtime, size, path in entries:
+            if total <= limit and now - mtime <= self.ttl:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._disk_bytes = total
+        self._disk_writes = 0
+
+@st.cache_resource
+def get_llm_cache():
+    """Returns the process-wide LLM response cache."""
+    return LLMResponseCache(os.path.join(CACHE_DIR, "llm"), LLM_CACHE_TTL, LLM_CACHE_MEMORY_MAX_BYTES, LLM_CACHE_DISK_MAX_BYTES)
+
+def cached_chat_completion(messages, temperature, max_tokens, model=LLM_MODEL):
+    """Returns the completion text for a request; identical requests are answered from the response cache."""
+    cache = get_llm_cache()
+    key = cache.make_key(messages, model, temperature, max_tokens)
+    response_text = cache.get(key)
+    if response_text is None:
+        response = get_llm_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        response_text = response.choices[0].message.content
+        cache.put(key, response_text)
+    return response_text
+
+def stream_chat_completion(messages, temperature, max_tokens, model=LLM_MODEL, metrics=None):
+    """Yields the completion text as tokens arrive; cached responses are yielded in one piece.
+
+    When a metrics dict is given it receives the model, whether the response was cached,
+    the time to first token and the total latency in seconds.
+    """
+    cache = get_llm_cache()
+    key = cache.make_key(messages, model, temperature, max_tokens)
+    started = time.perf_counter()
+    first_token_at = None
+    response_text = cache.get(key)
+    cached = response_text is not None
+    if cached:
+        first_token_at = time.perf_counter()
+        yield response_text
+    else:
+        stream = get_llm_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        parts = []
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(delta)
+                yield delta
+        response_text = "".join(parts)
+        cache.put(key, response_text)
+    if metrics is not None:
+        finished = time.perf_counter()
+        metrics.update(
+            model=model,
+            cached=cached,
+            ttft=(first_token_at or finished) - started,
+            total=finished - started,
+        )
 
-def get_entity_summary(msp):
-    """Generates a summary of DXF entities."""
-    entity_summary = defaultdict(int)
-    layers = set()
-    for e in msp:
-        etype = e.dxftype()
-        entity_summary[etype] += 1
-        layers.add(e.dxf.layer)
-    return entity_summary, layers
+# Rounds of tool calls allowed before the model has to answer.
+LLM_TOOL_ROUNDS = 4
+
+def stream_tool_chat_completion(messages, tools, run_tool, temperature, max_tokens, model=LLM_MODEL, metrics=None):
+    """Yields the completion text as tokens arrive, running the tool calls the model makes in between.
+
+    run_tool(name, arguments) returns the result of a call as a string. These responses are
+    not cached, since they depend on tool results that are not part of the request.
+    """
+    messages = list(messages)
+    started = time.perf_counter()
+    first_token_at = None
+    tool_calls = 0
+    for round_number in range(LLM_TOOL_ROUNDS + 1):
+        # The last round offers no tools, so the model answers with what it has.
+        offered = {'tools': tools} if round_number < LLM_TOOL_ROUNDS else {}
+        stream = get_llm_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            **offered
+        )
+        parts, calls = [], {}
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(delta.content)
+                yield delta.content
+            for call in getattr(delta, 'tool_calls', None) or ():
+                entry = calls.setdefault(call.index, {'id': "", 'name': "", 'arguments': ""})
+                entry['id'] = call.id or entry['id']
+                if call.function is not None:
+                    entry['name'] += call.function.name or ""
+                    entry['arguments'] += call.function.arguments or ""
+        if not calls:
+            break
+        messages.append({"role": "assistant", "content": "".join(parts) or None, "tool_calls": [
+            {"id": c['id'], "type": "function", "function": {"name": c['name'], "arguments": c['arguments']}}
+            for c in calls.values()
+        ]})
+        for c in calls.values():
+            messages.append({"role": "tool", "tool_call_id": c['id'], "content": run_tool(c['name'], c['arguments'])})
+        tool_calls += len(calls)
+    if metrics is not None:
+        finished = time.perf_counter()
+        metrics.update(
+            model=model,
+            cached=False,
+            ttft=(first_token_at or finished) - started,
+            total=finished - started,
+            tool_calls=tool_calls,
+        )
+
+# Recent requests whose latency metrics are kept in session state for the sidebar summary.
+LLM_METRICS_HISTORY = 200
+
+def format_llm_metrics(metrics):
+    """Formats the latency metrics recorded by stream_chat_completion()."""
+    source = " (cached)" if metrics['cached'] else ""
+    prompt = f", ~{metrics['prompt_tokens']} prompt tokens" if 'prompt_tokens' in metrics else ""
+    tools = f", {metrics['tool_calls']} geometry queries" if metrics.get('tool_calls') else ""
+    return f"⏱️ First token after {metrics['ttft']:.2f} s, complete after {metrics['total']:.2f} s{source}{prompt}{tools}"
+
+def summarize_llm_metrics(history):
+    """Describes the recorded requests in one line: counts and median latencies."""
+    cached = sum(metrics['cached'] for metrics in history)
+    ttft = np.median([metrics['ttft'] for metrics in history])
+    total = np.median([metrics['total'] for metrics in history])
+    tools = sum(metrics.get('tool_calls', 0) for metrics in history)
+    return (f"{len(history)} requests ({cached} cached, {tools} geometry queries); "
+            f"median first token {ttft:.2f} s, median complete {total:.2f} s")
+
+# --- Chat Memory ---
+
+CHAT_SYSTEM_PROMPT = "You are a helpful CAD assistant. Respond concisely and accurately based on the provided DXF data."
+# Recent turns are sent verbatim up to this many (estimated) tokens; older turns are folded
+# into a running summary, down to half the budget so that folding does not happen every turn.
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKENS", "1500"))
+CHAT_SUMMARY_MAX_TOKENS = 250
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "llama-3.1-8b-instant")
+
+def estimate_tokens(text):
+    """Rough token count of a text, at about four characters per token."""
+    return len(text) // 4 + 1
+
+def message_tokens(message):
+    """Estimated tokens of a chat message, including the per-message overhead."""
+    return estimate_tokens(message["content"]) + 4
+
+def new_chat_summary():
+    """Returns the empty running summary kept in session state next to the chat history."""
+    return {'text': "", 'folded': 0}
+
+def _summarize_turns(summary_text, turns):
+    """Folds turns into the running summary, keeping the tail of a plain transcript if the LLM fails."""
+    transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in turns)
+    prompt = f"""
+Update the running summary of a conversation between a user and a CAD assistant about a DXF drawing.
+Keep the facts, numbers, entity and layer names, decisions and open questions; drop pleasantries.
+Answer with the updated summary only, in at most {CHAT_SUMMARY_MAX_TOKENS * 3 // 5} words.
+
+Current summary:
+{summary_text if summary_text else '(empty)'}
+
+New turns:
+{transcript}
+"""
+    try:
+        return cached_chat_completion(
+            [{"role": "user", "content": prompt}],
+            temperature=0.2,
+            max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+            model=CHAT_SUMMARY_MODEL
+        ).strip()
+    except Exception:
+        lines = [summary_text] if summary_text else []
+        lines += [f"{m['role'].capitalize()}: {m['content'][:200]}" for m in turns]
+        return "\n".join(lines)[-CHAT_SUMMARY_MAX_TOKENS * 4:]
+
+def budget_chat_history(chat_history, chat_summary, budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """Returns the recent turns to send verbatim, folding older ones into chat_summary.
+
+    chat_summary is updated in place; 'folded' counts the leading messages of chat_history
+    that are already covered by its text.
+    """
+    turns = [m for m in chat_history if m["role"] in ("user", "assistant")]
+    start = min(chat_summary['folded'], len(turns))
+    sizes = [message_tokens(m) for m in turns[start:]]
+    if sum(sizes) > budget:
+        keep, cut = 0, len(turns)
+        for size in reversed(sizes):
+            if keep + size > budget // 2:
+                break
+            keep += size
+            cut -= 1
+        # Start the verbatim part at a question rather than at the answer to a folded one.
+        if cut < len(turns) and turns[cut]["role"] == "assistant":
+            cut += 1
+        chat_summary['text'] = _summarize_turns(chat_summary['text'], turns[start:cut])
+        chat_summary['folded'] = start = cut
+    return turns[start:]
+
+# --- Out-of-Process Parsing ---
+
+# Parser processes allowed to run at once on this server, and the per-file time limit.
+DXF_PARSE_WORKERS = int(os.getenv("DXF_PARSE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+DXF_PARSE_TIMEOUT = float(os.getenv("DXF_PARSE_TIMEOUT", "300"))
+# Parsing runs in child processes started by a fork server (else spawned). Forking the multithreaded
+# Streamlit server itself would copy locks other threads hold, such as logging's, and can deadlock.
+_MP_CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+if _MP_CONTEXT.get_start_method() == "forkserver":
+    # Children still run this file (as __mp_main__, or import it), but find its dependencies loaded.
+    _MP_CONTEXT.set_forkserver_preload(["numpy", "ezdxf", "fitz", "PIL.Image", "matplotlib.pyplot", "streamlit",
+                                        "openai", "gradio_client"])
+
+class _AppModule:
+    """Pickles as this file's module, which the child process imports by name when unpickling.
+
+    Under Streamlit that is __main__, which multiprocessing runs from this file in every child.
+    """
+
+    def __reduce__(self):
+        main = sys.modules.get("__main__")
+        return importlib.import_module, ("__main__" if getattr(main, "__file__", None) == __file__ else __name__,)
+
+class _WorkerFunction:
+    """Picklable reference to a top-level function of this file, resolved by name in the child process.
+
+    Streamlit reruns the script as a fresh __main__ module per session, so pickling a function
+    itself fails whenever another session's rerun has replaced __main__ in the meantime.
+    """
+
+    def __init__(self, function):
+        self.name = function.__name__
+
+    def __call__(self, *args, **kwargs):
+        return globals()[self.name](*args, **kwargs)
+
+    def __reduce__(self):
+        return getattr, (_AppModule(), self.name)
+
+class _ProgressReader(io.RawIOBase):
+    """Raw file wrapper publishing the number of bytes read into progress[0]."""
+
+    def __init__(self, raw, progress):
+        self._raw = raw
+        self._progress = progress
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self._raw.readinto(buffer)
+        self._progress[0] += n or 0
+        return n
+
+def parse_dxf_file(path, progress=None):
+    """Parses a DXF file and extracts everything the analyzer needs from it.
+
+    progress is an optional shared array receiving bytes read, entities extracted and the entity total.
+    Returns picklable plain data, see drawing_from_parse_result().
+    """
+    from ezdxf.filemanagement import dxf_file_info
+    from ezdxf.lldxf.validator import is_dxf_file, is_binary_dxf_file
+
+    if progress is None or is_binary_dxf_file(path):
+        doc = ezdxf.readfile(path)
+    else:
+        if not is_dxf_file(path):
+            raise IOError("The file does not contain DXF data")
+        info = dxf_file_info(path)
+        with open(path, "rb") as raw:
+            reader = io.BufferedReader(_ProgressReader(raw, progress))
+            doc = ezdxf.read(io.TextIOWrapper(reader, encoding=info.encoding, errors="surrogateescape"))
+
+    geometry = extract_geometry(doc.modelspace(), progress)
+    entity_summary, layers = get_entity_summary(geometry)
+    return {
+        'geometry': geometry.to_fields(),
+        'entity_summary': dict(entity_summary),
+        'layers': layers,
+    }
+
+def drawing_from_parse_result(result):
+    """Rebuilds the cached drawing (geometry, indexes, query engine, summary, layers) from parse_dxf_file() output."""
+    geometry = DrawingGeometry(**result['geometry'])
+    spatial_index = build_spatial_index(geometry)
+    return {
+        'geometry': geometry,
+        'spatial_index': spatial_index,
+        'annotation_index': build_annotation_index(geometry, spatial_index),
+        'query_engine': GeometryQueryEngine(geometry, spatial_index),
+        'entity_summary': defaultdict(int, result['entity_summary']),
+        'layers': result['layers'],
+        'visualization_description': result.get('visualization_description', ""),
+    }
+
+def _parse_dxf_worker(file_hash, source_path, result_path, progress):
+    """Child process entry point; writes ('ok', result) or ('error', exception) to result_path.
+
+    The result is persisted as a sidecar first, in which case ('ok', None) tells the parent to load it from there.
+    """
+    try:
+        result = parse_dxf_file(source_path, progress)
+        try:
+            save_drawing_sidecar(file_hash, result)
+            outcome = ('ok', None)
+        except OSError:
+            outcome = ('ok', result)
+    except Exception as ex:
+        outcome = ('error', ex)
+    with open(result_path + ".tmp", "wb") as f:
+        pickle.dump(outcome, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(result_path + ".tmp", result_path)
+
+class DXFParseJob:
+    """One DXF file being parsed in a child process, with progress reporting and cancellation."""
+
+    ACTIVE = ('pending', 'running')
+
+    def __init__(self, file_hash, file_bytes):
+        self.file_hash = file_hash
+        self.total_bytes = len(file_bytes)
+        self.status = 'pending'
+        self.started_at = None
+        fd, self.source_path = tempfile.mkstemp(suffix=".dxf")
+        with os.fdopen(fd, "wb") as f:
+            f.write(file_bytes)
+        self.result_path = self.source_path + ".result"
+        # bytes read, entities extracted, entity total
+        self._progress = _MP_CONTEXT.Array('d', 3, lock=False)
+        self._process = None
+        self._payload = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.status = 'running'
+        self._process = _MP_CONTEXT.Process(
+            target=_WorkerFunction(_parse_dxf_worker),
+            args=(self.file_hash, self.source_path, self.result_path, self._progress),
+            daemon=True,
+        )
+        self._process.start()
+
+    def poll(self, timeout):
+        if self.status != 'running':
+            return self.status
+        if self._process is None or not self._process.is_alive():
+            if self._process is not None:
+                self._process.join()
+            self._collect()
+        elif time.monotonic() - self.started_at > timeout:
+            self.cancel('timeout')
+        return self.status
+
+    def _collect(self):
+        try:
+            with open(self.result_path, "rb") as f:
+                outcome, self._payload = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            exitcode = self._process.exitcode if self._process is not None else None
+            outcome, self._payload = 'error', RuntimeError(f"The DXF parser process exited unexpectedly (exit code {exitcode}).")
+        self.status = 'done' if outcome == 'ok' else 'failed'
+        self._cleanup()
+
+    def cancel(self, status='cancelled'):
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+            self._process.join(2)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+        self.status = status
+        self._cleanup()
+
+    def _cleanup(self):
+        for path in (self.source_path, self.result_path, self.result_path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def progress(self):
+        """Returns (fraction, label) describing how far parsing has got."""
+        bytes_read, entities_done, entities_total = self._progress
+        if self.status == 'pending':
+            return 0.0, "Waiting for a free parser slot..."
+        if entities_total:
+            return 0.8 + 0.2 * entities_done / entities_total, f"Extracting entities... {int(entities_done):,} of {int(entities_total):,}"
+        fraction = min(bytes_read / self.total_bytes, 1.0) if self.total_bytes else 0.0
+        return 0.8 * fraction, f"Reading DXF... {bytes_read / 1e6:.1f} of {self.total_bytes / 1e6:.1f} MB"
+
+    def result(self):
+        """Returns the parse result, re-raising the parser's exception if it failed."""
+        if self.status == 'failed':
+            raise self._payload
+        return self._payload
+
+class DXFParseService:
+    """Server-wide scheduler running at most max_workers parse jobs at once, shared by all sessions."""
+
+    def __init__(self, max_workers, timeout):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, file_hash, file_bytes):
+        """Returns the job parsing this file, starting a new one unless an earlier job is still usable."""
+        with self._lock:
+            job = self._jobs.get(file_hash)
+            if job is None or job.status not in DXFParseJob.ACTIVE + ('done',):
+                job = self._jobs[file_hash] = DXFParseJob(file_hash, file_bytes)
+            self._schedule()
+            return job
+
+    def poll(self, job):
+        with self._lock:
+            job.poll(self.timeout)
+            self._schedule()
+            return job.status
+
+    def cancel(self, file_hash):
+        with self._lock:
+            job = self._jobs.pop(file_hash, None)
+            if job is not None and job.status in DXFParseJob.ACTIVE:
+                job.cancel()
+            self._schedule()
+
+    def release(self, file_hash):
+        """Forgets a finished job once its result has been cached."""
+        with self._lock:
+            job = self._jobs.get(file_hash)
+            if job is not None and job.status not in DXFParseJob.ACTIVE:
+                del self._jobs[file_hash]
+
+    def _schedule(self):
+        running = sum(1 for job in self._jobs.values() if job.status == 'running')
+        for job in self._jobs.values():
+            if running >= self.max_workers:
+                break
+            if job.status == 'pending':
+                job.start()
+                running += 1
+
+@st.cache_resource
+def get_parse_service():
+    """Returns the process-wide DXF parse scheduler."""
+    return DXFParseService(DXF_PARSE_WORKERS, DXF_PARSE_TIMEOUT)
+
+def load_parsed_drawing(file_hash, file_bytes):
+    """Returns the parsed drawing for an upload, parsing it out of process with progress and a cancel button.
+
+    Drawings are looked up in the in-memory cache, then in the sidecar files, before anything is parsed.
+    Returns None while parsing was cancelled or timed out; parser errors are re-raised.
+    """
+    cache = get_drawing_cache()
+    drawing = cache.get(file_hash)
+    if drawing is not None:
+        return drawing
+
+    result = load_drawing_sidecar(file_hash)
+    if result is not None:
+        drawing = drawing_from_parse_result(result)
+        cache.put(file_hash, drawing, drawing['geometry'].nbytes)
+        return drawing
+
+    if st.session_state.get('dxf_parse_cancelled') == file_hash:
+        st.warning("Parsing of this DXF file was stopped.")
+        if st.button("Retry Parsing", key="retry_parse_btn"):
+            st.session_state.dxf_parse_cancelled = None
+            st.rerun()
+        return None
+
+    service = get_parse_service()
+    job = service.submit(file_hash, file_bytes)
+    controls = st.empty()
+    with controls.container():
+        if st.button("Cancel Parsing", key="cancel_parse_btn"):
+            service.cancel(file_hash)
+            st.session_state.dxf_parse_cancelled = file_hash
+            st.rerun()
+        progress_bar = st.progress(0.0, text="Parsing DXF...")
+        while service.poll(job) in DXFParseJob.ACTIVE:
+            fraction, label = job.progress()
+            progress_bar.progress(min(fraction, 1.0), text=label)
+            time.sleep(0.2)
+    controls.empty()
+
+    if job.status in ('cancelled', 'timeout'):
+        st.session_state.dxf_parse_cancelled = file_hash
+        if job.status == 'timeout':
+            st.error(f"Parsing the DXF file took longer than {service.timeout:g} seconds and was stopped.")
+        else:
+            st.warning("Parsing of this DXF file was cancelled.")
+        return None
+
+    try:
+        result = job.result()
+        if result is None:
+            result = load_drawing_sidecar(file_hash)
+        if result is None:
+            raise RuntimeError("The parsed drawing could not be read back from the cache directory.")
+        drawing = drawing_from_parse_result(result)
+    finally:
+        service.release(file_hash)
+    cache.put(file_hash, drawing, drawing['geometry'].nbytes)
+    return drawing
+
+# --- Columnar Geometry Extraction ---
+
+class DrawingGeometry:
+    """Columnar NumPy view of a modelspace, extracted in a single pass over its entities.
+
+    Every entity gets a type code, a layer code and a row into the table of its kind
+    (-1 for kinds without a geometry table, or when extraction failed). Block definitions used by
+    inserts are kept tessellated once, see extract_blocks(), with one instance matrix per placement.
+    """
+
+    ARRAY_FIELDS = (
+        'type_codes', 'layer_codes', 'rows',
+        'line_start', 'line_end', 'line_index',
+        'circle_center', 'circle_radius', 'circle_index',
+        'arc_center', 'arc_radius', 'arc_start_angle', 'arc_end_angle', 'arc_index',
+        'poly_vertices', 'poly_offsets', 'poly_closed', 'poly_index',
+        'face_vertices', 'face_index',
+        'text_insert', 'text_height', 'text_index',
+        'insert_point', 'insert_scale', 'insert_rotation', 'insert_grid', 'insert_index',
+        'error_index',
+        'block_vertices', 'block_vertex_starts', 'block_type_counts',
+        'block_entity_block', 'block_entity_type', 'block_entity_layer', 'block_entity_bounds',
+        'block_entity_length', 'block_entity_area', 'block_entity_radius',
+        'block_segment_entity', 'block_segment_vector',
+        'block_run_block', 'block_run_type', 'block_run_start', 'block_run_length', 'block_run_count',
+        'block_text_insert', 'block_text_height', 'block_text_type', 'block_text_block',
+        'instance_block', 'instance_matrix', 'instance_owner',
+    )
+    LIST_FIELDS = ('type_names', 'layer_names', 'text_strings', 'insert_names', 'error_messages',
+                   'block_names', 'block_text_strings')
+
+    def __init__(self, **fields):
+        for name in self.ARRAY_FIELDS + self.LIST_FIELDS:
+            setattr(self, name, fields[name])
+
+    @property
+    def entity_count(self):
+        return len(self.type_codes)
+
+    @property
+    def nbytes(self):
+        array_bytes = sum(getattr(self, name).nbytes for name in self.ARRAY_FIELDS)
+        string_bytes = sum(len(text) for name in self.LIST_FIELDS for text in getattr(self, name))
+        return array_bytes + string_bytes
+
+    def to_fields(self):
+        """Returns the geometry as a plain dict of arrays and lists, the inverse of DrawingGeometry(**fields)."""
+        return {name: getattr(self, name) for name in self.ARRAY_FIELDS + self.LIST_FIELDS}
+
+    @property
+    def has_3d(self):
+        return any(name in ("3DFACE", "POLYLINE") for name in self.type_names)
+
+    def type_name(self, i):
+        return self.type_names[self.type_codes[i]]
+
+    def layer_name(self, i):
+        return self.layer_names[self.layer_codes[i]]
+
+    def polyline_vertices(self, row):
+        return self.poly_vertices[self.poly_offsets[row]:self.poly_offsets[row + 1]]
+
+    def error_message(self, i):
+        hits = np.flatnonzero(self.error_index == i)
+        return self.error_messages[hits[0]] if len(hits) else None
+
+def _code_for(name, names, lookup):
+    code = lookup.get(name)
+    if code is None:
+        code = lookup[name] = len(names)
+        names.append(name)
+    return code
+
+def _points_array(points, width=3):
+    return np.array(points, dtype=float).reshape(-1, width)
+
+def extract_geometry(msp, progress=None, expand_blocks=True):
+    """Walks the modelspace once and returns its geometry as a DrawingGeometry.
+
+    progress is an optional shared array whose slots 1 and 2 receive entities done and the total.
+    With expand_blocks the block definitions referenced by inserts are extracted as well.
+    """
+    type_names, type_lookup = [], {}
+    layer_names, layer_lookup = [], {}
+    type_codes, layer_codes, rows = [], [], []
+    line_start, line_end, line_index = [], [], []
+    circle_center, circle_radius, circle_index = [], [], []
+    arc_center, arc_radius, arc_start_angle, arc_end_angle, arc_index = [], [], [], [], []
+    poly_vertices, poly_offsets, poly_closed, poly_index = [], [0], [], []
+    face_vertices, face_index = [], []
+    text_insert, text_height, text_strings, text_index = [], [], [], []
+    insert_point, insert_scale, insert_rotation, insert_grid, insert_names, insert_index = [], [], [], [], [], []
+    error_index, error_messages = [], []
+    if progress is not None:
+        progress[2] = len(msp)
 
-def get_entity_details(msp):
-    """Generates detailed information about each DXF entity."""
-    detail_text = "🔍 Entity Details:\n"
     for i, e in enumerate(msp):
+        if progress is not None and i % 5000 == 0:
+            progress[1] = i
         etype = e.dxftype()
-        detail_text += f"\n--- Entity {i+1}: {etype} (Layer: {e.dxf.layer}) ---\n"
+        type_codes.append(_code_for(etype, type_names, type_lookup))
+        layer_codes.append(_code_for(e.dxf.layer, layer_names, layer_lookup))
+        row = -1
         try:
             if etype == 'LINE':
-                detail_text += f"  Start: ({e.dxf.start.x:.2f}, {e.dxf.start.y:.2f}, {e.dxf.start.z:.2f})\n"
-                detail_text += f"  End:   ({e.dxf.end.x:.2f}, {e.dxf.end.y:.2f}, {e.dxf.end.z:.2f})\n"
+                start, end = e.dxf.start, e.dxf.end
+                row = len(line_index)
+                line_start.append(start.xyz)
+                line_end.append(end.xyz)
+                line_index.append(i)
             elif etype == 'CIRCLE':
-                detail_text += f"  Center: ({e.dxf.center.x:.2f}, {e.dxf.center.y:.2f}, {e.dxf.center.z:.2f}), Radius: {e.dxf.radius:.2f}\n"
+                center, r = e.dxf.center, e.dxf.radius
+                row = len(circle_index)
+                circle_center.append(center.xyz)
+                circle_radius.append(r)
+                circle_index.append(i)
             elif etype == 'ARC':
-                detail_text += f"  Center: ({e.dxf.center.x:.2f}, {e.dxf.center.y:.2f}, {e.dxf.center.z:.2f}), Radius: {e.dxf.radius:.2f}, Start Angle: {e.dxf.start_angle:.2f}, End Angle: {e.dxf.end_angle:.2f}\n"
-            elif etype == 'TEXT':
-                detail_text += f"  Text: '{e.dxf.text}'\n"
-                detail_text += f"  Location: ({e.dxf.insert.x:.2f}, {e.dxf.insert.y:.2f}, {e.dxf.insert.z:.2f})\n"
-            elif etype == 'MTEXT':
-                detail_text += f"  Text: '{e.dxf.text}'\n"
-                detail_text += f"  Location: ({e.dxf.insert.x:.2f}, {e.dxf.insert.y:.2f}, {e.dxf.insert.z:.2f})\n"
-            elif etype == 'LWPOLYLINE':
-                points = e.get_points()
-                detail_text += f"  Points ({len(points)}):\n"
-                for p in points:
-                    detail_text += f"    ({p[0]:.2f}, {p[1]:.2f}, {p[2]:.2f})\n"
+                center, r = e.dxf.center, e.dxf.radius
+                start_angle, end_angle = e.dxf.start_angle, e.dxf.end_angle
+                row = len(arc_index)
+                arc_center.append(center.xyz)
+                arc_radius.append(r)
+                arc_start_angle.append(start_angle)
+                arc_end_angle.append(end_angle)
+                arc_index.append(i)
             elif etype == 'POLYLINE':
-                detail_text += f"  Vertices ({len(e.vertices)}):\n"
-                for v in e.vertices:
-                    loc = v.dxf.location
-                    detail_text += f"    ({loc.x:.2f}, {loc.y:.2f}, {loc.z:.2f})\n"
+                vertices = [v.dxf.location.xyz for v in e.vertices]
+                row = len(poly_index)
+                poly_vertices.extend(vertices)
+                poly_offsets.append(len(poly_vertices))
+                poly_closed.append(e.is_closed)
+                poly_index.append(i)
+            elif etype == 'LWPOLYLINE':
+                elevation = e.dxf.elevation
+                vertices = [(x, y, elevation) for x, y in e.get_points(format='xy')]
+                row = len(poly_index)
+                poly_vertices.extend(vertices)
+                poly_offsets.append(len(poly_vertices))
+                poly_closed.append(e.closed)
+                poly_index.append(i)
             elif etype == '3DFACE':
-                pts = [e.dxf.vtx0, e.dxf.vtx1, e.dxf.vtx2, e.dxf.vtx3]
-                detail_text += f"  Vertices:\n"
-                for p in pts:
-                    detail_text += f"    ({p.x:.2f}, {p.y:.2f}, {p.z:.2f})\n"
+                vertices = [e.dxf.vtx0.xyz, e.dxf.vtx1.xyz, e.dxf.vtx2.xyz, e.dxf.vtx3.xyz]
+                row = len(face_index)
+                face_vertices.append(vertices)
+                face_index.append(i)
+            elif etype == 'TEXT' or etype == 'MTEXT':
+                insert, text = e.dxf.insert, e.dxf.text
+                height = e.dxf.height if etype == 'TEXT' else e.dxf.char_height
+                row = len(text_index)
+                text_insert.append(insert.xyz)
+                text_height.append(height)
+                text_strings.append(text)
+                text_index.append(i)
             elif etype == 'INSERT':
-                detail_text += f"  Block Name: {e.dxf.name}\n"
-                detail_text += f"  Insertion Point: ({e.dxf.insert.x:.2f}, {e.dxf.insert.y:.2f}, {e.dxf.insert.z:.2f})\n"
-                detail_text += f"  Scale: X={e.dxf.xscale:.2f}, Y={e.dxf.yscale:.2f}, Z={e.dxf.zscale:.2f}\n"
+                name, insert = e.dxf.name, e.dxf.insert
+                scale = (e.dxf.xscale, e.dxf.yscale, e.dxf.zscale)
+                rotation = e.dxf.rotation
+                grid = (e.dxf.row_count, e.dxf.column_count, e.dxf.row_spacing, e.dxf.column_spacing)
+                row = len(insert_index)
+                insert_point.append(insert.xyz)
+                insert_scale.append(scale)
+                insert_rotation.append(rotation)
+                insert_grid.append(grid)
+                insert_names.append(name)
+                insert_index.append(i)
         except Exception as ex:
-            detail_text += f"  (Error extracting details for {etype}: {ex})\n"
+            error_index.append(i)
+            error_messages.append(f"Error extracting details for {etype}: {ex}")
+        rows.append(row)
+
+    inserts = {
+        'insert_point': _points_array(insert_point),
+        'insert_scale': _points_array(insert_scale),
+        'insert_rotation': np.array(insert_rotation, dtype=float),
+        'insert_grid': _points_array(insert_grid, width=4),
+        'insert_index': np.array(insert_index, dtype=np.int64),
+    }
+    blocks = msp.doc.blocks if expand_blocks and msp.doc is not None else None
+    block_fields = extract_blocks(blocks, inserts, insert_names, type_names, type_lookup, layer_names, layer_lookup)
+    return DrawingGeometry(
+        type_codes=np.array(type_codes, dtype=np.int32),
+        layer_codes=np.array(layer_codes, dtype=np.int32),
+        rows=np.array(rows, dtype=np.int64),
+        line_start=_points_array(line_start),
+        line_end=_points_array(line_end),
+        line_index=np.array(line_index, dtype=np.int64),
+        circle_center=_points_array(circle_center),
+        circle_radius=np.array(circle_radius, dtype=float),
+        circle_index=np.array(circle_index, dtype=np.int64),
+        arc_center=_points_array(arc_center),
+        arc_radius=np.array(arc_radius, dtype=float),
+        arc_start_angle=np.array(arc_start_angle, dtype=float),
+        arc_end_angle=np.array(arc_end_angle, dtype=float),
+        arc_index=np.array(arc_index, dtype=np.int64),
+        poly_vertices=_points_array(poly_vertices),
+        poly_offsets=np.array(poly_offsets, dtype=np.int64),
+        poly_closed=np.array(poly_closed, dtype=bool),
+        poly_index=np.array(poly_index, dtype=np.int64),
+        face_vertices=np.array(face_vertices, dtype=float).reshape(-1, 4, 3),
+        face_index=np.array(face_index, dtype=np.int64),
+        text_insert=_points_array(text_insert),
+        text_height=np.array(text_height, dtype=float),
+        text_index=np.array(text_index, dtype=np.int64),
+        error_index=np.array(error_index, dtype=np.int64),
+        type_names=type_names,
+        layer_names=layer_names,
+        text_strings=text_strings,
+        insert_names=insert_names,
+        error_messages=error_messages,
+        **inserts,
+        **block_fields,
+    )
+
+def arc_points(center, radius, start_angle, end_angle, samples=100):
+    """Samples arcs given in degrees into (n, samples) x/y arrays."""
+    start_rad = np.deg2rad(start_angle)
+    end_rad = np.deg2rad(end_angle)
+    end_rad = np.where(start_rad > end_rad, end_rad + 2 * np.pi, end_rad)
+    t = np.linspace(0.0, 1.0, samples)
+    theta = start_rad[:, None] + (end_rad - start_rad)[:, None] * t
+    x = center[:, 0:1] + radius[:, None] * np.cos(theta)
+    y = center[:, 1:2] + radius[:, None] * np.sin(theta)
+    return x, y
+
+def geometry_bounds(geometry):
+    """Returns the (min, max) xyz corners of the plottable geometry, or None if there is none."""
+    mins, maxs = [], []
+
+    def extend(points):
+        if len(points):
+            mins.append(points.min(axis=0))
+            maxs.append(points.max(axis=0))
+
+    extend(geometry.line_start)
+    extend(geometry.line_end)
+    r = geometry.circle_radius[:, None]
+    extend(geometry.circle_center - r * [1, 1, 0])
+    extend(geometry.circle_center + r * [1, 1, 0])
+    if len(geometry.arc_radius):
+        x, y = arc_points(geometry.arc_center, geometry.arc_radius, geometry.arc_start_angle, geometry.arc_end_angle)
+        z = np.broadcast_to(geometry.arc_center[:, 2:3], x.shape)
+        extend(np.column_stack([x.ravel(), y.ravel(), z.ravel()]))
+    extend(geometry.poly_vertices)
+    extend(geometry.face_vertices.reshape(-1, 3))
+    extend(geometry.text_insert)
+    if len(geometry.instance_block):
+        instance_bounds = block_instance_bounds(geometry)
+        extend(instance_bounds[~np.isnan(instance_bounds).any(axis=(1, 2))].reshape(-1, 3))
+    if not mins:
+        return None
+    return np.min(mins, axis=0), np.max(maxs, axis=0)
+
+def entity_bounds(geometry):
+    """Returns per-entity 2D bounding boxes as an (n, 4) array of min_x, min_y, max_x, max_y.
+
+    INSERT entities span the blocks they expand to; entities without plottable geometry
+    (unsupported types, empty blocks) get NaN rows.
+    """
+    bounds = np.full((geometry.entity_count, 4), np.nan)
+    if len(geometry.line_index):
+        xy = np.stack([geometry.line_start[:, :2], geometry.line_end[:, :2]], axis=1)
+        bounds[geometry.line_index] = np.hstack([xy.min(axis=1), xy.max(axis=1)])
+    if len(geometry.circle_index):
+        center, r = geometry.circle_center[:, :2], geometry.circle_radius[:, None]
+        bounds[geometry.circle_index] = np.hstack([center - r, center + r])
+    if len(geometry.arc_index):
+        x, y = arc_points(geometry.arc_center, geometry.arc_radius, geometry.arc_start_angle, geometry.arc_end_angle)
+        bounds[geometry.arc_index] = np.column_stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)])
+    if len(geometry.poly_index):
+        starts, ends = geometry.poly_offsets[:-1], geometry.poly_offsets[1:]
+        rows = np.flatnonzero(ends > starts)
+        if len(rows):
+            xy = geometry.poly_vertices[:, :2]
+            mins = np.minimum.reduceat(xy, starts[rows], axis=0)
+            maxs = np.maximum.reduceat(xy, starts[rows], axis=0)
+            bounds[geometry.poly_index[rows]] = np.hstack([mins, maxs])
+    if len(geometry.face_index):
+        xy = geometry.face_vertices[:, :, :2]
+        bounds[geometry.face_index] = np.hstack([xy.min(axis=1), xy.max(axis=1)])
+    if len(geometry.text_index):
+        # Labels are approximated by their height and an average glyph width.
+        lengths = np.array([len(text) for text in geometry.text_strings], dtype=float)
+        height = geometry.text_height
+        insert = geometry.text_insert[:, :2]
+        bounds[geometry.text_index] = np.column_stack([
+            insert[:, 0], insert[:, 1],
+            insert[:, 0] + 0.6 * height * lengths, insert[:, 1] + height,
+        ])
+    if len(geometry.instance_block):
+        instance_bounds = block_instance_bounds(geometry)
+        finite = ~np.isnan(instance_bounds).any(axis=(1, 2))
+        owners = geometry.instance_owner[finite]
+        mins = np.full((geometry.entity_count, 2), np.inf)
+        maxs = np.full((geometry.entity_count, 2), -np.inf)
+        np.minimum.at(mins, owners, instance_bounds[finite, 0, :2])
+        np.maximum.at(maxs, owners, instance_bounds[finite, 1, :2])
+        owners = np.unique(owners)
+        bounds[owners] = np.hstack([mins[owners], maxs[owners]])
+    return bounds
+
+# --- Block Expansion ---
+
+# Block placements (nested and MINSERT cells included) expanded per drawing; further placements are dropped.
+BLOCK_MAX_INSTANCES = 2_000_000
+# Block vertices transformed per batch when expanding instances for rendering.
+BLOCK_TRANSFORM_BATCH = 4_000_000
+_BOX_CORNERS = np.array([[i >> 2 & 1, i >> 1 & 1, i & 1] for i in range(8)])
+
+def insert_matrices(point, scale, rotation, grid):
+    """Returns the 4x4 block-to-parent matrices of inserts, one per MINSERT cell, and the insert row of each.
+
+    grid holds row count, column count, row spacing and column spacing; cells are spaced along the
+    rotated but unscaled axes of the insert. Extrusion directions are ignored.
+    """
+    counts = np.maximum(grid[:, :2], 1).astype(np.int64)
+    cells = counts[:, 0] * counts[:, 1]
+    owner = np.repeat(np.arange(len(point)), cells)
+    local = np.arange(len(owner)) - np.repeat(np.cumsum(cells) - cells, cells)
+    columns = counts[owner, 1]
+    offset_x = local % columns * grid[owner, 3]
+    offset_y = local // columns * grid[owner, 2]
+    angle = np.deg2rad(rotation[owner])
+    cos, sin = np.cos(angle), np.sin(angle)
+    sx, sy, sz = scale[owner].T
+    matrices = np.zeros((len(owner), 4, 4))
+    matrices[:, 0, 0], matrices[:, 0, 1] = cos * sx, -sin * sy
+    matrices[:, 1, 0], matrices[:, 1, 1] = sin * sx, cos * sy
+    matrices[:, 2, 2] = sz
+    matrices[:, 0, 3] = point[owner, 0] + cos * offset_x - sin * offset_y
+    matrices[:, 1, 3] = point[owner, 1] + sin * offset_x + cos * offset_y
+    matrices[:, 2, 3] = point[owner, 2]
+    matrices[:, 3, 3] = 1.0
+    return matrices, owner
+
+def transform_points(matrices, points):
+    """Applies (k, 4, 4) affine matrices to (n, 3) points, returning (k, n, 3)."""
+    return np.matmul(points, matrices[:, :3, :3].transpose(0, 2, 1)) + matrices[:, None, :3, 3]
+
+def _equal_length_batches(paths):
+    lengths = np.array([len(path) for path in paths])
+    return [np.stack([paths[i] for i in np.flatnonzero(lengths == length)]) for length in np.unique(lengths)]
+
+def extract_blocks(blocks, inserts, insert_names, type_names, type_lookup, layer_names, layer_lookup):
+    """Expands inserts into instances of block definitions that are extracted and tessellated once each.
+
+    Every block reachable from the inserts, nested inserts included, is walked with extract_geometry()
+    and its paths stored relative to its base point as runs of equally long paths. Every placement of
+    a block, with nested and MINSERT placements flattened, becomes an instance: a block id, the
+    block-to-world matrix and the top-level INSERT entity it belongs to. Each block entity is also
+    measured once in block coordinates for GeometryQueryEngine. Returns the block fields of a
+    DrawingGeometry; type and layer names only found in blocks are added to type_names and layer_names.
+    """
+    definitions, block_ids = [], {}
+    pending = list(dict.fromkeys(insert_names)) if blocks is not None else []
+    while pending:
+        name = pending.pop()
+        layout = None if name in block_ids else blocks.get(name)
+        if layout is None:
+            continue
+        block_ids[name] = len(definitions)
+        local = extract_geometry(layout, expand_blocks=False)
+        definitions.append((name, local, np.array(layout.block.dxf.base_point.xyz)))
+        pending.extend(local.insert_names)
+
+    vertices, vertex_starts, total = [], [0], 0
+    run_block, run_type, run_start, run_length, run_count = [], [], [], [], []
+    text_insert, text_height, text_type, text_block, text_strings = [], [], [], [], []
+    entity_block, entity_type, entity_layer, entity_bounds_, entity_length, entity_area, entity_radius = [], [], [], [], [], [], []
+    segment_entity, segment_vector = [], []
+    entity_count, children = 0, []
+    for b, (name, local, base) in enumerate(definitions):
+        codes = np.array([_code_for(etype, type_names, type_lookup) for etype in local.type_names], dtype=np.int64)
+        # Layer 0 inside a block stands for the layer of the insert placing it, marked -1.
+        layers = np.array([-1 if layer == "0" else _code_for(layer, layer_names, layer_lookup)
+                           for layer in local.layer_names], dtype=np.int64)
+        lengths, areas, radii = entity_measures(local)
+        bounds = entity_bounds(local) - np.tile(base[:2], 2)
+        entity_block.append(np.full(local.entity_count, b))
+        entity_type.append(codes[local.type_codes])
+        entity_layer.append(layers[local.layer_codes])
+        entity_bounds_.append(bounds)
+        entity_length.append(lengths)
+        entity_area.append(areas)
+        entity_radius.append(radii)
+        rows, seg_start, seg_end = polyline_segments(local)
+        segment_entity.append(entity_count + np.concatenate([local.line_index, local.poly_index[rows]]))
+        segment_vector.append(np.concatenate([local.line_end[:, :2] - local.line_start[:, :2], seg_end - seg_start]))
+        entity_count += local.entity_count
+        for etype, paths in geometry_paths(local, use_z=True).items():
+            for batch in ([paths] if isinstance(paths, np.ndarray) else _equal_length_batches(paths)):
+                run_block.append(b)
+                run_type.append(type_lookup[etype])
+                run_start.append(total)
+                run_length.append(batch.shape[1])
+                run_count.append(len(batch))
+                vertices.append(batch.reshape(-1, 3) - base)
+                total += len(vertices[-1])
+        vertex_starts.append(total)
+        text_insert.append(local.text_insert - base)
+        text_height.append(local.text_height)
+        text_type.append(codes[local.type_codes[local.text_index]])
+        text_block.append(np.full(len(local.text_index), b))
+        text_strings.extend(local.text_strings)
+        matrices, owner = insert_matrices(local.insert_point - base, local.insert_scale, local.insert_rotation, local.insert_grid)
+        child = np.array([block_ids.get(n, -1) for n in local.insert_names], dtype=np.int64)[owner]
+        children.append((child, matrices))
+
+    flat, visiting = {}, set()
+
+    def flatten(b):
+        # Block ids and matrices of block b itself and of every block nested in it, relative to b.
+        if b not in flat:
+            visiting.add(b)
+            ids, matrices = [np.array([b])], [np.eye(4)[None]]
+            child, child_matrices = children[b]
+            for c in np.unique(child[child >= 0]).tolist():
+                if c in visiting:
+                    continue
+                sub_ids, sub_matrices = flatten(c)
+                placements = child_matrices[child == c]
+                ids.append(np.tile(sub_ids, len(placements)))
+                matrices.append(np.matmul(placements[:, None], sub_matrices[None]).reshape(-1, 4, 4))
+            visiting.discard(b)
+            flat[b] = np.concatenate(ids), np.concatenate(matrices)
+        return flat[b]
+
+    instance_block, instance_matrix, instance_owner = [], [], []
+    if definitions:
+        matrices, owner = insert_matrices(inserts['insert_point'], inserts['insert_scale'],
+                                          inserts['insert_rotation'], inserts['insert_grid'])
+        block = np.array([block_ids.get(name, -1) for name in insert_names], dtype=np.int64)[owner]
+        budget = BLOCK_MAX_INSTANCES
+        for b in np.unique(block[block >= 0]).tolist():
+            sub_ids, sub_matrices = flatten(b)
+            cells = np.flatnonzero(block == b)[:budget // len(sub_ids)]
+            budget -= len(cells) * len(sub_ids)
+            instance_block.append(np.tile(sub_ids, len(cells)))
+            instance_matrix.append(np.matmul(matrices[cells, None], sub_matrices[None]).reshape(-1, 4, 4))
+            instance_owner.append(np.repeat(inserts['insert_index'][owner[cells]], len(sub_ids)))
+
+    type_counts = np.zeros((len(definitions), len(type_names)), dtype=np.int64)
+    entity_block = np.concatenate(entity_block) if entity_block else np.empty(0, dtype=np.int64)
+    entity_type = np.concatenate(entity_type) if entity_type else np.empty(0, dtype=np.int64)
+    np.add.at(type_counts, (entity_block, entity_type), 1)
+    return {
+        'block_names': [name for name, _, _ in definitions],
+        'block_vertices': _points_array(np.concatenate(vertices) if vertices else []),
+        'block_vertex_starts': np.array(vertex_starts, dtype=np.int64),
+        'block_type_counts': type_counts,
+        'block_entity_block': entity_block,
+        'block_entity_type': entity_type,
+        'block_entity_layer': np.concatenate(entity_layer) if entity_layer else np.empty(0, dtype=np.int64),
+        'block_entity_bounds': np.concatenate(entity_bounds_) if entity_bounds_ else np.empty((0, 4)),
+        'block_entity_length': np.concatenate(entity_length) if entity_length else np.empty(0),
+        'block_entity_area': np.concatenate(entity_area) if entity_area else np.empty(0),
+        'block_entity_radius': np.concatenate(entity_radius) if entity_radius else np.empty(0),
+        'block_segment_entity': np.concatenate(segment_entity) if segment_entity else np.empty(0, dtype=np.int64),
+        'block_segment_vector': np.concatenate(segment_vector) if segment_vector else np.empty((0, 2)),
+        'block_run_block': np.array(run_block, dtype=np.int64),
+        'block_run_type': np.array(run_type, dtype=np.int64),
+        'block_run_start': np.array(run_start, dtype=np.int64),
+        'block_run_length': np.array(run_length, dtype=np.int64),
+        'block_run_count': np.array(run_count, dtype=np.int64),
+        'block_text_insert': _points_array(np.concatenate(text_insert) if text_insert else []),
+        'block_text_height': np.concatenate(text_height) if text_height else np.empty(0),
+        'block_text_type': np.concatenate(text_type) if text_type else np.empty(0, dtype=np.int64),
+        'block_text_block': np.concatenate(text_block) if text_block else np.empty(0, dtype=np.int64),
+        'block_text_strings': text_strings,
+        'instance_block': np.concatenate(instance_block) if instance_block else np.empty(0, dtype=np.int64),
+        'instance_matrix': np.concatenate(instance_matrix) if instance_matrix else np.empty((0, 4, 4)),
+        'instance_owner': np.concatenate(instance_owner) if instance_owner else np.empty(0, dtype=np.int64),
+    }
+
+def block_instance_bounds(geometry):
+    """Returns (n, 2, 3) min/max xyz corners of the block instances, NaN for blocks without geometry.
+
+    Each box is the transformed bounding box of the block definition, exact unless rotated.
+    """
+    block_count = len(geometry.block_names)
+    mins, maxs = np.full((block_count, 3), np.inf), np.full((block_count, 3), -np.inf)
+    vertex_block = np.repeat(np.arange(block_count), np.diff(geometry.block_vertex_starts))
+    for block, points in ((vertex_block, geometry.block_vertices), (geometry.block_text_block, geometry.block_text_insert)):
+        np.minimum.at(mins, block, points)
+        np.maximum.at(maxs, block, points)
+    local = np.stack([mins, maxs], axis=1)
+    local[np.isinf(local).any(axis=(1, 2))] = np.nan
+    corners = local[:, _BOX_CORNERS, np.arange(3)]
+    matrices = geometry.instance_matrix
+    points = np.matmul(corners[geometry.instance_block], matrices[:, :3, :3].transpose(0, 2, 1)) + matrices[:, None, :3, 3]
+    return np.stack([points.min(axis=1), points.max(axis=1)], axis=1)
+
+def iter_block_paths(geometry, selected, dims):
+    """Yields (type name, (n, k, dims) paths) of the selected block instances, transformed in batches."""
+    instances = np.flatnonzero(selected)
+    instances = instances[np.argsort(geometry.instance_block[instances], kind='stable')]
+    blocks, firsts = np.unique(geometry.instance_block[instances], return_index=True)
+    run_starts = np.searchsorted(geometry.block_run_block, np.arange(len(geometry.block_names) + 1))
+    for b, group in zip(blocks.tolist(), np.split(instances, firsts[1:])):
+        first, last = geometry.block_vertex_starts[b], geometry.block_vertex_starts[b + 1]
+        if last == first:
+            continue
+        vertices = geometry.block_vertices[first:last]
+        batch = max(1, BLOCK_TRANSFORM_BATCH // len(vertices))
+        for k in range(0, len(group), batch):
+            points = transform_points(geometry.instance_matrix[group[k:k + batch]], vertices)[..., :dims]
+            for r in range(run_starts[b], run_starts[b + 1]):
+                start, length = geometry.block_run_start[r] - first, geometry.block_run_length[r]
+                end = start + length * geometry.block_run_count[r]
+                yield geometry.type_names[geometry.block_run_type[r]], points[:, start:end].reshape(-1, length, dims)
+
+def block_text_labels(geometry, selected):
+    """Returns world insert points, heights and block text rows of the texts in the selected block instances."""
+    text_starts = np.searchsorted(geometry.block_text_block, np.arange(len(geometry.block_names) + 1))
+    instances = np.flatnonzero(selected)
+    block = geometry.instance_block[instances]
+    counts = text_starts[block + 1] - text_starts[block]
+    owner = np.repeat(instances, counts)
+    texts = np.repeat(text_starts[block] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    matrices = geometry.instance_matrix[owner]
+    points = np.matmul(matrices[:, :3, :3], geometry.block_text_insert[texts, :, None])[:, :, 0] + matrices[:, :3, 3]
+    heights = geometry.block_text_height[texts] * np.linalg.norm(matrices[:, :3, 1], axis=1)
+    return points, heights, texts
+
+# --- Spatial Index ---
+
+class GridSpatialIndex:
+    """Uniform grid over entity bounding boxes answering viewport queries without a full scan."""
+
+    # Entities spanning more cells than this are kept in a separate list that every query tests.
+    MAX_CELLS_PER_ENTITY = 16
+    MAX_CELLS_PER_AXIS = 1024
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.valid_ids = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+        self.extent = None
+        self.large_ids = np.empty(0, dtype=np.int64)
+        self.entries = np.empty(0, dtype=np.int64)
+        self.cell_starts = np.zeros(2, dtype=np.int64)
+        self.shape = np.ones(2, dtype=np.int64)
+        self.origin = np.zeros(2)
+        self.cell_size = 1.0
+        if not len(self.valid_ids):
+            return
+
+        b = bounds[self.valid_ids]
+        self.extent = (b[:, :2].min(axis=0), b[:, 2:].max(axis=0))
+        self.origin = self.extent[0]
+        size = np.maximum(self.extent[1] - self.origin, 1e-9)
+        area = size[0] * size[1]
+        cell_size = np.sqrt(area / len(b)) if area > 1e-12 else size.max() / len(b)
+        # Cells smaller than a typical entity would register most entities in many cells.
+        typical = np.median(np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]))
+        self.cell_size = max(cell_size, typical, size.max() / self.MAX_CELLS_PER_AXIS)
+        self.shape = np.floor(size / self.cell_size).astype(np.int64) + 1
+
+        c0, c1 = self._cells(b[:, :2]), self._cells(b[:, 2:])
+        span_w = c1[:, 0] - c0[:, 0] + 1
+        span = span_w * (c1[:, 1] - c0[:, 1] + 1)
+        large = span > self.MAX_CELLS_PER_ENTITY
+        self.large_ids = self.valid_ids[large]
+
+        small = ~large
+        ids, c0, span_w, span = self.valid_ids[small], c0[small], span_w[small], span[small]
+        owner = np.repeat(np.arange(len(ids)), span)
+        local = np.arange(len(owner)) - np.repeat(np.cumsum(span) - span, span)
+        cx = c0[owner, 0] + local % span_w[owner]
+        cy = c0[owner, 1] + local // span_w[owner]
+        cell_ids = cy * self.shape[0] + cx
+        order = np.argsort(cell_ids, kind='stable')
+        self.entries = ids[owner[order]]
+        counts = np.bincount(cell_ids, minlength=int(self.shape.prod()))
+        self.cell_starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def _cells(self, xy):
+        cells = np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self.shape - 1)
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """Returns the sorted indices of entities whose bounding box intersects the viewport."""
+        if self.extent is None:
+            return np.empty(0, dtype=np.int64)
+        candidates = [self.large_ids]
+        (ext_min_x, ext_min_y), (ext_max_x, ext_max_y) = self.extent
+        if min_x <= ext_max_x and max_x >= ext_min_x and min_y <= ext_max_y and max_y >= ext_min_y:
+            c0, c1 = self._cells(np.array([min_x, min_y])), self._cells(np.array([max_x, max_y]))
+            xs = np.arange(c0[0], c1[0] + 1)
+            ys = np.arange(c0[1], c1[1] + 1)
+            cells = (ys[:, None] * self.shape[0] + xs).ravel()
+            starts, ends = self.cell_starts[cells], self.cell_starts[cells + 1]
+            lengths = ends - starts
+            positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+            candidates.append(self.entries[positions])
+        ids = np.unique(np.concatenate(candidates))
+        b = self.bounds[ids]
+        hit = (b[:, 0] <= max_x) & (b[:, 2] >= min_x) & (b[:, 1] <= max_y) & (b[:, 3] >= min_y)
+        return ids[hit]
+
+def build_spatial_index(geometry):
+    """Builds the grid spatial index over the entity bounding boxes of a drawing."""
+    return GridSpatialIndex(entity_bounds(geometry))
+
+# --- Line Deduplication ---
+
+# Endpoints within this distance (drawing units) snap to the same grid cell and count as one point.
+LINE_DEDUP_TOLERANCE = 1e-6
+# Lines whose directions differ by less than this (radians) are treated as parallel when checking overlaps.
+LINE_DEDUP_ANGLE_TOLERANCE = 1e-8
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+def _hash_rows(keys):
+    """Mixes the columns of an (n, k) int64 array into one uint64 hash per row."""
+    h = np.zeros(len(keys), dtype=np.uint64)
+    for column in keys.T:
+        h = (h ^ column.astype(np.uint64)) * _HASH_MULTIPLIER
+        h ^= h >> np.uint64(29)
+    return h
+
+def _run_starts(sorted_keys):
+    """Marks the first row of every run of equal rows in an (n, k) array sorted so equal rows are adjacent."""
+    starts = np.ones(len(sorted_keys), dtype=bool)
+    starts[1:] = (sorted_keys[1:] != sorted_keys[:-1]).any(axis=1)
+    return starts
+
+def find_redundant_lines(start, end, layer_codes, tolerance=LINE_DEDUP_TOLERANCE, angle_tolerance=LINE_DEDUP_ANGLE_TOLERANCE):
+    """Finds LINE rows that repeat or overlap other lines on the same layer.
+
+    Endpoints are snapped to a grid of tolerance-sized cells and hashed, so duplicates in either
+    direction become equal hashes found with one sort. The remaining flat lines are bucketed by
+    layer, elevation, direction and offset from the origin, then swept along their direction to
+    merge overlapping runs into one segment; lines that merely touch are left alone.
+
+    Returns row arrays 'exact' and 'reversed' (duplicates to delete), 'overlapping' (lines absorbed
+    by a merged segment) and 'merged' (the lines kept in their place), with the new endpoints of the
+    merged lines in 'merged_start' and 'merged_end'.
+    """
+    n = len(start)
+    report = {
+        'lines': n,
+        'exact': np.empty(0, dtype=np.int64),
+        'reversed': np.empty(0, dtype=np.int64),
+        'overlapping': np.empty(0, dtype=np.int64),
+        'merged': np.empty(0, dtype=np.int64),
+        'merged_start': np.empty((0, 3)),
+        'merged_end': np.empty((0, 3)),
+    }
+    if n < 2:
+        return report
+    origin = np.minimum(start.min(axis=0), end.min(axis=0))
+    p, q = start - origin, end - origin
+    a = np.round(p / tolerance).astype(np.int64)
+    b = np.round(q / tolerance).astype(np.int64)
+
+    # A line and its reverse share a key once their endpoints are put in lexicographic order.
+    d = a - b
+    first_diff = d[np.arange(n), np.argmax(d != 0, axis=1)]
+    swapped = first_diff > 0
+    low = np.where(swapped[:, None], b, a)
+    high = np.where(swapped[:, None], a, b)
+    keys = np.column_stack([layer_codes, low, high])
+    # Rows are grouped by hash and compared in full, so a hash collision can only hide a duplicate.
+    order = np.argsort(_hash_rows(keys), kind='stable')
+    starts = _run_starts(keys[order])
+    keeper = order[starts][np.cumsum(starts) - 1]
+    duplicates = ~starts
+    reversed_copy = swapped[order] != swapped[keeper]
+    report['exact'] = np.sort(order[duplicates & ~reversed_copy])
+    report['reversed'] = np.sort(order[duplicates & reversed_copy])
+
+    # Collinear overlaps, among the remaining lines that are flat and not degenerate in plan.
+    candidates = np.zeros(n, dtype=bool)
+    candidates[order[starts]] = True
+    candidates &= (a[:, 2] == b[:, 2]) & (low[:, :2] != high[:, :2]).any(axis=1)
+    rows = np.flatnonzero(candidates)
+    if len(rows) < 2:
+        return report
+    p, q = p[rows, :2], q[rows, :2]
+    direction = q - p
+    angle = np.mod(np.arctan2(direction[:, 1], direction[:, 0]), np.pi)
+    angle_bins = int(round(np.pi / angle_tolerance))
+    cos, sin = np.cos(angle), np.sin(angle)
+    t_start = np.round((p[:, 0] * cos + p[:, 1] * sin) / tolerance).astype(np.int64)
+    t_end = np.round((q[:, 0] * cos + q[:, 1] * sin) / tolerance).astype(np.int64)
+    line_keys = np.column_stack([
+        layer_codes[rows], a[rows, 2],
+        np.round(angle / angle_tolerance).astype(np.int64) % angle_bins,
+        np.round((p[:, 1] * cos - p[:, 0] * sin) / tolerance).astype(np.int64),
+    ])
+    order = np.argsort(_hash_rows(line_keys), kind='stable')
+    group_starts = _run_starts(line_keys[order])
+    # Lines alone on their infinite line cannot overlap anything.
+    group_first = np.flatnonzero(group_starts)
+    group_sizes = np.diff(np.append(group_first, len(order)))
+    shared = np.repeat(group_sizes > 1, group_sizes)
+    order, group_starts = order[shared], group_starts[shared]
+    if not len(order):
+        return report
+    group = np.cumsum(group_starts) - 1
+    t0, t1 = np.minimum(t_start, t_end), np.maximum(t_start, t_end)
+    order = order[np.lexsort((t0[order], group))]
+    rows, t0, t1, t_start = rows[order], t0[order], t1[order], t_start[order]
+
+    # The far end reached so far within each bucket: ranking (bucket, t1) makes a plain running
+    # maximum restart at every bucket, and the rank also identifies the line that reaches it.
+    by_end = np.lexsort((t1, group))
+    rank = np.empty(len(rows), dtype=np.int64)
+    rank[by_end] = np.arange(len(rows))
+    reach = np.maximum.accumulate(rank)
+    run_starts = group_starts.copy()
+    run_starts[1:] |= t0[1:] >= t1[by_end[reach[:-1]]]
+    first = np.flatnonzero(run_starts)
+    sizes = np.diff(np.append(first, len(rows)))
+    merged_runs = sizes > 1
+    if not merged_runs.any():
+        return report
+
+    run = np.cumsum(run_starts) - 1
+    keep = np.minimum.reduceat(rows, first)
+    overlapping = (sizes[run] > 1) & (rows != keep[run])
+    report['overlapping'] = np.sort(rows[overlapping])
+
+    # Kept lines keep their own orientation along the merged extent.
+    positions = np.where(rows == keep[run], np.arange(len(rows)), len(rows))
+    kept = np.minimum.reduceat(positions, first)[merged_runs]
+    forward = (t_start[kept] == t0[kept])[:, None]
+    first, last = first[merged_runs], (first + sizes - 1)[merged_runs]
+    far = by_end[reach[last]]
+    lo_point = np.where((t_start[first] == t0[first])[:, None], start[rows[first]], end[rows[first]])
+    hi_point = np.where((t_start[far] == t1[far])[:, None], start[rows[far]], end[rows[far]])
+    report['merged'] = rows[kept]
+    report['merged_start'] = np.where(forward, lo_point, hi_point)
+    report['merged_end'] = np.where(forward, hi_point, lo_point)
+    return report
+
+# --- Annotation Index ---
+
+# Words of an annotation; tags such as "V-102" or "3/4" are kept together and also split into their parts.
+ANNOTATION_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+ANNOTATION_SPLIT_RE = re.compile(r"[-_./]")
+# Number of annotations retrieved for each chatbot question, and listed in the AI summary prompt.
+ANNOTATION_TOP_K = 8
+SUMMARY_MAX_ANNOTATIONS = 40
+# Names of the cells of a 3x3 grid over the drawing extent, bottom row first. Annotations are tagged
+# with them and geometry queries filter by them, so the model sees one vocabulary.
+DRAWING_REGION_GRID = [
+    ["bottom-left", "bottom", "bottom-right"],
+    ["left", "center", "right"],
+    ["top-left", "top", "top-right"],
+]
+# Each region as (min_x, min_y, max_x, max_y) fractions of the drawing extent.
+DRAWING_REGIONS = {name: (col / 3, row / 3, (col + 1) / 3, (row + 1) / 3)
+                   for row, names in enumerate(DRAWING_REGION_GRID) for col, name in enumerate(names)}
+
+def tokenize_annotation(text):
+    """Returns the search terms of an annotation or question."""
+    terms = []
+    for token in ANNOTATION_TOKEN_RE.findall(text.lower()):
+        terms.append(token)
+        parts = ANNOTATION_SPLIT_RE.split(token)
+        if len(parts) > 1:
+            terms.extend(parts)
+            terms.append("".join(parts))
+    return terms
+
+class AnnotationIndex:
+    """BM25-ranked inverted index over the TEXT and MTEXT strings of a drawing.
+
+    Postings are kept in CSR layout: the documents containing term t are
+    doc_ids[term_starts[t]:term_starts[t + 1]], with their term frequencies in tf.
+    Each annotation is tagged with the region of the drawing it lies in.
+    """
+
+    K1 = 1.5
+    B = 0.75
+    MIN_RELATIVE_SCORE = 0.1
+
+    def __init__(self, geometry, extent=None):
+        self.geometry = geometry
+        self.texts = [
+            plain_mtext(text) if geometry.type_name(i) == 'MTEXT' else text
+            for text, i in zip(geometry.text_strings, geometry.text_index)
+        ]
+        self.vocabulary = {}
+        pair_terms, pair_docs = [], []
+        doc_lengths = np.zeros(len(self.texts), dtype=np.int64)
+        for doc, text in enumerate(self.texts):
+            terms = tokenize_annotation(text)
+            doc_lengths[doc] = len(terms)
+            for term in terms:
+                pair_terms.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+            pair_docs.extend([doc] * len(terms))
+
+        pairs = np.unique(np.array(pair_terms, dtype=np.int64) * max(len(self.texts), 1) + np.array(pair_docs, dtype=np.int64), return_counts=True)
+        keys, self.tf = pairs[0], pairs[1].astype(float)
+        terms, self.doc_ids = np.divmod(keys, max(len(self.texts), 1))
+        self.term_starts = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(self.vocabulary)))])
+        df = np.diff(self.term_starts)
+        n = len(self.texts)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+        average = doc_lengths.mean() if n else 0.0
+        self.length_norm = self.K1 * (1 - self.B + self.B * doc_lengths / average) if average else np.full(n, self.K1)
+        self.regions = self._regions(geometry.text_insert, extent)
+
+    @staticmethod
+    def _regions(points, extent):
+        """Names the DRAWING_REGIONS cell that each point lies in."""
+        if extent is None or not len(points):
+            return ["center"] * len(points)
+        origin, size = extent[0], np.maximum(extent[1] - extent[0], 1e-9)
+        col, row = np.clip(np.floor((points[:, :2] - origin) / size * 3), 0, 2).astype(int).T
+        return np.array(DRAWING_REGION_GRID)[row, col].tolist()
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.tf, self.doc_ids, self.term_starts, self.idf, self.length_norm))
+
+    def annotation(self, doc, score=None):
+        """Returns an annotation with its position, region and layer as a dict."""
+        x, y = self.geometry.text_insert[doc][:2]
+        return {
+            'text': self.texts[doc],
+            'x': float(x),
+            'y': float(y),
+            'region': self.regions[doc],
+            'layer': self.geometry.layer_name(self.geometry.text_index[doc]),
+            'score': score,
+        }
+
+    def search(self, query, k=ANNOTATION_TOP_K):
+        """Returns the k annotations ranked highest by BM25 for the query, best first."""
+        term_ids = sorted({self.vocabulary[t] for t in tokenize_annotation(query) if t in self.vocabulary})
+        if not term_ids:
+            return []
+        scores = np.zeros(len(self.texts))
+        for t in term_ids:
+            start, end = self.term_starts[t], self.term_starts[t + 1]
+            docs, tf = self.doc_ids[start:end], self.tf[start:end]
+            scores[docs] += self.idf[t] * tf * (self.K1 + 1) / (tf + self.length_norm[docs])
+        # Hits on a common fragment alone (the "v" of every "V-1xx" tag) are noise next to a real match.
+        hits = np.flatnonzero(scores >= scores.max() * self.MIN_RELATIVE_SCORE)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind='stable')]
+        return [self.annotation(doc, float(scores[doc])) for doc in hits]
+
+    def prominent(self, limit):
+        """Returns up to limit distinct annotations, tallest text first, as titles and labels usually are."""
+        order = np.argsort(-self.geometry.text_height, kind='stable')
+        seen, result = set(), []
+        for doc in order:
+            text = " ".join(self.texts[doc].split())
+            if text and text not in seen:
+                seen.add(text)
+                result.append(self.annotation(doc))
+                if len(result) == limit:
+                    break
+        return result
+
+def build_annotation_index(geometry, spatial_index):
+    """Builds the annotation index of a drawing, tagging regions by the spatial index extent."""
+    return AnnotationIndex(geometry, spatial_index.extent)
+
+def format_annotation(annotation):
+    """Formats a retrieved annotation as a prompt line."""
+    return (f"- '{annotation['text']}' at ({annotation['x']:.2f}, {annotation['y']:.2f}), "
+            f"{annotation['region']} of the drawing, layer {annotation['layer']}")
+
+# --- Geometric Queries ---
+
+_FILTER_PARAMETERS = {
+    'entity_type': {'type': 'string', 'description': "DXF entity type, e.g. LINE, CIRCLE, ARC, LWPOLYLINE, TEXT."},
+    'layer': {'type': 'string', 'description': "Layer name (case-insensitive)."},
+    'region': {'type': 'string', 'enum': list(DRAWING_REGIONS), 'description': "Part of the drawing extent the entity centers must lie in."},
+    'bbox': {
+        'type': 'array', 'items': {'type': 'number'}, 'minItems': 4, 'maxItems': 4,
+        'description': "Drawing-unit box [min_x, min_y, max_x, max_y] the entity centers must lie in.",
+    },
+    'min_radius': {'type': 'number', 'description': "Only circles and arcs with at least this radius."},
+    'max_radius': {'type': 'number', 'description': "Only circles and arcs with at most this radius."},
+}
+
+def _geometry_tool(name, description, required=(), **parameters):
+    properties = dict(_FILTER_PARAMETERS, **parameters)
+    return {'type': 'function', 'function': {
+        'name': name,
+        'description': description,
+        'parameters': {'type': 'object', 'properties': properties, 'required': list(required)},
+    }}
+
+GEOMETRY_TOOLS = [
+    _geometry_tool(
+        "count_entities",
+        "Counts the entities matching the filters, with a breakdown by type and layer. Block (INSERT) contents are "
+        "expanded: each block entity counts once per placement, nested blocks and MINSERT cells included."
+    ),
+    _geometry_tool(
+        "total_length",
+        "Sums the lengths of matching lines, polylines, circles (circumference) and arcs, block contents included."
+    ),
+    _geometry_tool(
+        "total_area",
+        "Sums the enclosed areas of matching circles and closed polylines, block contents included."
+    ),
+    _geometry_tool(
+        "radius_histogram",
+        "Counts matching circles and arcs by radius; exact radii when there are few distinct values, otherwise bins.",
+        bins={'type': 'integer', 'description': "Maximum number of distinct radii or bins, default 10."}
+    ),
+    _geometry_tool(
+        "nearest_entities",
+        "Finds the matching entities closest to a point; entities inside blocks report the INSERT entity and block name.",
+        required=('x', 'y'),
+        x={'type': 'number'},
+        y={'type': 'number'},
+        k={'type': 'integer', 'description': "Number of entities to return, default 1."}
+    ),
+]
+
+def _point_segment_distance(px, py, start, end):
+    d = end - start
+    length_sq = np.einsum('ij,ij->i', d, d)
+    t = np.where(length_sq > 0, ((px - start[:, 0]) * d[:, 0] + (py - start[:, 1]) * d[:, 1]) / np.where(length_sq > 0, length_sq, 1), 0)
+    t = np.clip(t, 0, 1)
+    return np.hypot(start[:, 0] + t * d[:, 0] - px, start[:, 1] + t * d[:, 1] - py)
+
+def polyline_segments(geometry):
+    """Returns the polyline row and 2D end points of every polyline segment, closing segments included."""
+    g = geometry
+    counts = np.diff(g.poly_offsets)
+    vertex_rows = np.repeat(np.arange(len(counts)), counts)
+    xy = g.poly_vertices[:, :2]
+    inner = np.flatnonzero(vertex_rows[:-1] == vertex_rows[1:]) if len(xy) else np.empty(0, dtype=np.int64)
+    closing = np.flatnonzero(g.poly_closed.astype(bool) & (counts > 2))
+    rows = np.concatenate([vertex_rows[inner], closing])
+    seg_start = np.concatenate([xy[inner], xy[g.poly_offsets[closing + 1] - 1]])
+    seg_end = np.concatenate([xy[inner + 1], xy[g.poly_offsets[closing]]])
+    return rows, seg_start, seg_end
+
+def entity_measures(geometry):
+    """Returns per-entity lengths, areas and radii, NaN for entities they do not apply to.
+
+    Polyline bulges are not extracted, so polylines are measured along straight segments.
+    """
+    g, n = geometry, geometry.entity_count
+    lengths, areas, radii = np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+    lengths[g.line_index] = np.linalg.norm(g.line_end - g.line_start, axis=1)
+    lengths[g.circle_index] = 2 * np.pi * g.circle_radius
+    areas[g.circle_index] = np.pi * g.circle_radius ** 2
+    radii[g.circle_index] = g.circle_radius
+    lengths[g.arc_index] = g.arc_radius * np.deg2rad((g.arc_end_angle - g.arc_start_angle) % 360)
+    radii[g.arc_index] = g.arc_radius
+    if len(g.poly_index):
+        rows, seg_start, seg_end = polyline_segments(g)
+        seg_lengths = np.linalg.norm(seg_end - seg_start, axis=1)
+        lengths[g.poly_index] = np.bincount(rows, weights=seg_lengths, minlength=len(g.poly_index))
+        cross = seg_start[:, 0] * seg_end[:, 1] - seg_end[:, 0] * seg_start[:, 1]
+        shoelace = np.abs(np.bincount(rows, weights=cross, minlength=len(g.poly_index))) / 2
+        closed = g.poly_closed.astype(bool)
+        areas[g.poly_index[closed]] = shoelace[closed]
+    return lengths, areas, radii
+
+class GeometryQueryEngine:
+    """Exact counts, lengths, areas and distances over a drawing, precomputed per entity.
+
+    Block contents are expanded: every entity of a block counts once per placement (nested blocks
+    and MINSERT cells included), after the top-level entities. Lengths and areas are NaN for
+    entities they do not apply to. Circles and arcs in non-uniformly scaled blocks are measured
+    as if scaled uniformly by the geometric mean of the scale factors, and block entities are
+    located by their bounding boxes.
+    """
+
+    TOOLS = tuple(tool['function']['name'] for tool in GEOMETRY_TOOLS)
+
+    def __init__(self, geometry, spatial_index):
+        self.geometry = geometry
+        self.spatial_index = spatial_index
+        g, n = geometry, geometry.entity_count
+        self.entity_count = n
+        self.arc_sweeps = np.deg2rad((g.arc_end_angle - g.arc_start_angle) % 360)
+        lengths, areas, radii = entity_measures(g)
+        blocks = self._expand_blocks()
+        self.bounds = np.concatenate([spatial_index.bounds, blocks['bounds']])
+        self.centers = np.column_stack([
+            (self.bounds[:, 0] + self.bounds[:, 2]) / 2,
+            (self.bounds[:, 1] + self.bounds[:, 3]) / 2,
+        ])
+        self.lengths = np.concatenate([lengths, blocks['lengths']])
+        self.areas = np.concatenate([areas, blocks['areas']])
+        self.radii = np.concatenate([radii, blocks['radii']])
+        self.type_codes = np.concatenate([g.type_codes, blocks['type_codes']])
+        self.layer_codes = np.concatenate([g.layer_codes, blocks['layer_codes']])
+        # Top-level entity each row belongs to, and the block it was expanded from (-1 for top-level rows).
+        self.row_owner = np.concatenate([np.arange(n), blocks['owner']])
+        self.row_block = np.concatenate([np.full(n, -1), blocks['block']])
+        self.type_names = np.array([name.upper() for name in g.type_names])
+        self.layer_keys = np.array([name.lower() for name in g.layer_names])
+
+    def _expand_blocks(self):
+        """Measures every block entity once per block instance, through the instance's matrix.
+
+        Areas scale with the determinant of the matrix; line and polyline lengths are exact from
+        their transformed segments.
+        """
+        g = self.geometry
+        entity_starts = np.searchsorted(g.block_entity_block, np.arange(len(g.block_names) + 1))
+        block = g.instance_block
+        counts = entity_starts[block + 1] - entity_starts[block]
+        row_starts = np.cumsum(counts) - counts
+        instance = np.repeat(np.arange(len(block)), counts)
+        entity = np.repeat(entity_starts[block] - row_starts, counts) + np.arange(counts.sum())
+        linear = g.instance_matrix[:, :2, :2]
+        det = np.abs(linear[:, 0, 0] * linear[:, 1, 1] - linear[:, 0, 1] * linear[:, 1, 0])[instance]
+
+        lengths = g.block_entity_length[entity] * np.sqrt(det)
+        segmented = np.zeros(len(g.block_entity_block), dtype=bool)
+        segmented[g.block_segment_entity] = True
+        lengths[segmented[entity]] = 0.0
+        segment_starts = np.searchsorted(g.block_entity_block[g.block_segment_entity], np.arange(len(g.block_names) + 1))
+        for b in np.unique(block[counts > 0]).tolist():
+            segments = slice(segment_starts[b], segment_starts[b + 1])
+            if segments.start == segments.stop:
+                continue
+            vectors = g.block_segment_vector[segments]
+            local_rows = g.block_segment_entity[segments] - entity_starts[b]
+            instances = np.flatnonzero(block == b)
+            batch = max(1, BLOCK_TRANSFORM_BATCH // len(vectors))
+            for k in range(0, len(instances), batch):
+                chunk = instances[k:k + batch]
+                seg_lengths = np.linalg.norm(np.matmul(vectors, linear[chunk].transpose(0, 2, 1)), axis=2)
+                np.add.at(lengths, (row_starts[chunk, None] + local_rows).ravel(), seg_lengths.ravel())
+
+        local = g.block_entity_bounds[entity]
+        matrices = g.instance_matrix[instance]
+        corners = np.stack([local[:, [0, 1]], local[:, [2, 1]], local[:, [0, 3]], local[:, [2, 3]]], axis=1)
+        world = np.matmul(corners, matrices[:, :2, :2].transpose(0, 2, 1)) + matrices[:, None, :2, 3]
+        layers = g.block_entity_layer[entity]
+        # Entities on layer 0 inside a block take the layer of the insert placing it.
+        layers = np.where(layers < 0, g.layer_codes[g.instance_owner[instance]], layers)
+        return {
+            'bounds': np.hstack([world.min(axis=1), world.max(axis=1)]),
+            'lengths': lengths,
+            'areas': g.block_entity_area[entity] * det,
+            'radii': g.block_entity_radius[entity] * np.sqrt(det),
+            'type_codes': g.block_entity_type[entity],
+            'layer_codes': layers,
+            'owner': g.instance_owner[instance],
+            'block': block[instance],
+        }
+
+    def select(self, entity_type=None, layer=None, region=None, bbox=None, min_radius=None, max_radius=None):
+        """Returns the sorted rows (entities, then expanded block entities) matching all given filters."""
+        mask = np.ones(len(self.type_codes), dtype=bool)
+        if entity_type:
+            mask &= self.type_names[self.type_codes] == entity_type.upper()
+        if layer:
+            mask &= self.layer_keys[self.layer_codes] == layer.lower()
+        if region:
+            if region not in DRAWING_REGIONS:
+                raise ValueError(f"Unknown region '{region}', expected one of {list(DRAWING_REGIONS)}")
+            if self.spatial_index.extent is None:
+                return np.empty(0, dtype=np.int64)
+            origin, size = self.spatial_index.extent[0], self.spatial_index.extent[1] - self.spatial_index.extent[0]
+            fractions = DRAWING_REGIONS[region]
+            bbox = [*(origin + size * fractions[:2]), *(origin + size * fractions[2:])]
+        if bbox:
+            min_x, min_y, max_x, max_y = bbox
+            # Expanded block entities are only tested by their centers.
+            candidates = np.zeros(len(mask), dtype=bool)
+            candidates[self.entity_count:] = True
+            candidates[self.spatial_index.query(min_x, min_y, max_x, max_y)] = True
+            cx, cy = self.centers[:, 0], self.centers[:, 1]
+            mask &= candidates & (cx >= min_x) & (cx <= max_x) & (cy >= min_y) & (cy <= max_y)
+        if min_radius is not None:
+            mask &= self.radii >= min_radius - 1e-9 * max(1.0, abs(min_radius))
+        if max_radius is not None:
+            mask &= self.radii <= max_radius + 1e-9 * max(1.0, abs(max_radius))
+        return np.flatnonzero(mask)
+
+    def _breakdown(self, names, codes, limit=20):
+        counts = np.bincount(codes, minlength=len(names))
+        order = np.argsort(-counts, kind='stable')[:limit]
+        return {names[c]: int(counts[c]) for c in order if counts[c]}
+
+    def count_entities(self, **filters):
+        ids = self.select(**filters)
+        return {
+            'count': len(ids),
+            'by_type': self._breakdown(self.geometry.type_names, self.type_codes[ids]),
+            'by_layer': self._breakdown(self.geometry.layer_names, self.layer_codes[ids]),
+        }
+
+    def total_length(self, **filters):
+        ids = self.select(**filters)
+        lengths = self.lengths[ids]
+        measured = ~np.isnan(lengths)
+        return {'total_length': round(float(lengths[measured].sum()), 6), 'measured_entities': int(measured.sum()),
+                'skipped_entities': int((~measured).sum())}
+
+    def total_area(self, **filters):
+        ids = self.select(**filters)
+        areas = self.areas[ids]
+        measured = ~np.isnan(areas)
+        return {'total_area': round(float(areas[measured].sum()), 6), 'measured_entities': int(measured.sum()),
+                'skipped_entities': int((~measured).sum())}
+
+    def radius_histogram(self, bins=10, **filters):
+        radii = self.radii[self.select(**filters)]
+        radii = radii[~np.isnan(radii)]
+        values, counts = np.unique(np.round(radii, 6), return_counts=True)
+        if len(values) <= bins:
+            return {'count': len(radii), 'radii': [{'radius': float(v), 'count': int(c)} for v, c in zip(values, counts)]}
+        counts, edges = np.histogram(radii, bins=bins)
+        return {'count': len(radii), 'bins': [
+            {'min_radius': round(float(lo), 6), 'max_radius': round(float(hi), 6), 'count': int(c)}
+            for lo, hi, c in zip(edges[:-1], edges[1:], counts)
+        ]}
+
+    def distances(self, x, y):
+        """Returns the 2D distance from (x, y) to every row; bounding boxes stand in for faces and block entities."""
+        g = self.geometry
+        b = self.bounds
+        dx = np.maximum(np.maximum(b[:, 0] - x, x - b[:, 2]), 0)
+        dy = np.maximum(np.maximum(b[:, 1] - y, y - b[:, 3]), 0)
+        result = np.hypot(dx, dy)
+        if len(g.line_index):
+            result[g.line_index] = _point_segment_distance(x, y, g.line_start[:, :2], g.line_end[:, :2])
+        if len(g.circle_index):
+            result[g.circle_index] = np.abs(np.hypot(g.circle_center[:, 0] - x, g.circle_center[:, 1] - y) - g.circle_radius)
+        if len(g.arc_index):
+            c, r = g.arc_center[:, :2], g.arc_radius
+            angle = np.arctan2(y - c[:, 1], x - c[:, 0])
+            start = np.deg2rad(g.arc_start_angle)
+            on_sweep = (angle - start) % (2 * np.pi) <= self.arc_sweeps
+            end = start + self.arc_sweeps
+            to_ends = np.minimum(
+                np.hypot(c[:, 0] + r * np.cos(start) - x, c[:, 1] + r * np.sin(start) - y),
+                np.hypot(c[:, 0] + r * np.cos(end) - x, c[:, 1] + r * np.sin(end) - y),
+            )
+            result[g.arc_index] = np.where(on_sweep, np.abs(np.hypot(c[:, 0] - x, c[:, 1] - y) - r), to_ends)
+        if len(g.poly_index):
+            rows, seg_start, seg_end = polyline_segments(g)
+            nearest = np.full(len(g.poly_index), np.inf)
+            np.minimum.at(nearest, rows, _point_segment_distance(x, y, seg_start, seg_end))
+            single = np.diff(g.poly_offsets) == 1
+            nearest[single] = np.hypot(*(g.poly_vertices[g.poly_offsets[:-1][single], :2] - [x, y]).T)
+            result[g.poly_index] = np.where(np.isinf(nearest), np.nan, nearest)
+        if len(g.text_index):
+            result[g.text_index] = np.hypot(g.text_insert[:, 0] - x, g.text_insert[:, 1] - y)
+        if len(g.insert_index):
+            result[g.insert_index] = np.hypot(g.insert_point[:, 0] - x, g.insert_point[:, 1] - y)
+        return result
+
+    def nearest_entities(self, x, y, k=1, **filters):
+        ids = self.select(**filters)
+        distances = self.distances(x, y)[ids]
+        valid = ~np.isnan(distances)
+        ids, distances = ids[valid], distances[valid]
+        k = max(1, min(int(k), 20, len(ids)))
+        if not len(ids):
+            return {'entities': []}
+        order = np.argsort(distances, kind='stable')[:k]
+        entities = []
+        for i, d in zip(ids[order], distances[order]):
+            entity = {
+                'entity': int(self.row_owner[i]) + 1,
+                'type': self.geometry.type_names[self.type_codes[i]],
+                'layer': self.geometry.layer_names[self.layer_codes[i]],
+                'distance': round(float(d), 6),
+                'center': [round(float(v), 6) for v in self.centers[i]],
+            }
+            if self.row_block[i] >= 0:
+                entity['block'] = self.geometry.block_names[self.row_block[i]]
+            entities.append(entity)
+        return {'entities': entities}
+
+    def run_tool(self, name, arguments):
+        """Runs a tool call of GEOMETRY_TOOLS and returns its JSON result; errors are reported to the model."""
+        try:
+            if name not in self.TOOLS:
+                raise ValueError(f"Unknown tool '{name}'")
+            kwargs = json.loads(arguments) if arguments else {}
+            if not isinstance(kwargs, dict):
+                raise ValueError("Tool arguments must be a JSON object")
+            return json.dumps(getattr(self, name)(**kwargs))
+        except Exception as e:
+            return json.dumps({'error': str(e)})
+
+# --- SVG Path Flattening ---
+
+SVG_PATH_COMMANDS = "MmZzLlHhVvCcSsQqTtAa"
+SVG_IS_PATH_COMMAND = np.zeros(256, dtype=bool)
+SVG_IS_PATH_COMMAND[np.frombuffer(SVG_PATH_COMMANDS.encode("ascii"), dtype=np.uint8)] = True
+# Arc flags are single digits that need no separator, as in "a5 5 0 0110 0".
+_SVG_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+# Compact number lists ("10-5.2", "1.5.5", "1,2") split into their numbers.
+SVG_NUMBER_RE = re.compile(_SVG_NUMBER)
+SVG_PATH_TOKEN_RE = re.compile(f"inf|{_SVG_NUMBER}")
+SVG_ARC_RUN_RE = re.compile(r"[Aa][^MmZzLlHhVvCcSsQqTtAa]*")
+SVG_ARC_ARGS_RE = re.compile(r"\s*,?\s*".join([f"({_SVG_NUMBER})"] * 3 + ["([01])"] * 2 + [f"({_SVG_NUMBER})"] * 2))
+SVG_PARAMETER_COUNTS = np.zeros(128, dtype=np.int64)
+for _command, _count in zip("MZLHVCSQTA", (2, 0, 2, 1, 1, 6, 4, 4, 2, 7)):
+    SVG_PARAMETER_COUNTS[ord(_command)] = SVG_PARAMETER_COUNTS[ord(_command.lower())] = _count
+# Maximum distance between a curve and the chords replacing it, in SVG user units.
+SVG_CURVE_TOLERANCE = 0.1
+SVG_MAX_CURVE_STEPS = 256
+
+def _separate_svg_numbers(text):
+    """Rewrites compact SVG number lists ("10-5.2", "1.5.5", "1,2") as space-separated numbers."""
+    text = text.replace(",", " ").replace("-", " -").replace("+", " +")
+    if "e" in text or "E" in text:
+        text = re.sub(r"([eE]) ([-+])", r"\1\2", text)
+    if re.search(r"\.\d*\.", text):
+        text = re.sub(r"(\.\d*)(?=\.)", r"\1 ", text)
+    return text
+
+def _read_svg_numbers(text, token_re=SVG_NUMBER_RE):
+    """Reads the numbers of SVG text as a float array, skipping characters that are not numbers."""
+    # Splitting is the fast path; token_re only runs on text it cannot read.
+    try:
+        return np.array(_separate_svg_numbers(text).split(), dtype=float)
+    except ValueError:
+        return np.array(token_re.findall(text), dtype=float)
+
+def parse_svg_numbers(text):
+    """Returns the numbers of an SVG attribute such as polyline points as a float array."""
+    return _read_svg_numbers(text)
+
+def _tokenize_svg_path(d):
+    """Splits path data into its command letter codes and one float array of all their parameters.
+
+    Every command letter becomes an inf marker in the array, so the numbers of the whole
+    path are read at once (see _read_svg_numbers()); other characters are skipped.
+    """
+    if "a" in d or "A" in d:
+        d = SVG_ARC_RUN_RE.sub(lambda m: m.group()[0] + " " + " ".join(
+            " ".join(args) for args in SVG_ARC_ARGS_RE.findall(m.group()[1:])
+        ), d)
+    raw = np.frombuffer(d.encode("utf-8"), dtype=np.uint8)
+    codes = raw[SVG_IS_PATH_COMMAND[raw]].astype(np.int64)
+    text = d
+    for command in SVG_PATH_COMMANDS:
+        if command in text:
+            text = text.replace(command, " inf ")
+    return codes, _read_svg_numbers(text, SVG_PATH_TOKEN_RE)
+
+def _resolve_chain(parent, offset):
+    """Resolves values defined as value[parent] + offset, roots being their own parent.
+
+    Pointer jumping takes O(log n) vectorized passes over chains of relative coordinates.
+    """
+    index = np.arange(len(parent))
+    value = offset.copy()
+    done = parent == index
+    while not done.all():
+        value = np.where(done, value, value + value[parent])
+        parent = np.where(done, parent, np.where(done[parent], index, parent[parent]))
+        done = parent == index
+    return value
+
+def _bezier_steps(p0, p1, p2, p3, tolerance):
+    """Number of chords keeping each cubic within tolerance of its flattening (Wang's formula)."""
+    dd = np.maximum(np.linalg.norm(p0 - 2 * p1 + p2, axis=1), np.linalg.norm(p1 - 2 * p2 + p3, axis=1))
+    return np.clip(np.ceil(np.sqrt(0.75 * dd / tolerance)), 1, SVG_MAX_CURVE_STEPS).astype(np.int64)
+
+def _curve_parameters(steps):
+    """Returns the owning curve and parameter t in (0, 1] of every flattened point."""
+    owner = np.repeat(np.arange(len(steps)), steps)
+    j = np.arange(len(owner)) - np.repeat(np.cumsum(steps) - steps, steps) + 1
+    return owner, j / steps[owner]
+
+def flatten_cubics(p0, p1, p2, p3, tolerance):
+    """Flattens (k, 2) cubic Béziers at once; returns the owning curve and points, start points excluded."""
+    owner, t = _curve_parameters(_bezier_steps(p0, p1, p2, p3, tolerance))
+    t, mt = t[:, None], 1 - t[:, None]
+    points = mt ** 3 * p0[owner] + 3 * mt ** 2 * t * p1[owner] + 3 * mt * t ** 2 * p2[owner] + t ** 3 * p3[owner]
+    return owner, points
+
+def flatten_arcs(p0, p1, radii, rotation, large_arc, sweep, tolerance):
+    """Flattens (k,) SVG elliptical arcs given in endpoint form; returns the owning arc and points.
+
+    Follows the endpoint-to-center conversion of the SVG specification (appendix F.6),
+    including the scaling up of radii too small to reach the end point.
+    """
+    phi = np.deg2rad(rotation)
+    cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+    half = (p0 - p1) / 2
+    x1 = cos_phi * half[:, 0] + sin_phi * half[:, 1]
+    y1 = -sin_phi * half[:, 0] + cos_phi * half[:, 1]
+    rx, ry = np.abs(radii[:, 0]), np.abs(radii[:, 1])
+    scale = np.sqrt(np.maximum(x1 ** 2 / rx ** 2 + y1 ** 2 / ry ** 2, 1))
+    rx, ry = rx * scale, ry * scale
+    numerator = rx ** 2 * ry ** 2 - rx ** 2 * y1 ** 2 - ry ** 2 * x1 ** 2
+    denominator = rx ** 2 * y1 ** 2 + ry ** 2 * x1 ** 2
+    coef = np.sqrt(np.maximum(numerator / np.where(denominator > 0, denominator, 1), 0))
+    coef = np.where(large_arc == sweep, -coef, coef)
+    cx1, cy1 = coef * rx * y1 / ry, -coef * ry * x1 / rx
+    mid = (p0 + p1) / 2
+    cx = cos_phi * cx1 - sin_phi * cy1 + mid[:, 0]
+    cy = sin_phi * cx1 + cos_phi * cy1 + mid[:, 1]
+    theta1 = np.arctan2((y1 - cy1) / ry, (x1 - cx1) / rx)
+    theta2 = np.arctan2((-y1 - cy1) / ry, (-x1 - cx1) / rx)
+    delta = (theta2 - theta1) % (2 * np.pi)
+    delta = np.where((sweep == 0) & (delta > 0), delta - 2 * np.pi, delta)
+
+    max_step = 2 * np.arccos(np.clip(1 - tolerance / np.maximum(rx, ry), -1, 1))
+    steps = np.clip(np.ceil(np.abs(delta) / np.maximum(max_step, 1e-9)), 1, SVG_MAX_CURVE_STEPS).astype(np.int64)
+    owner, t = _curve_parameters(steps)
+    theta = theta1[owner] + delta[owner] * t
+    cos_t, sin_t = rx[owner] * np.cos(theta), ry[owner] * np.sin(theta)
+    points = np.column_stack([
+        cx[owner] + cos_phi[owner] * cos_t - sin_phi[owner] * sin_t,
+        cy[owner] + sin_phi[owner] * cos_t + cos_phi[owner] * sin_t,
+    ])
+    # The last point of each arc is its exact end point.
+    points[np.cumsum(steps) - 1] = p1
+    return owner, points
+
+def parse_svg_path(d, tolerance=SVG_CURVE_TOLERANCE):
+    """Parses SVG path data into a list of (points, closed) subpaths with curves flattened.
+
+    The whole path is handled in NumPy: parameters are parsed at once, relative coordinates
+    and closepath returns are resolved with _resolve_chain(), and the Bézier and arc
+    segments are flattened in batches. Only smooth quadratic (T) control points, which each
+    depend on the previous one, are computed one by one.
+    """
+    codes, values = _tokenize_svg_path(d)
+    if not len(codes):
+        return []
+    markers = np.flatnonzero(np.isinf(values))
+    counts = SVG_PARAMETER_COUNTS[codes]
+    available = np.diff(np.append(markers, len(values))) - 1
+    repeats = np.where(counts > 0, available // np.maximum(counts, 1), 1)
+
+    # Segment 0 is a virtual moveto at the origin, where a path not starting with M begins.
+    command_of = np.repeat(np.arange(len(codes)), repeats)
+    first = np.concatenate([[True], np.diff(command_of) > 0]) if len(command_of) else np.empty(0, dtype=bool)
+    seg_code = np.concatenate([[ord('M')], codes[command_of]])
+    upper = seg_code & ~0x20
+    relative = seg_code >= ord('a')
+    is_move = np.concatenate([[True], (upper[1:] == ord('M')) & first])
+    is_close = upper == ord('Z')
+    # Parameters past the first pair of a moveto are implicit lineto commands.
+    upper = np.where((upper == ord('M')) & ~is_move, ord('L'), upper)
+
+    param_start = np.concatenate([[0], markers[command_of] + 1 + (
+        np.arange(len(command_of)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    ) * counts[command_of]])
+    padded = np.append(values, np.zeros(7))
+    params = padded[np.minimum(param_start[:, None] + np.arange(7), len(padded) - 1)]
+    params[0] = 0
+
+    n = len(seg_code)
+    index = np.arange(n)
+    end_columns = np.full((n, 2), -1)
+    end_columns[np.isin(upper, [ord('M'), ord('L'), ord('T')])] = [0, 1]
+    end_columns[upper == ord('H'), 0] = 0
+    end_columns[upper == ord('V'), 1] = 0
+    end_columns[upper == ord('C')] = [4, 5]
+    end_columns[np.isin(upper, [ord('S'), ord('Q')])] = [2, 3]
+    end_columns[upper == ord('A')] = [5, 6]
+    last_move = np.maximum.accumulate(np.where(is_move, index, 0))
+    ends = np.empty((n, 2))
+    for axis in (0, 1):
+        given = end_columns[:, axis] >= 0
+        value = np.where(given, params[index, np.maximum(end_columns[:, axis], 0)], 0.0)
+        absolute = given & ~relative
+        absolute[0] = True
+        parent = np.where(absolute, index, np.maximum(index - 1, 0))
+        # Closepath returns to the start of the subpath.
+        parent = np.where(is_close, last_move, parent)
+        ends[:, axis] = _resolve_chain(parent, np.where(is_close, 0.0, value))
+    starts = np.vstack([ends[:1], ends[:-1]])
+    base = np.where(relative[:, None], starts, 0.0)
+
+    # Segments produce their points in blocks by kind; a stable sort by segment restores path order.
+    kinds = [(ord('C'), ord('S'), ord('Q'), ord('T')), (ord('A'),), (ord('L'), ord('H'), ord('V'))]
+    cubic_ids = np.flatnonzero(np.isin(upper, kinds[0]))
+    arc_ids = np.flatnonzero(np.isin(upper, kinds[1]))
+    line_ids = np.flatnonzero(np.isin(upper, kinds[2]))
+    next_draws = np.append(~is_move[1:] & ~is_close[1:], False)
+    # A drawing command right after closepath starts a new subpath at the closed one's start.
+    point_ids = np.flatnonzero(is_move | (is_close & next_draws))
+    blocks = [(point_ids, ends[point_ids]), (line_ids, ends[line_ids])]
+
+    if len(cubic_ids):
+        c2_all = np.full((n, 2), np.nan)
+        c1 = params[cubic_ids, 0:2] + base[cubic_ids]
+        c2 = params[cubic_ids, 2:4] + base[cubic_ids]
+        kind = upper[cubic_ids]
+        c2_all[cubic_ids] = np.where((kind == ord('C'))[:, None], c2, c1)
+        s0, s3 = starts[cubic_ids], ends[cubic_ids]
+        smooth = kind == ord('S')
+        previous = cubic_ids - 1
+        reflects = smooth & np.isin(upper[previous], [ord('C'), ord('S')])
+        cubic_c1 = np.where((kind == ord('C'))[:, None], c1, s0)
+        cubic_c1 = np.where(reflects[:, None], 2 * s0 - c2_all[previous], cubic_c1)
+        cubic_c2 = np.where(smooth[:, None], c1, c2)
+        quadratic = (kind == ord('Q')) | (kind == ord('T'))
+        q = c1.copy()
+        for row in np.flatnonzero(kind == ord('T')):
+            i = cubic_ids[row]
+            prior = np.searchsorted(cubic_ids, i - 1)
+            chained = prior < row and cubic_ids[prior] == i - 1 and quadratic[prior]
+            q[row] = 2 * s0[row] - q[prior] if chained else s0[row]
+        cubic_c1 = np.where(quadratic[:, None], s0 + 2 / 3 * (q - s0), cubic_c1)
+        cubic_c2 = np.where(quadratic[:, None], s3 + 2 / 3 * (q - s3), cubic_c2)
+        owner, curve_points = flatten_cubics(s0, cubic_c1, cubic_c2, s3, tolerance)
+        blocks.append((cubic_ids[owner], curve_points))
+    if len(arc_ids):
+        s0, s3 = starts[arc_ids], ends[arc_ids]
+        radii, rotation = params[arc_ids, 0:2], params[arc_ids, 2]
+        # Arcs with a zero radius or no length are straight lines, as the specification says.
+        straight = (radii[:, 0] == 0) | (radii[:, 1] == 0) | np.all(s0 == s3, axis=1)
+        blocks.append((arc_ids[straight], s3[straight]))
+        curved = ~straight
+        if curved.any():
+            owner, curve_points = flatten_arcs(s0[curved], s3[curved], radii[curved], rotation[curved],
+                                               params[arc_ids[curved], 3], params[arc_ids[curved], 4], tolerance)
+            blocks.append((arc_ids[curved][owner], curve_points))
+
+    owners = np.concatenate([ids for ids, _ in blocks])
+    points = np.concatenate([pts for _, pts in blocks])[np.argsort(owners, kind='stable')]
+    per_segment = np.bincount(owners, minlength=n)
+    offsets = np.cumsum(per_segment) - per_segment
+
+    starts_subpath = np.zeros(n, dtype=bool)
+    starts_subpath[point_ids] = True
+    subpath_of = np.cumsum(starts_subpath) - 1
+    closed = np.zeros(subpath_of[-1] + 1, dtype=bool)
+    # Closepath closes the subpath of the segment before it.
+    close_ids = np.flatnonzero(is_close)
+    closed[subpath_of[np.maximum(close_ids - 1, 0)]] = True
+
+    first_points = offsets[point_ids]
+    last_points = np.append(first_points[1:], len(points))
+    is_closed = closed[subpath_of[point_ids]]
+    # A closed subpath that returns to its start explicitly does not repeat the vertex.
+    repeated = is_closed & (last_points - first_points > 1) & np.all(
+        np.abs(points[first_points] - points[np.maximum(last_points - 1, 0)]) <= 1e-9, axis=1)
+    last_points = last_points - repeated
+    return [
+        (points[a:b], bool(c))
+        for a, b, c in zip(first_points.tolist(), last_points.tolist(), is_closed)
+        if b - a > 1
+    ]
+
+# --- Polyline Simplification ---
+
+def simplify_polylines(points, offsets, tolerance, closed=None):
+    """Douglas-Peucker simplification of many polylines at once; returns a keep mask over points.
+
+    points is an (n, 2) array holding the polylines back to back, polyline i being
+    points[offsets[i]:offsets[i + 1]]. Every pass splits all open ranges whose farthest
+    interior point lies beyond tolerance, so the work per pass is one vectorized sweep.
+    Closed polylines (not repeating their first vertex) are first split at the vertex
+    farthest from their start.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    valid = ends >= starts
+    starts, ends = starts[valid], ends[valid]
+    keep[starts] = keep[ends] = True
+    if closed is not None:
+        loops = closed[valid] & (ends - starts >= 2)
+        if loops.any():
+            loop_starts, loop_ends = starts[loops], ends[loops]
+            counts = loop_ends - loop_starts + 1
+            first = np.cumsum(counts) - counts
+            index = np.repeat(loop_starts - first, counts) + np.arange(counts.sum())
+            distance = np.hypot(*(points[index] - points[np.repeat(loop_starts, counts)]).T)
+            far, _ = _reduceat_argmax(distance, index, first)
+            keep[far] = True
+            starts = np.concatenate([starts[~loops], loop_starts, far])
+            ends = np.concatenate([ends[~loops], far, loop_ends])
+
+    while len(starts):
+        interior = ends - starts - 1
+        active = interior > 0
+        starts, ends, interior = starts[active], ends[active], interior[active]
+        if not len(starts):
+            break
+        first = np.cumsum(interior) - interior
+        owner = np.repeat(np.arange(len(starts)), interior)
+        index = np.repeat(starts + 1 - first, interior) + np.arange(interior.sum())
+        # Distances to the chord segment, not its line, so hairpins cannot hide behind an end.
+        distance = _point_segment_distance(points[index, 0], points[index, 1], points[starts[owner]], points[ends[owner]])
+        split, maxima = _reduceat_argmax(distance, index, first)
+        far = maxima > tolerance
+        split = split[far]
+        keep[split] = True
+        starts = np.concatenate([starts[far], split])
+        ends = np.concatenate([split, ends[far]])
+    return keep
+
+def _reduceat_argmax(values, index, first):
+    """Returns the index of the first maximum within each run of values, and the maxima."""
+    maxima = np.maximum.reduceat(values, first)
+    counts = np.diff(np.append(first, len(values)))
+    candidates = np.where(values == np.repeat(maxima, counts), index, np.iinfo(np.int64).max)
+    return np.minimum.reduceat(candidates, first), maxima
+
+# Default simplification tolerance of exported polylines, in drawing units (pixels for traced images).
+SIMPLIFY_TOLERANCE = 0.5
+# Share of a simplification tolerance spent on dropping vertices; the rest covers rounding coordinates.
+SIMPLIFY_VERTEX_SHARE = 0.9
+
+def simplify_polyline_list(polylines, tolerance):
+    """Simplifies a list of (points, closed) polylines together; returns the simplified list and vertex counts.
+
+    Vertices are dropped with simplify_polylines() within SIMPLIFY_VERTEX_SHARE of tolerance and
+    coordinates rounded to the fewest decimals whose rounding error fits the remaining share, so
+    every vertex stays within tolerance of the original polyline and prints short in the DXF.
+    Repeated vertices are merged, keeping polyline ends, and closed polylines collapsing below
+    tolerance are dropped. Returns (polylines, vertices before, vertices after).
+    """
+    if not polylines:
+        return [], 0, 0
+    counts = np.array([len(points) for points, _ in polylines])
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    points = np.concatenate([points for points, _ in polylines]).astype(float)
+    closed = np.array([closed for _, closed in polylines], dtype=bool)
+
+    keep = simplify_polylines(points, offsets, SIMPLIFY_VERTEX_SHARE * tolerance, closed)
+    # Rounding to d decimals moves a vertex at most 0.5 * 10**-d along each axis.
+    decimals = max(0, int(np.ceil(-np.log10((1 - SIMPLIFY_VERTEX_SHARE) * tolerance / np.sqrt(0.5)))))
+    points = np.round(points, decimals)
+    owner = np.repeat(np.arange(len(polylines)), counts)
+    # A kept vertex repeating the previous kept one is merged into it; the later one is dropped
+    # unless it ends its polyline, so that the end stays where it is.
+    kept_index = np.flatnonzero(keep)
+    repeated = ((points[kept_index[1:]] == points[kept_index[:-1]]).all(axis=1)
+                & (owner[kept_index[1:]] == owner[kept_index[:-1]]))
+    last = np.zeros(len(points), dtype=bool)
+    last[offsets[1:] - 1] = True
+    keep[np.where(last[kept_index[1:]], kept_index[:-1], kept_index[1:])[repeated]] = False
+
+    kept = np.bincount(owner[keep], minlength=len(polylines))
+    extent = np.zeros(len(polylines))
+    np.maximum.at(extent, owner, np.hypot(*(points - points[offsets[:-1]][owner]).T))
+    survives = (kept >= 2) & ~(closed & (extent <= tolerance))
+    starts = np.concatenate([[0], np.cumsum(kept)])
+    kept_points = points[keep]
+    result = [(kept_points[starts[i]:starts[i + 1]], bool(closed[i])) for i in np.flatnonzero(survives)]
+    return result, int(counts.sum()), int(kept[survives].sum())
+
+# --- Local Vectorizer ---
+
+# Parameters of the vectorization, as sent to the remote Space; the local engine honors the
+# color, layering, mode, speckle, corner, length and precision settings.
+VECTORIZER_DEFAULTS = {
+    'colormode': "color", 'hierarchical': "stacked", 'mode': "spline",
+    'filter_speckle': 4, 'color_precision': 6, 'layer_difference': 16,
+    'corner_threshold': 60, 'length_threshold': 4, 'max_iterations': 10,
+    'splice_threshold': 45, 'path_precision': 3,
+}
+# Staircase pixel outlines are simplified to within this distance, in pixels.
+LOCAL_VECTORIZER_TOLERANCE = 1.0
+LOCAL_VECTORIZER_MAX_COLORS = 64
+
+def otsu_threshold(gray):
+    """Returns the Otsu threshold of an 8-bit grayscale array."""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(float)
+    weight = np.cumsum(histogram)
+    mean = np.cumsum(histogram * np.arange(256))
+    total_weight, total_mean = weight[-1], mean[-1]
+    background, foreground = weight, total_weight - weight
+    valid = (background > 0) & (foreground > 0)
+    between = np.zeros(256)
+    between[valid] = (total_mean * background[valid] - mean[valid] * total_weight) ** 2 / (background[valid] * foreground[valid])
+    return int(np.argmax(between))
+
+def quantize_colors(rgb, opaque, color_precision, layer_difference):
+    """Clusters the pixel colors; returns a label image (-1 where transparent) and the palette.
+
+    Channels keep color_precision significant bits, and colors closer than layer_difference
+    in every channel are merged into the more frequent one.
+    """
+    shift = 8 - int(np.clip(color_precision, 1, 8))
+    reduced = (rgb >> shift).astype(np.int64)
+    keys = (reduced[..., 0] << 16) | (reduced[..., 1] << 8) | reduced[..., 2]
+    colors, inverse, counts = np.unique(keys[opaque], return_inverse=True, return_counts=True)
+    values = np.column_stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255]) << shift
+    values += (1 << shift) >> 1
+    order = np.argsort(-counts, kind='stable')
+    palette, assignment = [], np.empty(len(colors), dtype=np.int64)
+    for color in order:
+        if palette:
+            distance = np.abs(np.array(palette) - values[color]).max(axis=1)
+            nearest = int(np.argmin(distance))
+            if distance[nearest] <= layer_difference or len(palette) == LOCAL_VECTORIZER_MAX_COLORS:
+                assignment[color] = nearest
+                continue
+        assignment[color] = len(palette)
+        palette.append(values[color])
+    labels = np.full(rgb.shape[:2], -1, dtype=np.int64)
+    labels[opaque] = assignment[inverse.ravel()]
+    return labels, np.array(palette, dtype=np.int64).reshape(-1, 3)
+
+def trace_mask_outlines(mask):
+    """Traces the pixel-edge outlines of a boolean mask into closed corner polygons.
+
+    Returns (points, offsets) with one loop per outline, inside on the left in image
+    coordinates, so holes run opposite to their outer boundary. Edges are linked by looking
+    up the outgoing edges of each end corner, and the loops ordered by pointer jumping.
+    """
+    padded = np.pad(mask, 1)
+    h, w = padded.shape
+    # Horizontal pixel edges between rows y - 1 and y, vertical ones between columns x - 1 and x.
+    ys, xs = np.nonzero(padded[1:, :] != padded[:-1, :])
+    ys = ys + 1
+    below = padded[ys, xs]
+    h_start = np.column_stack([np.where(below, xs, xs + 1), ys])
+    h_dir = np.where(below, 0, 2)
+    ys2, xs2 = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    xs2 = xs2 + 1
+    right = padded[ys2, xs2]
+    v_start = np.column_stack([xs2, np.where(right, ys2 + 1, ys2)])
+    v_dir = np.where(right, 3, 1)
+    start = np.concatenate([h_start, v_start])
+    direction = np.concatenate([h_dir, v_dir])
+    if not len(start):
+        return np.empty((0, 2)), np.zeros(1, dtype=np.int64)
+    step = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+    end = start + step[direction]
+
+    # Each edge continues with the outgoing edge at its end corner, turning left first.
+    keys = (start[:, 1] * (w + 1) + start[:, 0]) * 4 + direction
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    corner = (end[:, 1] * (w + 1) + end[:, 0]) * 4
+    successor = np.full(len(start), -1)
+    for turn in (1, 0, 3):
+        wanted = corner + (direction + turn) % 4
+        position = np.minimum(np.searchsorted(sorted_keys, wanted), len(sorted_keys) - 1)
+        found = (sorted_keys[position] == wanted) & (successor < 0)
+        successor[found] = order[position[found]]
+
+    # Label every loop by its smallest edge index, then rank edges by their distance to it.
+    n = len(successor)
+    label = np.arange(n)
+    pointer = successor.copy()
+    for _ in range(int(np.ceil(np.log2(n))) + 1):
+        label = np.minimum(label, label[pointer])
+        pointer = pointer[pointer]
+    last = successor == label
+    remaining = np.where(last, 0, 1)
+    pointer = np.where(last, np.arange(n), successor)
+    for _ in range(int(np.ceil(np.log2(n))) + 1):
+        remaining = remaining + remaining[pointer]
+        pointer = pointer[pointer]
+    order = np.lexsort((-remaining, label))
+    label, direction, start = label[order], direction[order], start[order]
+
+    # Keep only the corners, where the direction changes.
+    loop_start = np.concatenate([[True], label[1:] != label[:-1]])
+    loop_end = np.append(loop_start[1:], True)
+    previous = np.where(loop_start, np.flatnonzero(loop_end)[np.cumsum(loop_start) - 1], np.arange(n) - 1)
+    corner = direction != direction[previous]
+    points = start[corner] - 1.0
+    counts = np.bincount(np.cumsum(loop_start)[corner] - 1, minlength=int(loop_start.sum()))
+    return points, np.concatenate([[0], np.cumsum(counts)])
+
+def _loop_measures(points, offsets):
+    """Returns the signed shoelace area and perimeter of every closed loop."""
+    counts = np.diff(offsets)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    following = np.arange(len(points)) + 1
+    following[offsets[1:] - 1] = offsets[:-1]
+    nxt = points[following]
+    cross = points[:, 0] * nxt[:, 1] - nxt[:, 0] * points[:, 1]
+    area = np.bincount(owner, weights=cross, minlength=len(counts)) / 2
+    perimeter = np.bincount(owner, weights=np.hypot(*(nxt - points).T), minlength=len(counts))
+    return area, perimeter
+
+def _svg_loop_data(points, offsets, mode, corner_threshold, precision):
+    """Formats closed loops as SVG path data, with smooth cubic segments in spline mode."""
+    fmt = f"{{:.{precision}f}}".format
+    commands = []
+    for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        loop = points[a:b]
+        if mode != "spline" or len(loop) < 3:
+            coords = " ".join(f"{fmt(x)},{fmt(y)}" for x, y in loop)
+            commands.append(f"M{coords}Z")
+            continue
+        prev, nxt = np.roll(loop, 1, axis=0), np.roll(loop, -1, axis=0)
+        incoming, outgoing = loop - prev, nxt - loop
+        cosine = np.einsum('ij,ij->i', incoming, outgoing) / np.maximum(
+            np.hypot(*incoming.T) * np.hypot(*outgoing.T), 1e-12)
+        sharp = np.degrees(np.arccos(np.clip(cosine, -1, 1))) > corner_threshold
+        # Catmull-Rom tangents at smooth vertices; corners keep zero-length handles.
+        tangent = np.where(sharp[:, None], 0.0, (nxt - prev) / 2)
+        c1 = loop + tangent / 3
+        c2 = nxt - np.roll(tangent, -1, axis=0) / 3
+        parts = [f"M{fmt(loop[0, 0])},{fmt(loop[0, 1])}"]
+        for i in range(len(loop)):
+            end = nxt[i]
+            if sharp[i] and sharp[(i + 1) % len(loop)]:
+                parts.append(f"L{fmt(end[0])},{fmt(end[1])}")
+            else:
+                parts.append(f"C{fmt(c1[i, 0])},{fmt(c1[i, 1])} {fmt(c2[i, 0])},{fmt(c2[i, 1])} {fmt(end[0])},{fmt(end[1])}")
+        commands.append("".join(parts) + "Z")
+    return "".join(commands)
+
+def vectorize_image_locally(image_pil, params):
+    """Vectorizes an image into SVG text with NumPy and Pillow only.
+
+    Pixels are thresholded (binary mode) or color-quantized, each color layer is traced
+    into pixel-edge outlines, speckles and short outlines are dropped, and the outlines
+    are simplified (polygon mode) and fitted with cubic curves (spline mode). The
+    max_iterations and splice_threshold parameters only apply to the remote Space.
+    Images without opaque pixels give an empty SVG of the image size.
+    """
+    params = dict(VECTORIZER_DEFAULTS, **params)
+    rgba = np.asarray(image_pil.convert("RGBA"))
+    rgb, opaque = rgba[..., :3], rgba[..., 3] >= 128
+    height, width = opaque.shape
+    if params['colormode'] == "binary":
+        gray = np.asarray(image_pil.convert("L"))
+        labels = np.where(opaque & (gray <= otsu_threshold(gray[opaque] if opaque.any() else gray)), 0, -1)
+        palette = np.zeros((1, 3), dtype=np.int64)
+    else:
+        labels, palette = quantize_colors(rgb, opaque, params['color_precision'], params['layer_difference'])
+    if not opaque.any():
+        return _svg_document(width, height, [])
+
+    # Largest layers are drawn first; stacked layers extend under the ones drawn after them.
+    areas = np.bincount(labels[labels >= 0], minlength=len(palette))
+    draw_order = np.argsort(-areas, kind='stable')
+    rank = np.empty(len(palette), dtype=np.int64)
+    rank[draw_order] = np.arange(len(palette))
+    label_rank = np.where(labels >= 0, rank[np.maximum(labels, 0)], -1)
+    speckle_area = float(params['filter_speckle']) ** 2
+
+    paths = []
+    for position, color in enumerate(draw_order):
+        if params['hierarchical'] == "stacked" and params['colormode'] != "binary":
+            mask = label_rank >= position
+        else:
+            mask = labels == color
+        points, offsets = trace_mask_outlines(mask)
+        if len(offsets) < 2:
+            continue
+        area, perimeter = _loop_measures(points, offsets)
+        keep_loops = (np.abs(area) >= speckle_area) & (perimeter >= params['length_threshold'])
+        if params['mode'] != "none" and len(points):
+            keep = simplify_polylines(points, offsets, LOCAL_VECTORIZER_TOLERANCE, closed=np.ones(len(offsets) - 1, dtype=bool))
+            counts = np.add.reduceat(keep.astype(np.int64), offsets[:-1])
+            points, offsets = points[keep], np.concatenate([[0], np.cumsum(counts)])
+            keep_loops &= counts >= 3
+        if not keep_loops.any():
+            continue
+        counts = np.diff(offsets)
+        points = points[np.repeat(keep_loops, counts)]
+        offsets = np.concatenate([[0], np.cumsum(counts[keep_loops])])
+        d = _svg_loop_data(points, offsets, params['mode'], params['corner_threshold'], int(params['path_precision']))
+        r, g, b = np.clip(palette[color], 0, 255)
+        paths.append(f'<path d="{d}" fill="#{r:02x}{g:02x}{b:02x}" fill-rule="nonzero"/>')
+
+    return _svg_document(width, height, paths)
+
+def _svg_document(width, height, paths):
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}">\n' + "\n".join(paths) + "\n</svg>\n")
+
+# --- Image Preprocessing ---
+
+# Resolution images are reduced to before vectorization; images not recording theirs keep their size.
+PREPROCESS_TARGET_DPI = 100
+# Gray levels a pixel must differ from the border color by to count as content when cropping.
+PREPROCESS_CONTENT_DIFFERENCE = 32
+PREPROCESS_CROP_MARGIN = 8
+# An image is gray when 99% of its pixels have channels this close, and line art when
+# this fraction of its gray levels lies within PREPROCESS_INK_DIFFERENCE of black or white.
+PREPROCESS_GRAY_SPREAD = 24
+PREPROCESS_LINE_ART_FRACTION = 0.9
+PREPROCESS_INK_DIFFERENCE = 48
+# Pixels sampled when classifying an image.
+PREPROCESS_SAMPLE_PIXELS = 1_000_000
+PREPROCESS_COLOR_MODES = {"Auto": 'auto', "Keep color": 'color', "Grayscale": 'grayscale', "Black and white": 'binary'}
+# Color images with at most this many colors are stored with a palette, which resampling keeps.
+PREPROCESS_MAX_PALETTE = 256
+IMAGE_MODE_NAMES = {'1': "black and white", 'L': "grayscale", 'RGB': "color", 'RGBA': "color with alpha", 'P': "palette"}
+
+def encode_png(image, optimize=True):
+    """Encodes an image as PNG bytes; optimize trades encoding time for a smaller file."""
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", optimize=optimize)
+    return buffer.getvalue()
+
+def image_dpi(image):
+    """Returns the horizontal resolution recorded in an image, or None."""
+    dpi = image.info.get('dpi')
+    return float(dpi[0]) if dpi and dpi[0] and dpi[0] > 1 else None
+
+def classify_image_colors(image):
+    """Returns 'binary' for black and white line art, 'grayscale' for other gray images, else 'color'."""
+    rgb = np.asarray(image.convert("RGB"))
+    step = max(1, int(np.sqrt(rgb.shape[0] * rgb.shape[1] / PREPROCESS_SAMPLE_PIXELS)))
+    sample = rgb[::step, ::step].reshape(-1, 3).astype(np.int16)
+    if np.percentile(sample.max(axis=1) - sample.min(axis=1), 99) > PREPROCESS_GRAY_SPREAD:
+        return 'color'
+    gray = sample.mean(axis=1)
+    ink = (gray <= PREPROCESS_INK_DIFFERENCE) | (gray >= 255 - PREPROCESS_INK_DIFFERENCE)
+    return 'binary' if ink.mean() >= PREPROCESS_LINE_ART_FRACTION else 'grayscale'
+
+def preprocess_image(image, target_dpi=PREPROCESS_TARGET_DPI, crop=True, color_mode='auto'):
+    """Prepares an image for vectorization: crops margins, reduces colors and resolution.
+
+    Margins of the border color are cropped off, line art becomes 1-bit black and white and
+    other gray images 8-bit grayscale ('auto'), images recorded above target_dpi are downscaled,
+    and color images with few colors keep exactly those colors in a palette.
+    Images with transparency keep their colors. Returns (image, report) where report records
+    the size, mode, resolution and crop box applied.
+    """
+    dpi = image_dpi(image)
+    report = {'size_before': image.size, 'mode_before': image.mode, 'dpi_before': dpi, 'crop': None}
+    transparent = image.mode in ("RGBA", "LA", "PA") or 'transparency' in image.info
+
+    if crop:
+        gray = np.asarray(image.convert("L"), dtype=np.int16)
+        border = np.concatenate([gray[0], gray[-1], gray[:, 0], gray[:, -1]])
+        content = np.abs(gray - int(np.median(border))) > PREPROCESS_CONTENT_DIFFERENCE
+        if transparent:
+            # Transparent pixels are background; so are all others when the border is transparent.
+            alpha = np.asarray(image.convert("RGBA").getchannel("A")) > 0
+            border_alpha = np.concatenate([alpha[0], alpha[-1], alpha[:, 0], alpha[:, -1]])
+            content = alpha if border_alpha.mean() < 0.5 else content & alpha
+        rows, cols = np.flatnonzero(content.any(axis=1)), np.flatnonzero(content.any(axis=0))
+        if len(rows):
+            box = (max(0, int(cols[0]) - PREPROCESS_CROP_MARGIN), max(0, int(rows[0]) - PREPROCESS_CROP_MARGIN),
+                   min(image.width, int(cols[-1]) + 1 + PREPROCESS_CROP_MARGIN),
+                   min(image.height, int(rows[-1]) + 1 + PREPROCESS_CROP_MARGIN))
+            if box != (0, 0, image.width, image.height):
+                image = image.crop(box)
+                report['crop'] = box
+
+    if color_mode == 'auto':
+        color_mode = 'color' if transparent else classify_image_colors(image)
+    if color_mode in ('grayscale', 'binary'):
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if transparent else "RGB")
+
+    palette = None
+    if color_mode == 'color' and image.mode == "RGB":
+        colors = image.getcolors(PREPROCESS_MAX_PALETTE)
+        if colors:
+            palette = Image.new("P", (1, 1))
+            palette.putpalette([channel for _, color in colors for channel in color])
+
+    scale = target_dpi / dpi if target_dpi and dpi else 1.0
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+        dpi = target_dpi
+
+    if palette is not None:
+        # Resampling blends colors at edges; mapping back to the palette keeps flat layers flat.
+        image = image.quantize(palette=palette, dither=Image.Dither.NONE)
+
+    if color_mode == 'binary':
+        gray = np.asarray(image)
+        image = Image.fromarray(gray > otsu_threshold(gray))
+    if dpi:
+        image.info['dpi'] = (dpi, dpi)
+    report.update(size_after=image.size, mode_after=image.mode, dpi_after=dpi)
+    return image, report
+
+def prepare_image(image, options):
+    """Runs preprocess_image() with the given options; returns the image and a report line with PNG sizes."""
+    bytes_before = len(encode_png(image, optimize=False))
+    prepared, report = preprocess_image(image, **options)
+    return prepared, format_preprocess_report(report, bytes_before, len(encode_png(prepared)))
+
+def format_preprocess_report(report, bytes_before=None, bytes_after=None):
+    """Describes a preprocess_image() report in one line."""
+    def describe(size, mode, dpi):
+        text = f"{size[0]:,}×{size[1]:,} {IMAGE_MODE_NAMES.get(mode, mode)}"
+        return f"{text} at {dpi:g} dpi" if dpi else text
+
+    text = (f"{describe(report['size_before'], report['mode_before'], report['dpi_before'])} → "
+            f"{describe(report['size_after'], report['mode_after'], report['dpi_after'])}")
+    if report['crop']:
+        text += f", cropped to {report['crop'][:2]}–{report['crop'][2:]}"
+    if bytes_before is not None and bytes_after is not None:
+        text += f"; PNG {bytes_before / 1024:,.0f} KB → {bytes_after / 1024:,.0f} KB ({bytes_before / max(bytes_after, 1):.1f}× smaller)"
+    return text
+
+# --- Helper Functions ---
+
+# Uncompressed DXF exports above this size get a hint to use the zip download.
+DXF_ZIP_SUGGEST_BYTES = 20 * 1024 * 1024
+# Number of entities formatted per page of the entity details viewer.
+DETAILS_PAGE_SIZE = 50
+# Geometry smaller than this many pixels on screen is collapsed to a single point.
+LOD_MIN_PIXELS = 1.0
+# Text labels shorter than this many pixels are hidden, and at most MAX_TEXT_LABELS are drawn.
+TEXT_MIN_PIXELS = 4.0
+MAX_TEXT_LABELS = 1000
+
+def get_entity_summary(geometry):
+    """Generates a summary of DXF entities, counting the contents of every block instance."""
+    entity_summary = defaultdict(int)
+    counts = np.bincount(geometry.type_codes, minlength=len(geometry.type_names))
+    if len(geometry.instance_block):
+        # Every block instance adds the entities of its definition, nested INSERT entities included.
+        counts = counts + np.bincount(geometry.instance_block, minlength=len(geometry.block_names)) @ geometry.block_type_counts
+    for name, count in zip(geometry.type_names, counts):
+        if count:
+            entity_summary[name] = int(count)
+    used_layers = np.unique(geometry.layer_codes)
+    layers = {geometry.layer_names[code] for code in used_layers}
+    return entity_summary, layers
+
+def _format_point(p):
+    return f"({p[0]:.2f}, {p[1]:.2f}, {p[2]:.2f})"
+
+def format_entity_detail(geometry, i):
+    """Formats the details block of the entity with index i."""
+    etype = geometry.type_name(i)
+    detail_text = f"\n--- Entity {i+1}: {etype} (Layer: {geometry.layer_name(i)}) ---\n"
+    error = geometry.error_message(i)
+    if error:
+        return detail_text + f"  ({error})\n"
+    row = geometry.rows[i]
+    if row < 0:
+        return detail_text
+
+    if etype == 'LINE':
+        detail_text += f"  Start: {_format_point(geometry.line_start[row])}\n"
+        detail_text += f"  End:   {_format_point(geometry.line_end[row])}\n"
+    elif etype == 'CIRCLE':
+        detail_text += f"  Center: {_format_point(geometry.circle_center[row])}, Radius: {geometry.circle_radius[row]:.2f}\n"
+    elif etype == 'ARC':
+        detail_text += f"  Center: {_format_point(geometry.arc_center[row])}, Radius: {geometry.arc_radius[row]:.2f}, Start Angle: {geometry.arc_start_angle[row]:.2f}, End Angle: {geometry.arc_end_angle[row]:.2f}\n"
+    elif etype == 'TEXT' or etype == 'MTEXT':
+        detail_text += f"  Text: '{geometry.text_strings[row]}'\n"
+        detail_text += f"  Location: {_format_point(geometry.text_insert[row])}\n"
+    elif etype == 'LWPOLYLINE' or etype == 'POLYLINE':
+        vertices = geometry.polyline_vertices(row)
+        label = "Points" if etype == 'LWPOLYLINE' else "Vertices"
+        detail_text += f"  {label} ({len(vertices)}):\n"
+        detail_text += "".join(f"    {_format_point(p)}\n" for p in vertices)
+    elif etype == '3DFACE':
+        detail_text += "  Vertices:\n"
+        detail_text += "".join(f"    {_format_point(p)}\n" for p in geometry.face_vertices[row])
+    elif etype == 'INSERT':
+        scale = geometry.insert_scale[row]
+        detail_text += f"  Block Name: {geometry.insert_names[row]}\n"
+        detail_text += f"  Insertion Point: {_format_point(geometry.insert_point[row])}\n"
+        detail_text += f"  Scale: X={scale[0]:.2f}, Y={scale[1]:.2f}, Z={scale[2]:.2f}\n"
+        instances = np.count_nonzero(geometry.instance_owner == i)
+        if instances:
+            detail_text += f"  Block Instances: {instances} (nested blocks and array cells included)\n"
     return detail_text
 
-def plot_dxf_drawing(msp):
-    """Visualizes the DXF drawing using matplotlib."""
+def iter_entity_details(geometry, indices):
+    """Lazily yields the formatted details of the entities with the given indices."""
+    for i in indices:
+        yield format_entity_detail(geometry, int(i))
+
+@st.cache_data(max_entries=64)
+def filter_entity_indices(file_hash, _geometry, types, layers):
+    """Returns the indices of entities matching the selected types and layers (empty selection = all)."""
+    mask = np.ones(_geometry.entity_count, dtype=bool)
+    if types:
+        codes = [code for code, name in enumerate(_geometry.type_names) if name in types]
+        mask &= np.isin(_geometry.type_codes, codes)
+    if layers:
+        codes = [code for code, name in enumerate(_geometry.layer_names) if name in layers]
+        mask &= np.isin(_geometry.layer_codes, codes)
+    return np.flatnonzero(mask)
+
+@st.cache_data(max_entries=256)
+def get_entity_details_page(file_hash, _geometry, types, layers, page, page_size=DETAILS_PAGE_SIZE):
+    """Formats one page of entity details; pages already formatted are served from the cache."""
+    indices = filter_entity_indices(file_hash, _geometry, types, layers)
+    start = page * page_size
+    return "".join(iter_entity_details(_geometry, indices[start:start + page_size]))
+
+@st.cache_data(max_entries=8)
+def get_line_cleanup_report(file_hash, _geometry, tolerance):
+    """Runs find_redundant_lines() over the LINE entities of a drawing; reports are cached per file and tolerance."""
+    started = time.perf_counter()
+    report = find_redundant_lines(_geometry.line_start, _geometry.line_end,
+                                  _geometry.layer_codes[_geometry.line_index], tolerance)
+    report['seconds'] = time.perf_counter() - started
+    return report
+
+def line_cleanup_rows(geometry, report):
+    """Tabulates a line cleanup report per layer, for layers with anything to clean."""
+    line_layers = geometry.layer_codes[geometry.line_index]
+
+    def count(rows):
+        return np.bincount(line_layers[rows], minlength=len(geometry.layer_names))
+
+    lines = count(np.arange(len(line_layers)))
+    exact, reversed_copies, overlapping = count(report['exact']), count(report['reversed']), count(report['overlapping'])
+    removed = exact + reversed_copies + overlapping
+    return [
+        {"Layer": geometry.layer_names[code], "LINE entities": int(lines[code]), "Exact duplicates": int(exact[code]),
+         "Reversed duplicates": int(reversed_copies[code]), "Overlapping": int(overlapping[code]),
+         "LINE entities after cleanup": int(lines[code] - removed[code])}
+        for code in np.flatnonzero(removed)
+    ]
+
+def write_cleaned_dxf(file_bytes, geometry, report, compress=False, arcname="drawing.dxf"):
+    """Re-reads a DXF, applies a line cleanup report to its modelspace and returns it as an in-memory buffer.
+
+    Duplicate and overlapping lines are deleted and the lines kept in their place are stretched over
+    the merged extent; everything else is written back unchanged.
+    """
+    fd, path = tempfile.mkstemp(suffix=".dxf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(file_bytes)
+        doc = ezdxf.readfile(path)
+    finally:
+        os.remove(path)
+    msp = doc.modelspace()
+    entities = list(msp)
+    if len(entities) != geometry.entity_count:
+        raise ValueError("The DXF file does not match the analyzed drawing.")
+
+    removed = np.concatenate([report['exact'], report['reversed'], report['overlapping']])
+    for i in geometry.line_index[removed]:
+        doc.entitydb.delete_entity(entities[i])
+    # Destroyed entities are dropped in one pass instead of one list removal each.
+    msp.purge()
+    for i, start, end in zip(geometry.line_index[report['merged']], report['merged_start'], report['merged_end']):
+        line = entities[i]
+        line.dxf.start, line.dxf.end = start.tolist(), end.tolist()
+    return write_dxf_to_buffer(doc, compress=compress, arcname=arcname)
+
+def geometry_paths(geometry, use_z, visible=None, instances=None):
+    """Returns the vertex paths of line-like entities, grouped by entity type.
+
+    Values are either a (n, k, dims) array of equally long paths or a list of (k, dims) arrays.
+    visible is an optional boolean mask over entities restricting which ones are included.
+    INSERT entities contribute the paths of their block instances under the block's entity types;
+    instances is an optional boolean mask over block instances overriding the ones of visible inserts.
+    """
+    dims = 3 if use_z else 2
+
+    def selected(index):
+        return np.ones(len(index), dtype=bool) if visible is None else visible[index]
+
+    parts = defaultdict(list)
+    rows = selected(geometry.line_index)
+    if rows.any():
+        parts['LINE'].append(np.stack([geometry.line_start[rows, :dims], geometry.line_end[rows, :dims]], axis=1))
+    rows = selected(geometry.circle_index)
+    if rows.any():
+        theta = np.linspace(0, 2 * np.pi, 100)
+        center, r = geometry.circle_center[rows], geometry.circle_radius[rows, None]
+        x = center[:, 0:1] + r * np.cos(theta)
+        y = center[:, 1:2] + r * np.sin(theta)
+        z = np.broadcast_to(center[:, 2:3], x.shape)
+        parts['CIRCLE'].append(np.stack([x, y, z][:dims], axis=-1))
+    rows = selected(geometry.arc_index)
+    if rows.any():
+        x, y = arc_points(geometry.arc_center[rows], geometry.arc_radius[rows], geometry.arc_start_angle[rows], geometry.arc_end_angle[rows])
+        z = np.broadcast_to(geometry.arc_center[rows, 2:3], x.shape)
+        parts['ARC'].append(np.stack([x, y, z][:dims], axis=-1))
+    rows = np.flatnonzero(selected(geometry.poly_index))
+    if len(rows):
+        poly_types = geometry.type_codes[geometry.poly_index[rows]]
+        for code in np.unique(poly_types):
+            polylines = [geometry.polyline_vertices(row)[:, :dims] for row in rows[poly_types == code]]
+            polylines = [vertices for vertices in polylines if len(vertices)]
+            if polylines:
+                parts[geometry.type_names[code]].append(polylines)
+    rows = selected(geometry.face_index)
+    if rows.any():
+        faces = geometry.face_vertices[rows, :, :dims]
+        parts['3DFACE'].append(np.concatenate([faces, faces[:, :1]], axis=1))
+    if len(geometry.instance_block):
+        if instances is None:
+            instances = np.ones(len(geometry.instance_block), dtype=bool) if visible is None else visible[geometry.instance_owner]
+        for etype, batch in iter_block_paths(geometry, instances, dims):
+            parts[etype].append(batch)
+    return {etype: _merge_paths(batches) for etype, batches in parts.items()}
+
+def _merge_paths(batches):
+    if all(isinstance(batch, np.ndarray) for batch in batches) and len({batch.shape[1] for batch in batches}) == 1:
+        return batches[0] if len(batches) == 1 else np.concatenate(batches)
+    return [path for batch in batches for path in batch]
+
+def plot_dxf_drawing(geometry, batched=True, viewport=None, spatial_index=None, min_pixel_size=LOD_MIN_PIXELS):
+    """Visualizes the DXF drawing using matplotlib.
+
+    With batched=True all paths of one entity type are drawn as a single line collection
+    instead of one Line2D artist per entity. 2D drawings are culled to the viewport
+    (min_x, min_y, max_x, max_y; full extent if None) through the spatial index, and
+    entities smaller than min_pixel_size pixels are collapsed to points.
+
+    Returns the figure, the visualization description and a dict of render statistics.
+    """
     fig = plt.figure(figsize=(12, 8))
     fig.patch.set_facecolor('#f8fafc')
     
-    has_3d = any(e.dxftype() in ["3DFACE", "POLYLINE"] or getattr(e.dxf, 'z', 0) != 0 for e in msp)
+    has_3d = geometry.has_3d
     ax = fig.add_subplot(111, projection='3d' if has_3d else None)
     ax.set_facecolor('#ffffff')
 
@@ -705,104 +3576,112 @@ def plot_dxf_drawing(msp):
     }
 
     visualization_summary_parts = []
-    entity_counts = defaultdict(int)
-    min_x, max_x, min_y, max_y, min_z, max_z = float('inf'), float('-inf'), float('inf'), float('-inf'), float('inf'), float('-inf')
-    plotted_entities_count = 0
+    bounds = geometry_bounds(geometry)
+    index = spatial_index if spatial_index is not None else build_spatial_index(geometry)
+    plotted_entities_count = len(index.valid_ids)
+    render_stats = {'total': plotted_entities_count, 'drawn': plotted_entities_count, 'collapsed': 0, 'culled': 0, 'hidden_labels': 0}
+
+    visible = instances = None
+    min_label_height, label_budget = 0.0, MAX_TEXT_LABELS
+    if not has_3d and index.extent is not None:
+        if viewport is None:
+            (view_min_x, view_min_y), (view_max_x, view_max_y) = index.extent
+            candidates = index.valid_ids
+        else:
+            view_min_x, view_min_y, view_max_x, view_max_y = viewport
+            candidates = index.query(view_min_x, view_min_y, view_max_x, view_max_y)
+        units_per_pixel = max((view_max_x - view_min_x) / ax.bbox.width, (view_max_y - view_min_y) / ax.bbox.height)
+
+        is_text = np.zeros(geometry.entity_count, dtype=bool)
+        is_text[geometry.text_index] = True
+        shapes = candidates[~is_text[candidates]]
+        b = index.bounds[shapes]
+        tiny = np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]) < min_pixel_size * units_per_pixel
+        labels = candidates[is_text[candidates]]
+        heights = geometry.text_height[geometry.rows[labels]]
+        readable = heights >= TEXT_MIN_PIXELS * units_per_pixel
+        labels, heights = labels[readable], heights[readable]
+        if len(labels) > MAX_TEXT_LABELS:
+            labels = labels[np.argsort(-heights, kind='stable')[:MAX_TEXT_LABELS]]
+        min_label_height, label_budget = TEXT_MIN_PIXELS * units_per_pixel, MAX_TEXT_LABELS - len(labels)
+
+        visible = np.zeros(geometry.entity_count, dtype=bool)
+        visible[shapes[~tiny]] = True
+        visible[labels] = True
+
+        collapsed = shapes[tiny]
+        centers = (index.bounds[collapsed, :2] + index.bounds[collapsed, 2:]) / 2
+        collapsed_codes = geometry.type_codes[collapsed]
+        for code in np.unique(collapsed_codes):
+            points = centers[collapsed_codes == code]
+            ax.plot(points[:, 0], points[:, 1], linestyle='none', marker='.', markersize=1,
+                    color=colors.get(geometry.type_names[code], '#374151'))
+
+        if len(geometry.instance_block):
+            # Block instances of visible inserts are culled and collapsed like entities.
+            ib = block_instance_bounds(geometry)[:, :, :2].reshape(-1, 4)
+            in_view = ((ib[:, 0] <= view_max_x) & (ib[:, 2] >= view_min_x) & (ib[:, 1] <= view_max_y) & (ib[:, 3] >= view_min_y))
+            instances = visible[geometry.instance_owner] & in_view
+            tiny = np.maximum(ib[:, 2] - ib[:, 0], ib[:, 3] - ib[:, 1]) < min_pixel_size * units_per_pixel
+            points = (ib[instances & tiny, :2] + ib[instances & tiny, 2:]) / 2
+            ax.plot(points[:, 0], points[:, 1], linestyle='none', marker='.', markersize=1, color=colors['INSERT'])
+            instances &= ~tiny
+
+        render_stats.update(
+            drawn=int(visible.sum()),
+            collapsed=len(collapsed),
+            culled=plotted_entities_count - len(candidates),
+            hidden_labels=int(is_text[candidates].sum()) - len(labels),
+        )
 
-    for e in msp:
-        try:
-            etype = e.dxftype()
-            color = colors.get(etype, '#374151')
-            
-            if etype == 'LINE':
-                s, ept = e.dxf.start, e.dxf.end
-                ax.plot([s.x, ept.x], [s.y, ept.y], [s.z, ept.z] if has_3d else None, c=color, linewidth=1.5)
-                min_x, max_x = min(min_x, s.x, ept.x), max(max_x, s.x, ept.x)
-                min_y, max_y = min(min_y, s.y, ept.y), max(max_y, s.y, ept.y)
-                min_z, max_z = min(min_z, s.z, ept.z), max(max_z, s.z, ept.z)
-                plotted_entities_count += 1
-            elif etype == 'CIRCLE':
-                center, r = e.dxf.center, e.dxf.radius
-                theta = np.linspace(0, 2 * np.pi, 100)
-                x = center.x + r * np.cos(theta)
-                y = center.y + r * np.sin(theta)
-                z = np.full_like(x, center.z) if has_3d else None
-                ax.plot(x, y, z, c=color, linewidth=1.5)
-                min_x, max_x = min(min_x, center.x - r), max(max_x, center.x + r)
-                min_y, max_y = min(min_y, center.y - r), max(max_y, center.y + r)
-                min_z, max_z = min(min_z, center.z), max(max_z, center.z)
-                plotted_entities_count += 1
-            elif etype == 'ARC':
-                center, r = e.dxf.center, e.dxf.radius
-                start_angle_rad = np.deg2rad(e.dxf.start_angle)
-                end_angle_rad = np.deg2rad(e.dxf.end_angle)
-                if start_angle_rad > end_angle_rad:
-                    end_angle_rad += 2 * np.pi
-                theta = np.linspace(start_angle_rad, end_angle_rad, 100)
-                x = center.x + r * np.cos(theta)
-                y = center.y + r * np.sin(theta)
-                z = np.full_like(x, center.z) if has_3d else None
-                ax.plot(x, y, z, c=color, linewidth=1.5)
-                min_x, max_x = min(min_x, np.min(x)), max(max_x, np.max(x))
-                min_y, max_y = min(min_y, np.min(y)), max(max_y, np.max(y))
-                min_z, max_z = min(min_z, center.z), max(max_z, center.z)
-                plotted_entities_count += 1
-            elif etype == 'POLYLINE':
-                x, y, z = [], [], []
-                for v in e.vertices:
-                    x.append(v.dxf.location.x)
-                    y.append(v.dxf.location.y)
-                    z.append(v.dxf.location.z)
-                ax.plot(x, y, z if has_3d else None, c=color, linewidth=1.5)
-                min_x, max_x = min(min_x, np.min(x)), max(max_x, np.max(x))
-                min_y, max_y = min(min_y, np.min(y)), max(max_y, np.max(y))
-                min_z, max_z = min(min_z, np.min(z)), max(max_z, np.min(z))
-                plotted_entities_count += 1
-            elif etype == 'LWPOLYLINE':
-                points = e.get_points(format='xy')
-                x = [p[0] for p in points]
-                y = [p[1] for p in points]
-                lwpolyline_z = e.dxf.elevation if has_3d else 0
-                z = np.full_like(x, lwpolyline_z) if has_3d else None
-                ax.plot(x, y, z, c=color, linewidth=1.5)
-                min_x, max_x = min(min_x, np.min(x)), max(max_x, np.max(x))
-                min_y, max_y = min(min_y, np.min(y)), max(max_y, np.max(y))
-                min_z, max_z = min(min_z, lwpolyline_z), max(max_z, lwpolyline_z)
-                plotted_entities_count += 1
-            elif etype == '3DFACE':
-                pts = [e.dxf.vtx0, e.dxf.vtx1, e.dxf.vtx2, e.dxf.vtx3]
-                face_x = [p.x for p in pts] + [pts[0].x]
-                face_y = [p.y for p in pts] + [pts[0].y]
-                face_z = [p.z for p in pts] + [pts[0].z]
-                ax.plot(face_x, face_y, face_z, c=color, linewidth=1.5)
-                min_x, max_x = min(min_x, np.min(face_x)), max(max_x, np.max(face_x))
-                min_y, max_y = min(min_y, np.min(face_y)), max(max_y, np.max(face_y))
-                min_z, max_z = min(min_z, np.min(face_z)), max(max_z, np.max(face_z))
-                plotted_entities_count += 1
-            elif etype == 'TEXT' or etype == 'MTEXT':
-                insert_point = e.dxf.insert
-                text_content = e.dxf.text
-                if has_3d:
-                    ax.text(insert_point.x, insert_point.y, insert_point.z, text_content, color=color, fontsize=10, weight='bold')
-                else:
-                    ax.text(insert_point.x, insert_point.y, text_content, color=color, fontsize=10, weight='bold')
-                
-                min_x, max_x = min(min_x, insert_point.x), max(max_x, insert_point.x)
-                min_y, max_y = min(min_y, insert_point.y), max(max_y, insert_point.y)
-                min_z, max_z = min(min_z, insert_point.z), max(max_z, insert_point.z)
-                plotted_entities_count += 1
-            
-            entity_counts[etype] += 1
+    for etype, paths in geometry_paths(geometry, has_3d, visible, instances).items():
+        color = colors.get(etype, '#374151')
+        if batched:
+            if has_3d:
+                ax.add_collection3d(Line3DCollection(paths, colors=color, linewidths=1.5))
+            else:
+                ax.add_collection(LineCollection(paths, colors=color, linewidths=1.5))
+        else:
+            for path in paths:
+                ax.plot(*path.T, c=color, linewidth=1.5)
+
+    if viewport is not None and visible is not None:
+        ax.set_xlim(viewport[0], viewport[2])
+        ax.set_ylim(viewport[1], viewport[3])
+    elif batched and bounds is not None:
+        # Collections do not take part in autoscaling like ax.plot does.
+        if has_3d:
+            ax.auto_scale_xyz(*np.array(bounds).T)
+        else:
+            ax.update_datalim(np.array(bounds)[:, :2])
+            ax.autoscale_view()
 
-        except Exception as ex:
-            st.warning(f"Skipping entity {etype} due to plotting error: {ex}")
+    for insert_point, text_content, i in zip(geometry.text_insert, geometry.text_strings, geometry.text_index):
+        if visible is not None and not visible[i]:
             continue
+        color = colors[geometry.type_name(i)]
+        if has_3d:
+            ax.text(insert_point[0], insert_point[1], insert_point[2], text_content, color=color, fontsize=10, weight='bold')
+        else:
+            ax.text(insert_point[0], insert_point[1], text_content, color=color, fontsize=10, weight='bold')
+
+    if len(geometry.block_text_block):
+        if instances is None:
+            instances = np.ones(len(geometry.instance_block), dtype=bool) if visible is None else visible[geometry.instance_owner]
+        points, heights, texts = block_text_labels(geometry, instances)
+        readable = np.flatnonzero(heights >= min_label_height)
+        readable = readable[np.argsort(-heights[readable], kind='stable')[:label_budget]]
+        render_stats['hidden_labels'] += len(texts) - len(readable)
+        for point, text in zip(points[readable], texts[readable]):
+            color = colors[geometry.type_names[geometry.block_text_type[text]]]
+            ax.text(*point[:3 if has_3d else 2], geometry.block_text_strings[text], color=color, fontsize=10, weight='bold')
 
     if plotted_entities_count == 0:
         plt.close(fig)
-        return None, "No plottable geometric entities were found in the DXF file. Visualization cannot be generated."
+        return None, "No plottable geometric entities were found in the DXF file. Visualization cannot be generated.", render_stats
 
-    if min_x != float('inf'):
+    if bounds is not None:
+        (min_x, min_y, min_z), (max_x, max_y, max_z) = bounds
         bbox_width = max_x - min_x
         bbox_height = max_y - min_y
         bbox_depth = max_z - min_z if has_3d else 0
@@ -826,6 +3705,7 @@ def plot_dxf_drawing(msp):
         ax.tick_params(axis='x', colors='#374151')
         ax.tick_params(axis='y', colors='#374151')
 
+    entity_counts, _ = get_entity_summary(geometry)
     entity_viz_counts = ", ".join([f"{count} {etype.lower()}(s)" for etype, count in entity_counts.items()])
     if entity_viz_counts:
         visualization_summary_parts.append(f"It visually represents: {entity_viz_counts}.")
@@ -835,19 +3715,34 @@ def plot_dxf_drawing(msp):
     plt.title("DXF Geometry Visualization", fontsize=16, color='#1f2937', weight='bold')
     plt.grid(True, linestyle='--', alpha=0.7, color='#e2e8f0') # Lighter grid
     plt.tight_layout()
-    return fig, " ".join(visualization_summary_parts)
-
-def generate_llm_summary(msp, entity_summary, visualization_description):
-    """Generates a professional summary of the DXF drawing using the LLM."""
-    if not st.session_state.llm_client_ready:
-        return "AI services are not available. Cannot generate summary."
+    return fig, " ".join(visualization_summary_parts), render_stats
+
+@st.cache_data(max_entries=32)
+def render_drawing_png(file_hash, _geometry, _spatial_index, viewport):
+    """Renders the drawing for a viewport to PNG bytes; views already rendered are served from the cache."""
+    fig, viz_desc, render_stats = plot_dxf_drawing(_geometry, viewport=viewport, spatial_index=_spatial_index)
+    if fig is None:
+        return None, viz_desc, render_stats
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=200, bbox_inches="tight", facecolor=fig.get_facecolor())
+    plt.close(fig)
+    return buffer.getvalue(), viz_desc, render_stats
+
+def generate_llm_summary(annotation_index, entity_summary, visualization_description, metrics=None):
+    """Streams a professional summary of the DXF drawing generated by the LLM.
+
+    Only the most prominent annotations go into the prompt; see AnnotationIndex.prominent().
+    """
+    if not llm_client_ready():
+        yield "AI services are not available. Cannot generate summary."
+        return
 
     geom = "\n".join([f"- {k}: {v}" for k, v in entity_summary.items()])
 
-    annots = ""
-    for e in msp:
-        if e.dxftype() in ['TEXT', 'MTEXT']:
-            annots += f"- '{e.dxf.text}' at ({e.dxf.insert.x:.2f}, {e.dxf.insert.y:.2f})\n"
+    annotations = annotation_index.prominent(SUMMARY_MAX_ANNOTATIONS)
+    annots = "\n".join(format_annotation(a) for a in annotations)
+    if len(annotation_index) > len(annotations):
+        annots += f"\n- ... {len(annotation_index) - len(annotations)} more annotations not listed"
     if not annots:
         annots = "No text annotations found."
 
@@ -872,65 +3767,74 @@ Based on the above data, generate a professional summary describing:
 -   If there are text annotations, integrate their meaning into the summary.
 -   Keep the summary concise yet informative, suitable for an engineering or design review.
 """
-    with st.spinner("Generating AI summary... This may take a moment."):
-        try:
-            response = llm_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[
-                    {"role": "system", "content": "You are a CAD expert providing professional summaries of DXF drawings."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.5,
-                max_tokens=500
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"AI Summary Generation Failed: {e}"
+    try:
+        yield from stream_chat_completion(
+            [
+                {"role": "system", "content": "You are a CAD expert providing professional summaries of DXF drawings."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.5,
+            max_tokens=500,
+            metrics=metrics
+        )
+    except Exception as e:
+        yield f"AI Summary Generation Failed: {e}"
+
+def generate_chatbot_response(user_question, entity_summary, layers, visualization_description, annotation_index,
+                              query_engine, chat_history, chat_summary, metrics=None):
+    """Streams a chatbot response generated by the LLM based on the current DXF context.
+
+    chat_history holds the earlier turns only; it is trimmed to the token budget with
+    budget_chat_history(), and the DXF context is sent once, ahead of the conversation.
+    The annotations most relevant to the question are retrieved from annotation_index, and
+    the model can call the GEOMETRY_TOOLS answered by query_engine.
+    """
+    if not llm_client_ready():
+        yield "AI services are not available. Cannot respond."
+        return
 
-def generate_chatbot_response(user_question, entity_summary, layers, visualization_description, chat_history):
-    """Generates a chatbot response using the LLM based on the current DXF context."""
-    if not st.session_state.llm_client_ready:
-        return "AI services are not available. Cannot respond."
+    context_prompt = f"""{CHAT_SYSTEM_PROMPT}
 
-    context_prompt = f"""
 Current DXF Context:
 - Entity Summary: {dict(entity_summary)}
-- Layers: {list(layers)}
+- Layers: {sorted(layers)}
 - Visualization Description: {visualization_description if visualization_description else 'No geometric visualization available for context.'}
-- User Question: {user_question}
 
-Based on the provided DXF context, answer the user's question concisely and helpfully.
-If the question cannot be answered from the provided DXF data, state that.
+Based on the provided DXF context, answer the user's questions concisely and helpfully.
+For counts, lengths, areas, radii and positions, call the geometry tools instead of estimating; their results are exact.
+If a question cannot be answered from the provided DXF data, state that.
 """
-    messages_for_llm = chat_history + [{"role": "user", "content": context_prompt}]
-
-    with st.spinner("Bot thinking..."):
-        try:
-            response = llm_client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages_for_llm,
-                temperature=0.7,
-                max_tokens=200
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Chatbot Error: {e}"
+    messages_for_llm = [{"role": "system", "content": context_prompt}]
+    try:
+        recent_turns = budget_chat_history(chat_history, chat_summary)
+        if chat_summary['text']:
+            messages_for_llm.append({"role": "system", "content": f"Summary of the earlier conversation:\n{chat_summary['text']}"})
+        messages_for_llm += recent_turns
+        annotations = annotation_index.search(user_question)
+        if annotations:
+            retrieved = "\n".join(format_annotation(a) for a in annotations)
+            messages_for_llm.append({"role": "system", "content": f"Text annotations of the drawing relevant to the next question:\n{retrieved}"})
+        elif len(annotation_index):
+            messages_for_llm.append({"role": "system", "content": "No text annotation of the drawing matches the next question."})
+        messages_for_llm.append({"role": "user", "content": user_question})
+        if metrics is not None:
+            metrics['prompt_tokens'] = sum(message_tokens(m) for m in messages_for_llm)
+
+        yield from stream_tool_chat_completion(
+            messages_for_llm, GEOMETRY_TOOLS, query_engine.run_tool, temperature=0.7, max_tokens=200, metrics=metrics
+        )
+    except Exception as e:
+        yield f"Chatbot Error: {e}"
 
-def extract_image_from_pdf(pdf_file):
-    """Extracts the first page as an image from a PDF file-like object."""
+def extract_image_from_pdf(pdf_bytes, dpi=None):
+    """Extracts the first page as an image from PDF content."""
     doc = None
     try:
-        pdf_bytes = pdf_file.read()
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
         if not doc.page_count == 1:
-            st.warning("PDF contains more than one page. Only the first page will be processed.")
+            st.warning(f"PDF contains {doc.page_count} pages. Only the first page is previewed; convert all of them to DXF below.")
 
-        page = doc.load_page(0)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2)) # Render at 2x resolution
-
-        img_data = pix.tobytes("png")
-        image = Image.open(io.BytesIO(img_data))
-        return image
+        return render_pdf_page(doc.load_page(0), dpi)
     except Exception as e:
         st.error(f"Error extracting image from PDF. Please ensure it's a valid PDF.")
         return None
@@ -938,233 +3842,310 @@ def extract_image_from_pdf(pdf_file):
         if doc:
             doc.close()
 
-def convert_image_to_svg(image_pil):
-    """Converts a PIL Image to SVG using the Hugging Face Gradio API."""
-    if not st.session_state.gradio_client_ready:
-        st.error("Vectorization services are not available. Cannot convert to SVG.")
-        return None
-
+def vectorize_remote(image_pil, params):
+    """Vectorizes an image on the Hugging Face Space; returns SVG text or raises."""
     temp_image_path = None
     temp_svg_from_api_path = None
-    svg_string = None
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
+            temp_image_path = temp_file.name
+            temp_file.write(encode_png(image_pil))
 
-    with st.spinner("Converting image to SVG... This may take a moment."):
-        try:
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-                temp_image_path = temp_file.name
-                image_pil.save(temp_image_path)
-
-            result = gradio_client.predict(
-                image=handle_file(temp_image_path),
-                colormode="color", hierarchical="stacked", mode="spline",
-                filter_speckle=4, color_precision=6, layer_difference=16,
-                corner_threshold=60, length_threshold=4, max_iterations=10,
-                splice_threshold=45, path_precision=3,
-                api_name="/convert_to_vector_1"
-            )
+        result = get_gradio_client().predict(
+            image=handle_file(temp_image_path), **dict(VECTORIZER_DEFAULTS, **params),
+            api_name="/convert_to_vector_1"
+        )
 
-            if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], str) and os.path.exists(result[1]):
-                temp_svg_from_api_path = result[1]
-                with open(temp_svg_from_api_path, "r") as f:
-                    svg_string = f.read()
-            elif isinstance(result, str):
-                svg_string = result
-            elif isinstance(result, list) and len(result) > 0 and isinstance(result[0], str):
-                svg_string = result[0]
-            else:
-                st.error("SVG conversion failed: Unexpected response from conversion service.")
-                return None
+        if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], str) and os.path.exists(result[1]):
+            temp_svg_from_api_path = result[1]
+            with open(temp_svg_from_api_path, "r") as f:
+                return f.read()
+        elif isinstance(result, str):
+            return result
+        elif isinstance(result, list) and len(result) > 0 and isinstance(result[0], str):
+            return result[0]
+        raise RuntimeError("Unexpected response from conversion service.")
+    finally:
+        if temp_image_path and os.path.exists(temp_image_path):
+            os.remove(temp_image_path)
+        if temp_svg_from_api_path and os.path.exists(temp_svg_from_api_path):
+            os.remove(temp_svg_from_api_path)
+
+# Vectorizer backends by label: (vectorize(image_pil, params) -> SVG text, availability check).
+VECTORIZER_BACKENDS = {
+    "Remote (Hugging Face Space)": (vectorize_remote, lambda: gradio_client_ready()),
+    "Local (offline)": (vectorize_image_locally, lambda: True),
+}
+# Backend preselected in the UI: "remote" or "local".
+DEFAULT_VECTORIZER_BACKEND = next(
+    (label for label in VECTORIZER_BACKENDS if label.lower().startswith(os.getenv("VECTORIZER_BACKEND", "remote").lower())),
+    next(iter(VECTORIZER_BACKENDS)))
+
+def vectorizer_ready(backend):
+    """True unless the given vectorizer backend is known to be unavailable."""
+    return VECTORIZER_BACKENDS[backend][1]()
+
+def benchmark_vectorizers(image_pil, params):
+    """Runs every available vectorizer backend on the same image; returns one result row per backend."""
+    rows = []
+    for backend, (vectorize, ready) in VECTORIZER_BACKENDS.items():
+        row = {'Backend': backend, 'Seconds': None, 'SVG bytes': None, 'Paths': None, 'Error': ""}
+        if not ready():
+            row['Error'] = "Not available"
+        else:
+            started = time.perf_counter()
+            try:
+                svg_string = vectorize(image_pil, params)
+                row['Seconds'] = round(time.perf_counter() - started, 3)
+                row['SVG bytes'] = len(svg_string.encode("utf-8"))
+                row['Paths'] = svg_string.count("<path")
+            except Exception as e:
+                row['Error'] = str(e)
+        rows.append(row)
+    return rows
+
+def vectorizer_settings(key_prefix="vec_"):
+    """Renders the vectorization parameters; returns them as a dict for the backends."""
+    with st.expander("Vectorization settings"):
+        col1, col2, col3 = st.columns(3)
+        params = {
+            'colormode': col1.selectbox("Color mode", ["color", "binary"], key=f"{key_prefix}colormode"),
+            'hierarchical': col2.selectbox("Layering", ["stacked", "cutout"], key=f"{key_prefix}hierarchical"),
+            'mode': col3.selectbox("Curve fitting", ["spline", "polygon", "none"], key=f"{key_prefix}mode"),
+        }
+        for i, (name, label, low, high) in enumerate([
+                ('filter_speckle', "Filter speckle (px)", 0, 128), ('color_precision', "Color precision (bits)", 1, 8),
+                ('layer_difference', "Layer difference", 0, 255), ('corner_threshold', "Corner threshold (°)", 0, 180),
+                ('length_threshold', "Length threshold (px)", 0, 100), ('max_iterations', "Max iterations", 1, 50),
+                ('splice_threshold', "Splice threshold (°)", 0, 180), ('path_precision', "Path precision (decimals)", 0, 8)]):
+            params[name] = (col1, col2, col3)[i % 3].number_input(
+                label, min_value=low, max_value=high, value=VECTORIZER_DEFAULTS[name], step=1, key=f"{key_prefix}{name}")
+    return params
+
+def preprocessing_settings(key_prefix="prep_"):
+    """Renders the image preprocessing options; returns them for preprocess_image(), or None when disabled."""
+    with st.expander("Image preprocessing"):
+        if not st.checkbox("Preprocess images before vectorization", value=True, key=f"{key_prefix}enabled",
+                           help="Smaller images upload and trace much faster; line art loses nothing."):
+            return None
+        col1, col2, col3 = st.columns(3)
+        return {
+            'crop': col1.checkbox("Crop margins", value=True, key=f"{key_prefix}crop"),
+            'color_mode': PREPROCESS_COLOR_MODES[col2.selectbox("Colors", list(PREPROCESS_COLOR_MODES), key=f"{key_prefix}colors")],
+            'target_dpi': col3.number_input("Target DPI", min_value=25, max_value=1200, value=PREPROCESS_TARGET_DPI,
+                                            step=25, key=f"{key_prefix}dpi",
+                                            help="Images recording a higher resolution are downscaled to this."),
+        }
 
-            if svg_string:
-                st.success("Image successfully converted to SVG!")
-                return svg_string
-            else:
-                st.error("SVG conversion failed: No SVG content received.")
-                return None
+def simplify_settings(key_prefix=""):
+    """Renders the polyline simplification options; returns the tolerance in drawing units, or None when off."""
+    col1, col2 = st.columns(2)
+    enabled = col1.checkbox("Simplify polylines", value=True, key=f"{key_prefix}simplify",
+                            help="Drops nearly collinear vertices of traced outlines; DXF files get several times smaller.")
+    tolerance = col2.number_input("Simplification tolerance (drawing units)", min_value=0.001, value=SIMPLIFY_TOLERANCE,
+                                  step=0.1, format="%.3f", key=f"{key_prefix}simplify_tolerance", disabled=not enabled,
+                                  help="No point of the exported polylines moves further than this.")
+    return tolerance if enabled else None
+
+def write_dxf_to_buffer(doc, compress=False, arcname="drawing.dxf"):
+    """Serializes a DXF document straight into an in-memory buffer, optionally as a zip archive."""
+    buffer = io.BytesIO()
+    if compress:
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(arcname, "w", force_zip64=True) as entry:
+                _write_dxf_text(doc, entry)
+    else:
+        _write_dxf_text(doc, buffer)
+    buffer.seek(0)
+    return buffer
+
+def _write_dxf_text(doc, binary_stream):
+    text_stream = io.TextIOWrapper(binary_stream, encoding=doc.output_encoding, newline="")
+    doc.write(text_stream)
+    text_stream.flush()
+    text_stream.detach()
+
+SVG_NAMESPACE = "{http://www.w3.org/2000/svg}"
+SVG_EXPORTED_ELEMENTS = frozenset(['path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'text'])
+# Characters (or bytes, for files) handed to the XML parser at a time.
+SVG_PARSE_CHUNK_SIZE = 1024 * 1024
+# Characters of path data parsed and flattened together.
+SVG_PATH_BATCH_SIZE = 1024 * 1024
+
+def iter_svg_elements(svg_source, names):
+    """Yields the SVG elements with the given local names in document order, as each one closes.
+
+    svg_source is SVG text or a binary file object; it is parsed incrementally, as iterparse
+    does, and every element is detached from the tree once handled, so memory stays flat
+    however large the document is.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    open_elements = []
+
+    def handle_events():
+        for event, element in parser.read_events():
+            if event == "start":
+                open_elements.append(element)
+                continue
+            open_elements.pop()
+            if element.tag.startswith(SVG_NAMESPACE) and element.tag[len(SVG_NAMESPACE):] in names:
+                yield element
+            element.clear()
+            # A closing element is always the last child of its still open parent.
+            if open_elements:
+                del open_elements[-1][-1]
+
+    if isinstance(svg_source, str):
+        chunks = (svg_source[i:i + SVG_PARSE_CHUNK_SIZE] for i in range(0, len(svg_source), SVG_PARSE_CHUNK_SIZE))
+    else:
+        chunks = iter(lambda: svg_source.read(SVG_PARSE_CHUNK_SIZE), b"")
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from handle_events()
+    parser.close()
+    yield from handle_events()
+
+def add_svg_to_layout(layout, svg_source, tolerance=SVG_CURVE_TOLERANCE, simplify=None, transform=None):
+    """Adds the exportable elements of an SVG to a DXF layout in one streaming pass; returns entity and vertex counts.
+
+    Curves are flattened within tolerance, then mapped by the optional 3x3 transform and simplified, see simplify_polyline_list().
+    """
+    path_batch, batch_size = [], 0
+    entities_at_start = len(layout)
+    stats = {'vertices_before': 0, 'vertices': 0, 'dropped': 0}
+    if transform is not None:
+        transform = np.asarray(transform, dtype=float)
+        linear, offset = transform[:2, :2], transform[:2, 2]
+        # Lengths (radii, text heights) scale by the mean factor of the linear part.
+        length_scale = np.sqrt(abs(np.linalg.det(linear)))
+
+    def point(x, y):
+        if transform is None:
+            return (x, y)
+        return tuple((linear @ (x, y) + offset).tolist())
+
+    def add_polylines(polylines):
+        if transform is not None:
+            polylines = [(points @ linear.T + offset, closed) for points, closed in polylines]
+        if simplify:
+            simplified, before, after = simplify_polyline_list(polylines, simplify)
+            stats['dropped'] += len(polylines) - len(simplified)
+            polylines = simplified
+        else:
+            before = after = sum(len(points) for points, _ in polylines)
+        stats['vertices_before'] += before
+        stats['vertices'] += after
+        for points, closed in polylines:
+            layout.add_lwpolyline(points.tolist(), close=closed)
+
+    def flush_paths():
+        nonlocal batch_size
+        # Every path restarts at the origin, so the batch parses like the paths one by one.
+        add_polylines(parse_svg_path("".join(f"M0 0 {d} " for d in path_batch), tolerance))
+        path_batch.clear()
+        batch_size = 0
+
+    for element in iter_svg_elements(svg_source, SVG_EXPORTED_ELEMENTS):
+        tag = element.tag[len(SVG_NAMESPACE):]
+
+        if tag == 'path':
+            # Traced SVGs hold many small paths; they are flattened in batches.
+            d_attr = element.get("d")
+            if d_attr:
+                path_batch.append(d_attr)
+                batch_size += len(d_attr)
+                if batch_size >= SVG_PATH_BATCH_SIZE:
+                    flush_paths()
+            continue
 
-        except Exception as e:
-            st.error(f"Error during SVG conversion. Please ensure the image is valid and try again.")
-            return None
-        finally:
-            if temp_image_path and os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-            if temp_svg_from_api_path and os.path.exists(temp_svg_from_api_path):
-                os.remove(temp_svg_from_api_path)
-
-def convert_svg_to_dxf(svg_content):
-    """Converts SVG content to DXF using ezdxf."""
+        # Other elements keep their place in document order.
+        if path_batch:
+            flush_paths()
+
+        if tag == 'rect':
+            x = float(element.get('x', 0))
+            y = float(element.get('y', 0))
+            width = float(element.get('width', 0))
+            height = float(element.get('height', 0))
+            if width > 0 and height > 0:
+                points = [
+                    point(x, y),
+                    point(x + width, y),
+                    point(x + width, y + height),
+                    point(x, y + height),
+                    point(x, y)
+                ]
+                layout.add_lwpolyline(points, close=True)
+
+        elif tag == 'circle':
+            cx = float(element.get('cx', 0))
+            cy = float(element.get('cy', 0))
+            r = float(element.get('r', 0))
+            if r > 0:
+                layout.add_circle(point(cx, cy), r if transform is None else r * length_scale)
+
+        elif tag == 'ellipse':
+            cx = float(element.get('cx', 0))
+            cy = float(element.get('cy', 0))
+            rx = float(element.get('rx', 0))
+            ry = float(element.get('ry', 0))
+            if rx > 0 and ry > 0:
+                major_axis = (rx, 0) if transform is None else tuple((linear @ (rx, 0)).tolist())
+                layout.add_ellipse(center=point(cx, cy), major_axis=major_axis, ratio=ry/rx)
+
+        elif tag == 'line':
+            x1 = float(element.get('x1', 0))
+            y1 = float(element.get('y1', 0))
+            x2 = float(element.get('x2', 0))
+            y2 = float(element.get('y2', 0))
+            layout.add_line(point(x1, y1), point(x2, y2))
+
+        elif tag == 'polyline' or tag == 'polygon':
+            coords = parse_svg_numbers(element.get('points', ''))
+            points = coords[:len(coords) // 2 * 2].reshape(-1, 2)
+            if len(points):
+                add_polylines([(points, tag == 'polygon')])
+
+        elif tag == 'text':
+            x = float(element.get('x', 0))
+            y = float(element.get('y', 0))
+            text_content = element.text or ""
+            font_size = float(element.get('font-size', '12').replace('px', ''))
+            layout.add_text(text_content, dxfattribs={
+                'height': font_size if transform is None else font_size * length_scale,
+                'insert': point(x, y),
+                'halign': 0,
+                'valign': 0
+            })
+
+    if path_batch:
+        flush_paths()
+    entities = len(layout) - entities_at_start
+    return {'entities_before': entities + stats['dropped'], 'entities': entities,
+            'vertices_before': stats['vertices_before'], 'vertices': stats['vertices']}
+
+def format_simplify_stats(stats):
+    """Describes add_svg_to_layout() counts in one line."""
+    text = f"{stats['entities']:,} entities, {stats['vertices']:,} polyline vertices"
+    if stats['vertices'] != stats['vertices_before'] or stats['entities'] != stats['entities_before']:
+        text += (f" (simplified from {stats['entities_before']:,} entities and {stats['vertices_before']:,} vertices, "
+                 f"{stats['vertices_before'] / max(stats['vertices'], 1):.1f}× fewer vertices)")
+    return text
+
+def convert_svg_to_dxf(svg_content, compress=False, arcname="drawing.dxf", tolerance=SVG_CURVE_TOLERANCE, simplify=None):
+    """Converts SVG content to DXF using ezdxf and returns it as an in-memory buffer; see add_svg_to_layout()."""
     if ezdxf is None:
         st.error("The 'ezdxf' library is not available. Cannot export to DXF. Please ensure it's installed.")
         return None
 
-    temp_dxf_path = None
-    dxf_bytes = None
-
     with st.spinner("Exporting SVG to DXF..."):
         try:
             doc = ezdxf.new("R2010")
-            msp = doc.modelspace()
-            root = ET.fromstring(svg_content)
-            svg_ns = "{http://www.w3.org/2000/svg}"
-
-            # Basic parsing for <path> elements
-            for path_element in root.findall(f".//{svg_ns}path"):
-                d_attr = path_element.get("d")
-                if d_attr:
-                    points = []
-                    current_x, current_y = 0.0, 0.0
-                    path_commands = d_attr.replace(',', ' ').split()
-
-                    i = 0
-                    while i < len(path_commands):
-                        command = path_commands[i]
-                        i += 1
-
-                        if command == 'M' or command == 'm':
-                            x = float(path_commands[i])
-                            y = float(path_commands[i+1])
-                            i += 2
-                            if command == 'm':
-                                current_x += x
-                                current_y += y
-                            else:
-                                current_x = x
-                                current_y = y
-                            if points:
-                                msp.add_lwpolyline(points)
-                                points = []
-                            points.append((current_x, current_y))
-
-                        elif command == 'L' or command == 'l':
-                            x = float(path_commands[i])
-                            y = float(path_commands[i+1])
-                            i += 2
-                            if command == 'l':
-                                current_x += x
-                                current_y += y
-                            else:
-                                current_x = x
-                                current_y = y
-                            points.append((current_x, current_y))
-
-                        elif command == 'H' or command == 'h':
-                            val = float(path_commands[i])
-                            i += 1
-                            if command == 'h':
-                                current_x += val
-                            else:
-                                current_x = val
-                            points.append((current_x, current_y))
-
-                        elif command == 'V' or command == 'v':
-                            val = float(path_commands[i])
-                            i += 1
-                            if command == 'v':
-                                current_y += val
-                            else:
-                                current_y = val
-                            points.append((current_x, current_y))
-
-                        elif command == 'Z' or command == 'z':
-                            if points:
-                                if points[0] != points[-1]:
-                                    points.append(points[0])
-                                msp.add_lwpolyline(points, close=True)
-                                points = []
-                        else:
-                            while i < len(path_commands) and (path_commands[i][0].isdigit() or path_commands[i][0] == '-' or path_commands[i][0] == '.'):
-                                i += 1
-
-                    if points:
-                        msp.add_lwpolyline(points)
-
-            # Handle <rect> elements
-            for rect_element in root.findall(f".//{svg_ns}rect"):
-                x = float(rect_element.get('x', 0))
-                y = float(rect_element.get('y', 0))
-                width = float(rect_element.get('width', 0))
-                height = float(rect_element.get('height', 0))
-                if width > 0 and height > 0:
-                    points = [
-                        (x, y),
-                        (x + width, y),
-                        (x + width, y + height),
-                        (x, y + height),
-                        (x, y)
-                    ]
-                    msp.add_lwpolyline(points, close=True)
-
-            # Handle <circle> elements
-            for circle_element in root.findall(f".//{svg_ns}circle"):
-                cx = float(circle_element.get('cx', 0))
-                cy = float(circle_element.get('cy', 0))
-                r = float(circle_element.get('r', 0))
-                if r > 0:
-                    msp.add_circle((cx, cy), r)
-
-            # Handle <ellipse> elements
-            for ellipse_element in root.findall(f".//{svg_ns}ellipse"):
-                cx = float(ellipse_element.get('cx', 0))
-                cy = float(ellipse_element.get('cy', 0))
-                rx = float(ellipse_element.get('rx', 0))
-                ry = float(ellipse_element.get('ry', 0))
-                if rx > 0 and ry > 0:
-                    msp.add_ellipse(center=(cx, cy), major_axis=(rx, 0), ratio=ry/rx)
-
-            # Handle <line> elements
-            for line_element in root.findall(f".//{svg_ns}line"):
-                x1 = float(line_element.get('x1', 0))
-                y1 = float(line_element.get('y1', 0))
-                x2 = float(line_element.get('x2', 0))
-                y2 = float(line_element.get('y2', 0))
-                msp.add_line((x1, y1), (x2, y2))
-
-            # Handle <polyline> elements
-            for polyline_element in root.findall(f".//{svg_ns}polyline"):
-                points_str = polyline_element.get('points', '')
-                if points_str:
-                    points = []
-                    for pair in points_str.split():
-                        coords = pair.split(',')
-                        if len(coords) == 2:
-                            points.append((float(coords[0]), float(coords[1])))
-                    if points:
-                        msp.add_lwpolyline(points)
-
-            # Handle <polygon> elements
-            for polygon_element in root.findall(f".//{svg_ns}polygon"):
-                points_str = polygon_element.get('points', '')
-                if points_str:
-                    points = []
-                    for pair in points_str.split():
-                        coords = pair.split(',')
-                        if len(coords) == 2:
-                            points.append((float(coords[0]), float(coords[1])))
-                    if points:
-                        msp.add_lwpolyline(points, close=True)
-
-            # Handle <text> elements
-            for text_element in root.findall(f".//{svg_ns}text"):
-                x = float(text_element.get('x', 0))
-                y = float(text_element.get('y', 0))
-                text_content = text_element.text or ""
-                font_size = float(text_element.get('font-size', '12').replace('px', ''))
-                msp.add_text(text_content, dxfattribs={
-                    'height': font_size,
-                    'insert': (x, y),
-                    'halign': 0,
-                    'valign': 0
-                })
-
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".dxf") as temp_dxf_file:
-                temp_dxf_file.write(doc.getvalue().encode('utf-8')) # Save DXF content to bytes
-                temp_dxf_path = temp_dxf_file.name
-
-            with open(temp_dxf_path, "rb") as f:
-                dxf_bytes = f.read()
-
-            st.success("SVG successfully exported to DXF!")
-            return dxf_bytes
+            stats = add_svg_to_layout(doc.modelspace(), svg_content, tolerance, simplify)
+            dxf_buffer = write_dxf_to_buffer(doc, compress=compress, arcname=arcname)
+
+            st.success(f"SVG successfully exported to DXF! {format_simplify_stats(stats)}.")
+            return dxf_buffer
 
         except ET.ParseError as e:
             st.error(f"DXF export failed: The SVG content is malformed or contains unsupported features.")
@@ -1172,9 +4153,479 @@ def convert_svg_to_dxf(svg_content):
         except Exception as e:
             st.error(f"An error occurred during DXF export. Ensure the SVG content is suitable for DXF conversion.")
             return None
-        finally:
-            if temp_dxf_path and os.path.exists(temp_dxf_path):
-                os.remove(temp_dxf_path)
+
+# --- Vectorization Queue ---
+
+# Per backend: vectorizations running at once on this server, and attempts per job. Remote
+# failures are usually transient and retried with exponential backoff; local ones are not.
+VECTORIZER_LIMITS = {
+    "Remote (Hugging Face Space)": (int(os.getenv("VECTORIZER_REMOTE_CONCURRENCY", "2")), 4),
+    "Local (offline)": (int(os.getenv("VECTORIZER_LOCAL_CONCURRENCY", str(max(1, (os.cpu_count() or 2) // 2)))), 1),
+}
+# First retry delay in seconds, doubled per attempt with jitter, and its upper bound.
+VECTORIZE_RETRY_DELAY = 2.0
+VECTORIZE_RETRY_MAX_DELAY = 60.0
+# Finished jobs nobody collected are dropped after this many seconds.
+VECTORIZE_JOB_TTL = 3600
+# Seconds between refreshes of the job list while it is shown.
+VECTORIZE_POLL_SECONDS = 2
+
+class VectorizationJob:
+    """One image queued for vectorization, with its retry state and result."""
+
+    ACTIVE = ('queued', 'running', 'retrying')
+
+    def __init__(self, image, name, backend, params, preprocess=None):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.backend = backend
+        self.params = dict(params)
+        self.image = image
+        self.preprocess = preprocess
+        self.preprocess_report = ""
+        self.status = 'queued'
+        self.attempts = 0
+        self.not_before = 0.0
+        self.error = ""
+        self.svg = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    def describe(self):
+        """Returns a short human-readable status."""
+        if self.status == 'retrying':
+            wait = max(0.0, self.not_before - time.monotonic())
+            return f"Retrying in {wait:.0f} s (attempt {self.attempts + 1}) after: {self.error}"
+        if self.status == 'running':
+            return f"Running (attempt {self.attempts + 1})" if self.attempts else "Running"
+        if self.status == 'done':
+            return f"Done in {self.finished_at - self.submitted_at:.1f} s"
+        if self.status == 'failed':
+            return f"Failed after {self.attempts} attempt{'s' if self.attempts != 1 else ''}: {self.error}"
+        return "Queued"
+
+class VectorizationQueue:
+    """Server-wide queue running vectorization jobs in background threads, shared by all sessions.
+
+    At most limits[backend][0] jobs of a backend run at once; failed attempts are retried up to
+    limits[backend][1] attempts in total, waiting exponentially longer each time.
+    """
+
+    def __init__(self, limits, retry_delay=VECTORIZE_RETRY_DELAY, max_delay=VECTORIZE_RETRY_MAX_DELAY, ttl=VECTORIZE_JOB_TTL):
+        self.limits = limits
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, image, name, backend, params, preprocess=None):
+        """Queues an image, to be preprocessed with the given options first, and returns its job.
+
+        The image must not change afterwards.
+        """
+        job = VectorizationJob(image, name, backend, params, preprocess)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._schedule()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._schedule()
+            return self._jobs.get(job_id)
+
+    def retry(self, job_id):
+        """Queues a failed job again with a fresh attempt budget."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.status == 'failed' and job.image is not None:
+                job.status, job.attempts, job.not_before, job.error = 'queued', 0, 0.0, ""
+                job.submitted_at = time.time()
+                self._schedule()
+
+    def remove(self, job_id):
+        """Forgets a job; a running attempt finishes in the background and is discarded."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _schedule(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.status not in VectorizationJob.ACTIVE and now - job.finished_at > self.ttl]:
+            del self._jobs[job_id]
+        running = defaultdict(int)
+        for job in self._jobs.values():
+            if job.status == 'running':
+                running[job.backend] += 1
+        for job in self._jobs.values():
+            if job.status == 'retrying' and job.not_before <= time.monotonic():
+                job.status = 'queued'
+            if job.status == 'queued' and running[job.backend] < self.limits[job.backend][0]:
+                job.status = 'running'
+                running[job.backend] += 1
+                threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        vectorize = VECTORIZER_BACKENDS[job.backend][0]
+        try:
+            if job.preprocess is not None and not job.preprocess_report:
+                job.image, job.preprocess_report = prepare_image(job.image, job.preprocess)
+            svg, error = vectorize(job.image, job.params), ""
+            if not svg:
+                raise RuntimeError("No SVG content received.")
+        except Exception as ex:
+            svg, error = None, str(ex) or type(ex).__name__
+        with self._lock:
+            job.attempts += 1
+            job.error = error
+            if svg is not None:
+                job.status, job.svg, job.image = 'done', svg, None
+                job.finished_at = time.time()
+            elif job.attempts < self.limits[job.backend][1]:
+                delay = min(self.max_delay, self.retry_delay * 2 ** (job.attempts - 1)) * random.uniform(0.5, 1.0)
+                job.status, job.not_before = 'retrying', time.monotonic() + delay
+                timer = threading.Timer(delay, self._wake)
+                timer.daemon = True
+                timer.start()
+            else:
+                job.status = 'failed'
+                job.finished_at = time.time()
+            self._schedule()
+
+    def _wake(self):
+        with self._lock:
+            self._schedule()
+
+@st.cache_resource
+def get_vectorization_queue():
+    """Returns the process-wide vectorization job queue."""
+    return VectorizationQueue(VECTORIZER_LIMITS)
+
+# --- PDF Vector Extraction ---
+
+# Cubic Béziers deviating from a circle by less than this fraction of its radius become arcs; the
+# standard four-curve circle deviates by 2.7e-4.
+PDF_ARC_RELATIVE_ERROR = 5e-4
+# DXF text height (cap height) as a fraction of the PDF font size.
+PDF_TEXT_CAP_HEIGHT = 0.7
+
+def _cubic_circles(curves, tolerance):
+    """Finds the (k, 4, 2) cubics that are circular arcs.
+
+    Returns a mask of circular curves, their centers, radii, start and end angles in degrees
+    ordered counterclockwise, and whether the curves run clockwise.
+    """
+    a, b = curves[:, 0], curves[:, 3]
+    bezier = lambda t: ((1 - t) ** 3 * a + 3 * (1 - t) ** 2 * t * curves[:, 1]
+                        + 3 * (1 - t) * t ** 2 * curves[:, 2] + t ** 3 * b)
+    m = bezier(0.5)
+    # Circumcenter of the start, middle and end points.
+    ab, am = b - a, m - a
+    cross = ab[:, 0] * am[:, 1] - ab[:, 1] * am[:, 0]
+    valid = np.abs(cross) > 1e-12 * np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-300)
+    denominator = np.where(valid, 2 * cross, 1)
+    ab2, am2 = np.einsum('ij,ij->i', ab, ab), np.einsum('ij,ij->i', am, am)
+    center = a + np.column_stack([am[:, 1] * ab2 - ab[:, 1] * am2, ab[:, 0] * am2 - am[:, 0] * ab2]) / denominator[:, None]
+    radius = np.hypot(*(a - center).T)
+    allowed = np.maximum(tolerance, PDF_ARC_RELATIVE_ERROR * radius)
+    for t in (0.25, 0.75):
+        valid &= np.abs(np.hypot(*(bezier(t) - center).T) - radius) <= allowed
+    # The handles must be tangent to the circle at both ends.
+    for end, handle in ((a, curves[:, 1]), (b, curves[:, 2])):
+        radial, tangent = end - center, handle - end
+        length = np.hypot(*tangent.T) * radius
+        valid &= (length == 0) | (np.abs(np.einsum('ij,ij->i', radial, tangent)) <= 1e-3 * np.maximum(length, 1e-300))
+    start = np.degrees(np.arctan2(a[:, 1] - center[:, 1], a[:, 0] - center[:, 0]))
+    end = np.degrees(np.arctan2(b[:, 1] - center[:, 1], b[:, 0] - center[:, 0]))
+    clockwise = cross > 0
+    return valid, center, radius, np.where(clockwise, end, start), np.where(clockwise, start, end), clockwise
+
+def extract_pdf_vectors(page, tolerance=SVG_CURVE_TOLERANCE):
+    """Reads the vector paths and text spans of a PyMuPDF page as plain, picklable DXF-ready data.
+
+    Coordinates are in PDF points with the y axis pointing up. Connected segments become polylines
+    (single segments lines), circular Bézier runs become arcs or circles, and other curves are
+    flattened within tolerance. 'scanned' is set for pages holding images but no vector geometry.
+    """
+    height = page.rect.height
+    drawings = page.get_drawings()
+    flip = lambda p: (p.x, height - p.y)
+
+    curves = [item[1:5] for path in drawings for item in path['items'] if item[0] == 'c']
+    if curves:
+        curves = np.array([[flip(p) for p in curve] for curve in curves], dtype=float).reshape(-1, 4, 2)
+        circular, centers, radii, starts, ends, clockwise = _cubic_circles(curves, tolerance)
+        owner, flat = flatten_cubics(curves[:, 0], curves[:, 1], curves[:, 2], curves[:, 3], tolerance)
+        flat_starts = np.searchsorted(owner, np.arange(len(curves) + 1))
+
+    vectors = {'lines': [], 'polylines': [], 'arcs': [], 'circles': [], 'texts': []}
+    chain = []
+    arc = None
+
+    def finish_chain(closed=False):
+        nonlocal chain
+        if len(chain) > 3 and chain[0] == chain[-1]:
+            chain, closed = chain[:-1], True
+        if len(chain) == 2 and not closed:
+            vectors['lines'].append(tuple(chain))
+        elif len(chain) >= 2:
+            vectors['polylines'].append((chain, closed))
+        chain = []
+
+    def finish_arc():
+        nonlocal arc
+        if arc is not None:
+            center, radius, start, end, sweep, last_point, _, first_point = arc
+            if last_point == first_point and sweep > 180:
+                vectors['circles'].append((center, radius))
+            else:
+                vectors['arcs'].append((center, radius, start, end))
+        arc = None
+
+    def add_points(start, points):
+        nonlocal chain
+        finish_arc()
+        if not chain or chain[-1] != start:
+            finish_chain()
+            chain = [start]
+        chain.extend(points)
+
+    def add_arc(k):
+        # Consecutive arcs of one circle, running the same way, are joined.
+        nonlocal arc
+        finish_chain()
+        center, radius = (float(centers[k, 0]), float(centers[k, 1])), float(radii[k])
+        start, end, sweep = float(starts[k]), float(ends[k]), float((ends[k] - starts[k]) % 360)
+        if (arc is not None and arc[6] == clockwise[k] and arc[5] == tuple(curves[k, 0].tolist())
+                and np.hypot(center[0] - arc[0][0], center[1] - arc[0][1]) <= tolerance and abs(radius - arc[1]) <= tolerance):
+            start, end = (start, arc[3]) if clockwise[k] else (arc[2], end)
+            arc = (arc[0], arc[1], start, end, arc[4] + sweep, tuple(curves[k, 3].tolist()), arc[6], arc[7])
+            return
+        finish_arc()
+        arc = (center, radius, start, end, sweep, tuple(curves[k, 3].tolist()), clockwise[k], tuple(curves[k, 0].tolist()))
+
+    k = 0
+    for path in drawings:
+        for item in path['items']:
+            kind = item[0]
+            if kind == 'l':
+                add_points(flip(item[1]), [flip(item[2])])
+            elif kind == 'c':
+                if circular[k]:
+                    add_arc(k)
+                else:
+                    add_points(flip(item[1]), [tuple(p) for p in flat[flat_starts[k]:flat_starts[k + 1]].tolist()])
+                k += 1
+            elif kind in ('re', 'qu'):
+                finish_arc()
+                finish_chain()
+                quad = item[1].quad if kind == 're' else item[1]
+                vectors['polylines'].append(([flip(quad.ul), flip(quad.ur), flip(quad.lr), flip(quad.ll)], True))
+        finish_arc()
+        finish_chain(closed=bool(path.get('closePath')))
+
+    for block in page.get_text("dict")['blocks']:
+        for line in block.get('lines', ()):
+            rotation = float(np.degrees(np.arctan2(-line['dir'][1], line['dir'][0])))
+            for span in line['spans']:
+                text = span['text'].strip()
+                if text:
+                    vectors['texts'].append((text, flip(fitz.Point(span['origin'])),
+                                             span['size'] * PDF_TEXT_CAP_HEIGHT, rotation))
+
+    vectors['scanned'] = not any(vectors[kind] for kind in ('lines', 'polylines', 'arcs', 'circles')) and bool(page.get_images())
+    return vectors
+
+def add_pdf_vectors_to_layout(layout, vectors):
+    """Writes extract_pdf_vectors() output as LINE, LWPOLYLINE, ARC, CIRCLE and TEXT entities."""
+    for start, end in vectors['lines']:
+        layout.add_line(start, end)
+    for points, closed in vectors['polylines']:
+        layout.add_lwpolyline(points, close=closed)
+    for center, radius, start, end in vectors['arcs']:
+        layout.add_arc(center, radius, start, end)
+    for center, radius in vectors['circles']:
+        layout.add_circle(center, radius)
+    for text, insert, height, rotation in vectors['texts']:
+        layout.add_text(text, dxfattribs={'height': height, 'insert': insert, 'rotation': rotation})
+
+def count_pdf_vectors(vectors):
+    """Returns the number of DXF entities extract_pdf_vectors() output turns into."""
+    return sum(len(vectors[kind]) for kind in ('lines', 'polylines', 'arcs', 'circles', 'texts'))
+
+# --- PDF Batch Conversion ---
+
+# Pixels a PDF page is rendered to when no resolution is given, and the resolution bounds then applied.
+PDF_PIXEL_BUDGET = int(float(os.getenv("PDF_PIXEL_BUDGET_MP", "16")) * 1_000_000)
+PDF_MIN_DPI = 72
+PDF_MAX_DPI = 400
+# Pages above this many pixels are rendered in horizontal bands of at most this size.
+PDF_TILE_PIXELS = 4_000_000
+# Processes converting PDF pages at once in a batch.
+PDF_PAGE_WORKERS = int(os.getenv("PDF_PAGE_WORKERS", str(os.cpu_count() or 1)))
+PDF_OUTPUT_MODES = {
+    "One DXF per page (.zip)": 'files',
+    "One DXF with a layout per page": 'layouts',
+}
+
+def parse_page_selection(text, page_count):
+    """Parses a selection such as "1-3, 7" into sorted zero-based page numbers; empty selects all pages."""
+    if not text.strip():
+        return list(range(page_count))
+    pages = set()
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError(f"'{part}' is not a page number or range.")
+        first, last = int(first), int(last or first)
+        if not 1 <= first <= last <= page_count:
+            raise ValueError(f"Page range {part} is outside 1-{page_count}.")
+        pages.update(range(first - 1, last))
+    return sorted(pages)
+
+def pdf_page_dpi(page, pixel_budget=PDF_PIXEL_BUDGET):
+    """Returns the resolution at which a page fills the pixel budget, within PDF_MIN_DPI and PDF_MAX_DPI."""
+    square_inches = page.rect.width * page.rect.height / 72 ** 2
+    return float(np.clip(np.sqrt(pixel_budget / max(square_inches, 1e-6)), PDF_MIN_DPI, PDF_MAX_DPI))
+
+def render_pdf_page(page, dpi=None, tile_pixels=PDF_TILE_PIXELS):
+    """Renders a PyMuPDF page into an RGB PIL image at dpi (default: from the pixel budget), recording it.
+
+    Pixmap samples are copied straight into the image. Pages above tile_pixels are rendered in
+    bands, so that besides the image only one band is held at a time.
+    """
+    dpi = dpi or pdf_page_dpi(page)
+    matrix = fitz.Matrix(dpi / 72, dpi / 72)
+    rect = page.rect
+    full = fitz.IRect(*(rect * matrix).irect)
+    if full.width * full.height <= tile_pixels:
+        pix = page.get_pixmap(matrix=matrix, alpha=False)
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride)
+    else:
+        image = Image.new("RGB", (full.width, full.height), "white")
+        band = max(1, tile_pixels // full.width)
+        for top in range(0, full.height, band):
+            clip = fitz.Rect(rect.x0, rect.y0 + top * 72 / dpi, rect.x1, rect.y0 + min(full.height, top + band) * 72 / dpi)
+            pix = page.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+            image.paste(Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride),
+                        (pix.x - full.x0, pix.y - full.y0))
+            del pix
+    image.info['dpi'] = (dpi, dpi)
+    return image
+
+def traced_page_transform(rect, dpi, box, size):
+    """Returns the 3x3 matrix mapping pixels of a traced page image to PDF points with the y axis up.
+
+    The page, of PyMuPDF rect (x0, y0, x1, y1), was rendered at dpi, cropped to box (render pixels)
+    and resized to size; the result shares the frame of extract_pdf_vectors().
+    """
+    scale_x = (box[2] - box[0]) / size[0] * 72 / dpi
+    scale_y = (box[3] - box[1]) / size[1] * 72 / dpi
+    height = rect[3] - rect[1]
+    return np.array([[scale_x, 0, rect[0] + box[0] * 72 / dpi],
+                     [0, -scale_y, height - rect[1] - box[1] * 72 / dpi],
+                     [0, 0, 1]])
+
+def _convert_pdf_page(pdf_path, page_number, backend, params, tolerance, write_dxf, extract_vectors=True, preprocess=None,
+                      dpi=None, simplify=None):
+    """Pool worker converting one PDF page; returns a dict with its geometry, its DXF bytes if asked for, and timing.
+
+    Pages holding vector paths or text are read directly (see extract_pdf_vectors()), scanned pages
+    are rendered (at dpi, by default from the pixel budget but no finer than the preprocessing
+    target), preprocessed if asked for, and traced by the vectorizer backend; 'transform' then maps
+    the traced pixels to page points, see traced_page_transform(). Failures are
+    returned in 'error' so that one bad page does not stop the batch.
+    """
+    started = time.perf_counter()
+    outcome = {'page': page_number, 'vectors': None, 'svg': None, 'transform': None, 'dxf': None, 'error': ""}
+    try:
+        with fitz.open(pdf_path) as pdf:
+            page = pdf.load_page(page_number)
+            if extract_vectors:
+                vectors = extract_pdf_vectors(page, tolerance)
+                if not vectors['scanned']:
+                    outcome['vectors'] = vectors
+            if outcome['vectors'] is None:
+                if dpi is None and preprocess is not None and preprocess['target_dpi']:
+                    dpi = min(pdf_page_dpi(page), preprocess['target_dpi'])
+                dpi = dpi or pdf_page_dpi(page)
+                image = render_pdf_page(page, dpi)
+                rect = tuple(page.rect)
+        if outcome['vectors'] is None:
+            box = (0, 0) + image.size
+            if preprocess is not None:
+                image, report = preprocess_image(image, **preprocess)
+                box = report['crop'] or box
+            outcome['svg'] = VECTORIZER_BACKENDS[backend][0](image, params)
+            outcome['transform'] = traced_page_transform(rect, dpi, box, image.size)
+        if write_dxf:
+            doc = ezdxf.new("R2010")
+            outcome['stats'] = add_pdf_page_to_layout(doc.modelspace(), outcome, tolerance, simplify)
+            outcome['dxf'] = write_dxf_to_buffer(doc).getvalue()
+    except Exception as ex:
+        outcome['error'] = str(ex) or type(ex).__name__
+    outcome['seconds'] = time.perf_counter() - started
+    return outcome
+
+def add_pdf_page_to_layout(layout, outcome, tolerance, simplify=None):
+    """Writes a converted page, extracted vectors or traced SVG, to a DXF layout.
+
+    Traced pages are mapped from image pixels to the PDF points, y axis up, of extracted vectors.
+
+    Returns the add_svg_to_layout() counts for traced pages, else None.
+    """
+    if outcome['vectors'] is not None:
+        add_pdf_vectors_to_layout(layout, outcome['vectors'])
+        return None
+    return add_svg_to_layout(layout, outcome['svg'], tolerance, simplify, outcome['transform'])
+
+def iter_converted_pdf_pages(pdf_path, pages, backend, params, tolerance, write_dxf, extract_vectors=True,
+                             preprocess=None, dpi=None, simplify=None, workers=PDF_PAGE_WORKERS):
+    """Converts PDF pages, yielding each page's outcome as soon as it is done.
+
+    Pages traced by the local backend are converted in a process pool; the remote backend waits on
+    the network and converts pages here one by one, using this process's Space client.
+    """
+    args = (backend, params, tolerance, write_dxf, extract_vectors, preprocess, dpi, simplify)
+    if workers <= 1 or len(pages) == 1 or VECTORIZER_BACKENDS[backend][0] is not vectorize_image_locally:
+        for page_number in pages:
+            yield _convert_pdf_page(pdf_path, page_number, *args)
+        return
+    pool = concurrent.futures.ProcessPoolExecutor(min(workers, len(pages)), mp_context=_MP_CONTEXT)
+    try:
+        futures = [pool.submit(_WorkerFunction(_convert_pdf_page), pdf_path, page_number, *args) for page_number in pages]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+    finally:
+        # A rerun or stop closes this generator; pages not yet started are dropped rather than waited for.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def assemble_pdf_dxf(outcomes, mode, base_name, tolerance, compress=False, simplify=None):
+    """Packs converted pages into a download; returns (buffer, file name, mime type).
+
+    'files' zips one DXF per page, 'layouts' writes a single DXF with a paper space layout per page.
+    """
+    outcomes = sorted((o for o in outcomes if not o['error']), key=lambda o: o['page'])
+    if mode == 'files':
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for outcome in outcomes:
+                archive.writestr(f"{base_name}_page{outcome['page'] + 1:03d}.dxf", outcome['dxf'])
+        buffer.seek(0)
+        return buffer, f"{base_name}_pages.zip", "application/zip"
+
+    doc = ezdxf.new("R2010")
+    for outcome in outcomes:
+        outcome['stats'] = add_pdf_page_to_layout(doc.layouts.new(f"Page {outcome['page'] + 1}"), outcome, tolerance, simplify)
+    if outcomes:
+        doc.layouts.delete("Layout1")
+    buffer = write_dxf_to_buffer(doc, compress=compress, arcname=f"{base_name}.dxf")
+    if compress:
+        return buffer, f"{base_name}.zip", "application/zip"
+    return buffer, f"{base_name}.dxf", "application/dxf"
 
 # --- Streamlit UI Functions ---
 
@@ -1186,20 +4637,26 @@ def cad_analyzer_section():
     uploaded_file = st.file_uploader("Upload DXF File", type=["dxf"], key="dxf_uploader")
 
     if uploaded_file is not None:
-        temp_file_path = None
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".dxf") as temp_file:
-                temp_file.write(uploaded_file.read())
-                temp_file_path = temp_file.name
-
-            doc = ezdxf.readfile(temp_file_path)
-            msp = doc.modelspace()
-
-            st.session_state.doc = doc
-            st.session_state.msp = msp
-            st.session_state.entity_summary, st.session_state.layers = get_entity_summary(msp)
-            st.session_state.visualization_description = ""
-            st.session_state.chat_history = []  # No system message
+            file_bytes = uploaded_file.getvalue()
+            file_hash = hash_file_bytes(file_bytes)
+            drawing = load_parsed_drawing(file_hash, file_bytes)
+            if drawing is None:
+                return
+            geometry = drawing['geometry']
+
+            st.session_state.geometry = geometry
+            st.session_state.entity_summary = drawing['entity_summary']
+            st.session_state.layers = drawing['layers']
+            if st.session_state.get('dxf_file_hash') != file_hash:
+                # Only a newly uploaded drawing resets the per-drawing session state.
+                st.session_state.dxf_file_hash = file_hash
+                st.session_state.visualization_description = drawing['visualization_description']
+                st.session_state.show_entity_details = False
+                st.session_state.show_visualization = False
+                st.session_state.show_line_cleanup = False
+                st.session_state.chat_history = []
+                st.session_state.chat_summary = new_chat_summary()
 
             st.success(f"Successfully loaded DXF file: **{uploaded_file.name}**")
 
@@ -1213,8 +4670,7 @@ def cad_analyzer_section():
 
             with col1:
                 if st.button("🔍 View Entity Details", key="view_details_btn"):
-                    with st.expander("Detailed Entity Information", expanded=True):
-                        st.text_area("Details", get_entity_details(msp), height=300)
+                    st.session_state.show_entity_details = not st.session_state.show_entity_details
 
             with col2:
                 if st.button("📄 Show Layers", key="show_layers_btn"):
@@ -1224,31 +4680,79 @@ def cad_analyzer_section():
                         else:
                             st.info("No layers found in the DXF file.")
 
+            if st.session_state.show_entity_details:
+                with st.expander("Detailed Entity Information", expanded=True):
+                    filter_col1, filter_col2 = st.columns(2)
+                    with filter_col1:
+                        detail_types = st.multiselect("Entity types", sorted(st.session_state.entity_summary), key="details_types")
+                    with filter_col2:
+                        detail_layers = st.multiselect("Layers", sorted(st.session_state.layers), key="details_layers")
+                    detail_types, detail_layers = tuple(detail_types), tuple(detail_layers)
+                    indices = filter_entity_indices(file_hash, geometry, detail_types, detail_layers)
+                    if len(indices):
+                        page_count = (len(indices) + DETAILS_PAGE_SIZE - 1) // DETAILS_PAGE_SIZE
+                        page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1, key="details_page") - 1
+                        first = page * DETAILS_PAGE_SIZE
+                        st.caption(f"🔍 Entities {first + 1}–{min(first + DETAILS_PAGE_SIZE, len(indices))} of {len(indices)} (page {page + 1} of {page_count})")
+                        st.text_area("Details", get_entity_details_page(file_hash, geometry, detail_types, detail_layers, page), height=300)
+                    else:
+                        st.info("No entities match the selected filters.")
+
+            if len(geometry.line_index):
+                with st.expander("🧹 Duplicate & Overlapping Lines"):
+                    line_cleanup_section(file_hash, file_bytes, uploaded_file.name, geometry)
+
             st.markdown("<h4 class='section-header'>📈 Drawing Visualization</h4>", unsafe_allow_html=True)
             if st.button("Visualize Drawing", key="visualize_btn"):
-                fig, viz_desc = plot_dxf_drawing(msp)
+                st.session_state.show_visualization = True
+
+            if st.session_state.show_visualization:
+                spatial_index = drawing['spatial_index']
+                viewport = None
+                if not geometry.has_3d and spatial_index.extent is not None:
+                    (min_x, min_y), (max_x, max_y) = spatial_index.extent
+                    if max_x > min_x and max_y > min_y:
+                        with st.expander("🔎 Zoom to Region"):
+                            full_x, full_y = (float(min_x), float(max_x)), (float(min_y), float(max_y))
+                            x_range = st.slider("X range", full_x[0], full_x[1], full_x, key="zoom_x")
+                            y_range = st.slider("Y range", full_y[0], full_y[1], full_y, key="zoom_y")
+                        if x_range != full_x or y_range != full_y:
+                            viewport = (x_range[0], y_range[0], x_range[1], y_range[1])
+
+                png, viz_desc, render_stats = render_drawing_png(file_hash, geometry, spatial_index, viewport)
                 st.session_state.visualization_description = viz_desc
-                if fig:
-                    st.pyplot(fig)
+                if drawing['visualization_description'] != viz_desc:
+                    drawing['visualization_description'] = viz_desc
+                    update_sidecar_description(file_hash, viz_desc)
+                if png:
+                    st.image(png, use_container_width=True)
                     st.info("Drawing visualized.")
+                    st.caption(
+                        f"Rendered {render_stats['drawn']} of {render_stats['total']} entities: "
+                        f"{render_stats['culled']} outside the view, {render_stats['collapsed']} collapsed below "
+                        f"{LOD_MIN_PIXELS:g}px, {render_stats['hidden_labels']} labels too small to read."
+                    )
                 else:
                     st.warning(viz_desc)
-                plt.close(fig)
 
             st.markdown("<h4 class='section-header'>🤖 AI-Powered Analysis</h4>", unsafe_allow_html=True)
-            if st.session_state.llm_client_ready:
+            if llm_client_ready():
                 if st.button("Generate AI Summary", key="llm_summary_btn"):
-                    summary = generate_llm_summary(
-                        msp,
-                        st.session_state.entity_summary,
-                        st.session_state.visualization_description
-                    )
                     st.markdown("---")
                     st.subheader("AI Summary:")
-                    st.write(summary)
+                    metrics = {}
+                    st.write_stream(generate_llm_summary(
+                        drawing['annotation_index'],
+                        st.session_state.entity_summary,
+                        st.session_state.visualization_description,
+                        metrics=metrics
+                    ))
+                    if metrics:
+                        st.session_state.llm_metrics.append(metrics)
+                        st.caption(format_llm_metrics(metrics))
                     st.markdown("---")
             else:
-                st.warning("AI services not available. AI summary generation disabled.")
+                st.warning(f"AI services not available. AI summary generation disabled. {service_unavailable_reason('llm')}")
 
             st.markdown("<h4 class='section-header'>💬 CAD Chatbot</h4>", unsafe_allow_html=True)
 
@@ -1257,7 +4761,7 @@ def cad_analyzer_section():
                     st.markdown(message["content"])
 
             if prompt := st.chat_input("Type your question here..."):
-                if not st.session_state.llm_client_ready:
+                if not llm_client_ready():
                     st.warning("AI services not available. Chatbot disabled.")
                     st.session_state.chat_history.append({"role": "user", "content": prompt})
                     with st.chat_message("user"):
@@ -1266,48 +4770,91 @@ def cad_analyzer_section():
                         st.markdown("Chatbot is currently unavailable.")
                     return
 
-                st.session_state.chat_history.append({"role": "user", "content": prompt})
                 with st.chat_message("user"):
                     st.markdown(prompt)
 
-                bot_response = generate_chatbot_response(
-                    prompt,
-                    st.session_state.entity_summary,
-                    st.session_state.layers,
-                    st.session_state.visualization_description,
-                    st.session_state.chat_history
-                )
-                st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
                 with st.chat_message("assistant"):
-                    st.markdown(bot_response)
+                    metrics = {}
+                    bot_response = st.write_stream(generate_chatbot_response(
+                        prompt,
+                        st.session_state.entity_summary,
+                        st.session_state.layers,
+                        st.session_state.visualization_description,
+                        drawing['annotation_index'],
+                        drawing['query_engine'],
+                        st.session_state.chat_history,
+                        st.session_state.chat_summary,
+                        metrics=metrics
+                    ))
+                    if metrics.get('total') is not None:
+                        st.session_state.llm_metrics.append(metrics)
+                        st.caption(format_llm_metrics(metrics))
+                st.session_state.chat_history.append({"role": "user", "content": prompt})
+                st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
 
         except ezdxf.DXFStructureError as e:
             st.error("Error reading DXF file: The file might be corrupted or invalid. Please ensure it's a valid DXF.")
-            st.session_state.doc = None
-            st.session_state.msp = None
+            st.session_state.geometry = None
             st.session_state.entity_summary = {}
             st.session_state.layers = set()
             st.session_state.visualization_description = ""
+            st.session_state.dxf_file_hash = None
         except UnicodeDecodeError as e:
             st.error("Encoding error while reading DXF file. The DXF file might contain unsupported characters. Please check the file's integrity.")
-            st.session_state.doc = None
-            st.session_state.msp = None
+            st.session_state.geometry = None
             st.session_state.entity_summary = {}
             st.session_state.layers = set()
             st.session_state.visualization_description = ""
+            st.session_state.dxf_file_hash = None
         except Exception as e:
             st.error(f"An unexpected error occurred while processing the DXF file: {e}. Please try a different DXF file or contact support.")
-            st.session_state.doc = None
-            st.session_state.msp = None
+            st.session_state.geometry = None
             st.session_state.entity_summary = {}
             st.session_state.layers = set()
             st.session_state.visualization_description = ""
-        finally:
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+            st.session_state.dxf_file_hash = None
     else:
         st.info("Please upload a DXF file to get started with CAD analysis.")
 
+def line_cleanup_section(file_hash, file_bytes, file_name, geometry):
+    """Renders the duplicate and overlapping LINE report of a drawing, with a cleaned DXF download."""
+    st.caption("Finds LINE entities repeated on the same layer, in either direction, and collinear lines that overlap.")
+    tolerance = st.number_input("Snap tolerance (drawing units)", min_value=1e-6, value=LINE_DEDUP_TOLERANCE, step=1e-6,
+                                format="%.6f", key="dedup_tolerance",
+                                help="Endpoints closer than this count as the same point.")
+    if st.button("Find Duplicate Lines", key="find_duplicate_lines_btn"):
+        st.session_state.show_line_cleanup = True
+    if not st.session_state.show_line_cleanup:
+        return
+
+    report = get_line_cleanup_report(file_hash, geometry, tolerance)
+    exact, reversed_copies, overlapping = len(report['exact']), len(report['reversed']), len(report['overlapping'])
+    removed = exact + reversed_copies + overlapping
+    if not removed:
+        st.success(f"No duplicate or overlapping lines among {report['lines']:,} LINE entities ({report['seconds']:.2f} s).")
+        return
+    st.info(f"{removed:,} of {report['lines']:,} LINE entities are redundant: {exact:,} exact duplicates, "
+            f"{reversed_copies:,} reversed duplicates and {overlapping:,} overlapping lines merged into "
+            f"{len(report['merged']):,} ({report['seconds']:.2f} s).")
+    st.dataframe(line_cleanup_rows(geometry, report), use_container_width=True, hide_index=True)
+
+    compress = st.checkbox("Compress cleaned DXF (.zip)", key="compress_cleaned_dxf")
+    if st.button("Write Cleaned DXF", key="write_cleaned_dxf_btn"):
+        base_name = f"{os.path.splitext(file_name)[0]}_cleaned"
+        try:
+            with st.spinner("Writing cleaned DXF..."):
+                buffer = write_cleaned_dxf(file_bytes, geometry, report, compress, arcname=f"{base_name}.dxf")
+        except Exception as e:
+            st.error(f"Writing the cleaned DXF failed: {e}")
+            return
+        st.download_button(
+            label="Download Cleaned DXF (.zip)" if compress else "Download Cleaned DXF",
+            data=buffer,
+            file_name=f"{base_name}.zip" if compress else f"{base_name}.dxf",
+            mime="application/zip" if compress else "application/dxf",
+            key="download_cleaned_dxf_btn"
+        )
+
 def raster_to_vector_section():
     """Renders the Raster to Vector Converter section."""
     st.markdown("<h3 class='section-header'>🖼️ Raster to Vector Converter</h3>", unsafe_allow_html=True)
@@ -1317,6 +4864,9 @@ def raster_to_vector_section():
 
     st.markdown("---")
 
+    if st.session_state.vectorization_jobs:
+        vectorization_jobs_section()
+
     if uploaded_file is not None:
         file_extension = uploaded_file.name.split('.')[-1].lower()
         st.session_state.uploaded_file_name = uploaded_file.name
@@ -1325,7 +4875,11 @@ def raster_to_vector_section():
         if file_extension in ["png", "jpg", "jpeg"]:
             image_to_process = Image.open(uploaded_file)
         elif file_extension == "pdf":
-            image_to_process = extract_image_from_pdf(uploaded_file)
+            render_dpi = st.number_input("PDF render resolution (DPI, 0 = automatic)", min_value=0, max_value=1200, value=0,
+                                         step=50, key="pdf_render_dpi",
+                                         help=f"Automatic fits each page into {PDF_PIXEL_BUDGET / 1e6:g} megapixels.") or None
+            pdf_bytes = uploaded_file.getvalue()
+            image_to_process = extract_image_from_pdf(pdf_bytes, render_dpi)
 
         if image_to_process:
             st.session_state.current_image_pil = image_to_process
@@ -1333,35 +4887,61 @@ def raster_to_vector_section():
             st.subheader("Image Preview:")
             st.image(image_to_process, caption="Uploaded Image", use_container_width=True)
 
-            if st.session_state.gradio_client_ready:
+            backends = list(VECTORIZER_BACKENDS)
+            backend = st.selectbox("Vectorizer", backends, index=backends.index(DEFAULT_VECTORIZER_BACKEND),
+                                   key="vectorizer_backend",
+                                   help="The local engine runs offline; the remote Space usually gives smoother curves.")
+            vectorizer_params = vectorizer_settings()
+            preprocess_options = preprocessing_settings()
+
+            if vectorizer_ready(backend):
                 if st.button("Convert to SVG", key="convert_to_svg_btn"):
-                    svg_content = convert_image_to_svg(st.session_state.current_image_pil)
-                    if svg_content:
-                        st.session_state.last_svg_content = svg_content
-                        st.download_button(
-                            label="Download SVG",
-                            data=svg_content.encode("utf-8"),
-                            file_name=f"{os.path.splitext(st.session_state.uploaded_file_name)[0]}_vectorized.svg",
-                            mime="image/svg+xml",
-                            key="download_svg_btn"
-                        )
-                        st.info("SVG conversion complete. You can now export to DXF.")
-                    else:
-                        st.error("SVG conversion failed.")
+                    job = get_vectorization_queue().submit(st.session_state.current_image_pil.copy(),
+                                                           uploaded_file.name, backend, vectorizer_params,
+                                                           preprocess_options)
+                    st.session_state.vectorization_jobs.append(job.job_id)
+                    st.info(f"Queued as job **{job.job_id}**. You can queue more images while it runs; "
+                            "results appear under Vectorization jobs.")
             else:
-                st.warning("Vectorization services not available. SVG conversion disabled.")
+                st.warning(f"Vectorization services not available. SVG conversion disabled. {service_unavailable_reason('vectorizer')}")
+
+            if file_extension == "pdf":
+                pdf_conversion_section(pdf_bytes, os.path.splitext(uploaded_file.name)[0], backend, vectorizer_params,
+                                       preprocess_options, render_dpi)
+
+            with st.expander("Benchmark vectorizers"):
+                st.caption("Runs every available backend on this image with the settings above.")
+                if st.button("Run benchmark", key="benchmark_vectorizers_btn"):
+                    with st.spinner("Vectorizing with every backend..."):
+                        image = st.session_state.current_image_pil
+                        if preprocess_options is not None:
+                            image, preprocess_report = prepare_image(image, preprocess_options)
+                            st.caption(f"Preprocessed: {preprocess_report}")
+                        st.dataframe(benchmark_vectorizers(image, vectorizer_params),
+                                     use_container_width=True, hide_index=True)
 
             if st.session_state.get('last_svg_content'):
+                compress_dxf = st.checkbox("Compress DXF download (.zip)", key="compress_dxf",
+                                           help="Recommended for large drawings; DXF text typically compresses 5-10x.")
+                curve_tolerance = st.number_input("Curve tolerance (SVG units)", min_value=0.001, value=SVG_CURVE_TOLERANCE,
+                                                  step=0.05, format="%.3f", key="curve_tolerance",
+                                                  help="Maximum distance between SVG curves and the polyline chords replacing them in the DXF.")
+                simplify_tolerance = simplify_settings()
                 if st.button("Export to DXF", key="export_to_dxf_btn"):
-                    dxf_bytes = convert_svg_to_dxf(st.session_state.last_svg_content)
-                    if dxf_bytes:
+                    base_name = f"{os.path.splitext(st.session_state.last_svg_name or st.session_state.uploaded_file_name)[0]}_vectorized"
+                    dxf_buffer = convert_svg_to_dxf(st.session_state.last_svg_content, compress=compress_dxf, arcname=f"{base_name}.dxf",
+                                                    tolerance=curve_tolerance, simplify=simplify_tolerance)
+                    if dxf_buffer:
                         st.download_button(
-                            label="Download DXF",
-                            data=dxf_bytes,
-                            file_name=f"{os.path.splitext(st.session_state.uploaded_file_name)[0]}_vectorized.dxf",
-                            mime="application/dxf",
+                            label="Download DXF (.zip)" if compress_dxf else "Download DXF",
+                            data=dxf_buffer,
+                            file_name=f"{base_name}.zip" if compress_dxf else f"{base_name}.dxf",
+                            mime="application/zip" if compress_dxf else "application/dxf",
                             key="download_dxf_btn"
                         )
+                        dxf_size = dxf_buffer.getbuffer().nbytes
+                        if not compress_dxf and dxf_size > DXF_ZIP_SUGGEST_BYTES:
+                            st.info(f"The DXF is {dxf_size / (1024 * 1024):.1f} MB. Enable compression for a much smaller download.")
                     else:
                         st.error("DXF export failed.")
             else:
@@ -1373,6 +4953,113 @@ def raster_to_vector_section():
     else:
         st.info("Please upload an image or PDF file to get started with vectorization.")
 
+@st.fragment(run_every=VECTORIZE_POLL_SECONDS)
+def vectorization_jobs_section():
+    """Lists this session's vectorization jobs, refreshing on its own until they have finished."""
+    queue = get_vectorization_queue()
+    st.subheader("Vectorization jobs")
+    for job_id in list(st.session_state.vectorization_jobs):
+        job = queue.get(job_id)
+        if job is None:
+            st.session_state.vectorization_jobs.remove(job_id)
+            st.caption(f"Job {job_id} has expired.")
+            continue
+        info, actions = st.columns([3, 2])
+        info.markdown(f"**{job.name}** · `{job.job_id}` · {job.backend}")
+        info.caption(job.describe())
+        if job.preprocess_report:
+            info.caption(job.preprocess_report)
+        if job.status == 'done':
+            col1, col2, col3 = actions.columns(3)
+            if col1.button("Load", key=f"load_job_{job_id}", help="Use this SVG for the DXF export"):
+                st.session_state.last_svg_content = job.svg
+                st.session_state.last_svg_name = job.name
+                st.rerun(scope="app")
+            col2.download_button("SVG", data=job.svg.encode("utf-8"), mime="image/svg+xml",
+                                 file_name=f"{os.path.splitext(job.name)[0]}_vectorized.svg", key=f"download_job_{job_id}")
+            if col3.button("Remove", key=f"remove_job_{job_id}"):
+                queue.remove(job_id)
+                st.session_state.vectorization_jobs.remove(job_id)
+                st.rerun(scope="fragment")
+        elif job.status == 'failed':
+            col1, col2 = actions.columns(2)
+            if col1.button("Retry", key=f"retry_job_{job_id}"):
+                queue.retry(job_id)
+                st.rerun(scope="fragment")
+            if col2.button("Remove", key=f"remove_job_{job_id}"):
+                queue.remove(job_id)
+                st.session_state.vectorization_jobs.remove(job_id)
+                st.rerun(scope="fragment")
+    st.markdown("---")
+
+def pdf_conversion_section(pdf_bytes, base_name, backend, vectorizer_params, preprocess_options=None, render_dpi=None):
+    """Renders the conversion of PDF pages to DXF, reading vector pages directly and tracing scanned ones.
+
+    Page workers open the PDF from a temporary file, which only lives while the batch runs.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        page_count = pdf.page_count
+
+    with st.expander(f"Convert PDF pages to DXF ({page_count} page{'s' if page_count != 1 else ''})", expanded=True):
+        selection = ""
+        if page_count > 1:
+            selection = st.text_input("Pages", placeholder=f"All pages, or e.g. 1-5, 8 (of {page_count})", key="pdf_batch_pages")
+        extract_vectors = st.checkbox("Read vector paths and text directly", value=True, key="pdf_extract_vectors",
+                                      help="Exact geometry for CAD plots; only scanned pages are traced by the vectorizer.")
+        mode = 'layouts'
+        if page_count > 1:
+            mode = PDF_OUTPUT_MODES[st.radio("Output", list(PDF_OUTPUT_MODES), key="pdf_batch_output", horizontal=True)]
+        compress = mode == 'layouts' and st.checkbox("Compress DXF download (.zip)", key="pdf_batch_compress")
+        simplify_tolerance = simplify_settings(key_prefix="pdf_")
+        if not vectorizer_ready(backend):
+            if not extract_vectors:
+                st.warning(f"The selected vectorizer is not available. {service_unavailable_reason('vectorizer')}")
+                return
+            st.caption("The selected vectorizer is not available, so scanned pages cannot be converted.")
+        if not st.button("Convert pages to DXF", key="pdf_batch_btn"):
+            return
+        try:
+            pages = parse_page_selection(selection, page_count)
+        except ValueError as e:
+            st.error(str(e))
+            return
+
+        tolerance = st.session_state.get("curve_tolerance", SVG_CURVE_TOLERANCE)
+        started = time.perf_counter()
+        outcomes = []
+        progress_bar = st.progress(0.0, text=f"Converting {len(pages)} pages...")
+        # Removed even when a rerun or stop interrupts the batch.
+        with tempfile.TemporaryDirectory() as batch_dir:
+            pdf_path = os.path.join(batch_dir, "upload.pdf")
+            with open(pdf_path, "wb") as f:
+                f.write(pdf_bytes)
+            for outcome in iter_converted_pdf_pages(pdf_path, pages, backend, vectorizer_params, tolerance,
+                                                    write_dxf=(mode == 'files'), extract_vectors=extract_vectors,
+                                                    preprocess=preprocess_options, dpi=render_dpi, simplify=simplify_tolerance):
+                outcomes.append(outcome)
+                method = "read" if outcome['vectors'] is not None else "traced"
+                status = "failed" if outcome['error'] else f"{method} in {outcome['seconds']:.1f} s"
+                progress_bar.progress(len(outcomes) / len(pages),
+                                      text=f"Page {outcome['page'] + 1} {status} ({len(outcomes)} of {len(pages)})")
+
+        failed = [o for o in outcomes if o['error']]
+        for outcome in sorted(failed, key=lambda o: o['page']):
+            st.error(f"Page {outcome['page'] + 1}: {outcome['error']}")
+        if len(failed) == len(outcomes):
+            return
+        buffer, file_name, mime = assemble_pdf_dxf(outcomes, mode, base_name, tolerance, compress, simplify_tolerance)
+        traced = [o['stats'] for o in outcomes if o.get('stats')]
+        if traced:
+            st.caption("Traced pages: " + format_simplify_stats({key: sum(stats[key] for stats in traced) for key in traced[0]}))
+        page_seconds = sum(o['seconds'] for o in outcomes)
+        vector_pages = sum(1 for o in outcomes if o['vectors'] is not None)
+        st.success(f"Converted {len(outcomes) - len(failed)} of {len(pages)} pages in {time.perf_counter() - started:.1f} s "
+                   f"({page_seconds:.1f} s of page work); {vector_pages} read as vectors "
+                   f"({sum(count_pdf_vectors(o['vectors']) for o in outcomes if o['vectors'] is not None):,} entities), "
+                   f"{len(outcomes) - len(failed) - vector_pages} traced.")
+        st.download_button(label=f"Download {file_name}", data=buffer, file_name=file_name, mime=mime,
+                           key="pdf_batch_download_btn")
+
 # --- Main Application Logic ---
 
 def main():
@@ -1398,14 +5085,22 @@ def main():
 
     # --- Initialize State ---
     for key, default in {
-        'doc': None,
-        'msp': None,
+        'dxf_parse_cancelled': None,
+        'geometry': None,
         'entity_summary': {},
         'layers': set(),
         'visualization_description': "",
-        'chat_history': [{"role": "system", "content": "You are a helpful CAD assistant. Respond concisely and accurately based on the provided DXF data."}],
+        'dxf_file_hash': None,
+        'show_entity_details': False,
+        'show_visualization': False,
+        'show_line_cleanup': False,
+        'chat_history': [],
+        'chat_summary': new_chat_summary(),
+        'llm_metrics': deque(maxlen=LLM_METRICS_HISTORY),
         'current_image_pil': None,
         'last_svg_content': None,
+        'last_svg_name': "",
+        'vectorization_jobs': [],
         'uploaded_file_name': ""
     }.items():
         if key not in st.session_state:
@@ -1417,6 +5112,11 @@ def main():
     elif nav_option == "Raster to Vector Converter":
         raster_to_vector_section()
 
+    # --- AI Latency ---
+    if st.session_state.llm_metrics:
+        with st.sidebar:
+            st.markdown("**⏱️ AI Latency**")
+            st.caption(summarize_llm_metrics(st.session_state.llm_metrics))
 
     # --- Optional Footer (Uncomment if needed) ---
     st.markdown("<div class='footer'>© 2025 TAILAI LABS PVT LTD. All rights reserved.</div>", unsafe_allow_html=True)
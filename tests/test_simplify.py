@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("points, expected", [
+    ([(0, 0), (10, 10), (10.001, 10.001)], [(0, 0), (10, 10)]),
+    ([(0, 0), (10, 5), (20, 0.001), (20, 0.001)], [(0, 0), (10, 5), (20, 0)]),
+    ([(0, 0), (10, 10), (20, 0), (20.004, 0), (20.004, 0.004)], [(0, 0), (10, 10), (20, 0)]),
+])
+def test_simplify_keeps_polyline_ends(points, expected):
+    points = np.array(points, dtype=float)
+    result, _, _ = app.simplify_polyline_list([(points, False)], 0.5)
+    assert len(result) == 1
+    simplified = result[0][0]
+    np.testing.assert_allclose(simplified[[0, -1]], points[[0, -1]], atol=0.5)
+    np.testing.assert_allclose(simplified, expected, atol=0.5)
@@ -0,0 +1,21 @@
+import ezdxf
+import numpy as np
+
+import app
+
+
+def test_parse_svg_path_skips_unknown_characters():
+    polylines = app.parse_svg_path("M0 0 L10 10 # M1 1 x L2 2")
+    assert [points.tolist() for points, _ in polylines] == [[[0, 0], [10, 10]], [[1, 1], [2, 2]]]
+
+
+def test_parse_svg_numbers_skips_unknown_characters():
+    np.testing.assert_array_equal(app.parse_svg_numbers("1,2 3-4 5.5.5 #"), [1, 2, 3, -4, 5.5, 0.5])
+
+
+def test_bad_path_does_not_stop_export():
+    svg = ('<svg xmlns="http://www.w3.org/2000/svg"><path d="M0 0 L10 10 #"/>'
+           '<path d="M0 0 L5 0 L5 5 Z"/></svg>')
+    doc = ezdxf.new("R2010")
+    stats = app.add_svg_to_layout(doc.modelspace(), svg)
+    assert stats['entities'] == 2